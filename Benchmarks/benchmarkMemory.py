@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Compares the peak memory of the analysis steps with the compact dtype policy and with 64 bit types
+# Usage: python benchmarkMemory.py [size]
+
+import sys
+import os
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CLI"))
+
+# The dtype policy settings of each run
+POLICIES = {
+    "compact": {"DENSITY_DTYPE": "float32"},
+    "64 bit": {"DENSITY_DTYPE": "float64", "LABEL_DTYPE": "int64", "DISTANCE_DTYPE": "int64"},
+}
+
+
+def phantom(size):
+    """Creates a reference volume of random smooth trabeculae, and its bone mask."""
+    from scipy.ndimage import gaussian_filter
+
+    rng = np.random.default_rng(0)
+    smooth = gaussian_filter(rng.random((size, size, size), dtype=np.float32), 2)
+    low, high = np.min(smooth), np.max(smooth)
+    img = ((smooth - low) / (high - low) * 4000).astype(np.int16)
+    return img, img > np.percentile(img, 60)
+
+
+def residentMemory():
+    """Gets the current and peak resident memory of this process in bytes, from /proc on Linux or getrusage elsewhere."""
+    import resource
+
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]) * 1024, int(fields["VmHWM"].split()[0]) * 1024
+    # macOS reports bytes, and only the peak
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak, peak
+
+
+def resetPeak():
+    """Sets the peak resident memory to the current memory, where the system allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def runStep(step, policy, directory):
+    """Runs one step in a new process. Returns the increase of its peak resident memory, in bytes."""
+    from MusculoskeletalAnalysisCLITools import connectivityDensity, dtypes, findSpheres, largestCC, meanDensity
+
+    for name, value in POLICIES[policy].items():
+        setattr(dtypes, name, value)
+    img = np.load(os.path.join(directory, "img.npy"))
+    mask = np.load(os.path.join(directory, "mask.npy"))
+    # Loading the volumes can leave the peak above the current memory, which would hide the peak of the step
+    resetPeak()
+    (before, _) = residentMemory()
+    if step == "density":
+        meanDensity(img, mask, 1.5, -100)
+    elif step == "largestCC":
+        largestCC(mask)
+    elif step == "connectivity":
+        connectivityDensity(mask, 1)
+    elif step == "thickness":
+        findSpheres(mask)
+    (_, after) = residentMemory()
+    return after - before
+
+
+def main(size):
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        print("Peak memory can only be measured on Linux and macOS")
+        sys.exit(1)
+    with tempfile.TemporaryDirectory() as directory:
+        img, mask = phantom(size)
+        np.save(os.path.join(directory, "img.npy"), img)
+        np.save(os.path.join(directory, "mask.npy"), mask)
+        print("Step\t" + "\t".join(p + " (MB)" for p in POLICIES) + "\tReduction")
+        for step in ("density", "largestCC", "connectivity", "thickness"):
+            peaks = []
+            for policy in POLICIES:
+                # A new process for each run, so the peak of one run does not hide the next
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                    peaks.append(pool.submit(runStep, step, policy, directory).result())
+            print("{}\t{}\t{:.0%}".format(step, "\t".join("{:.1f}".format(p / 2**20) for p in peaks),
+                  1 - peaks[0] / peaks[1] if peaks[1] > 0 else 0))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 160)
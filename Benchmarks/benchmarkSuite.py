@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+# Times every analysis tool and CLI module on synthetic phantoms, and compares their results to the known geometry
+# Usage: python benchmarkSuite.py [size ...] [--only name,...] [--workers N]
+
+import sys
+import os
+import contextlib
+import io
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CLI"))
+
+# Physical side length of a voxel, in mm
+VOXEL_SIZE = 0.01
+# Image value of bone, and the thresholds and density calibration every analysis uses
+BONE = 4000
+LOWER = 2000
+UPPER = 10000
+SLOPE = 0.5
+INTERCEPT = -100
+# Slices of the first axis of a phantom evaluated at once, which bounds the temporary memory of large phantoms
+GRID_CHUNK = 16
+# The phantoms each analysis is run on
+CLI_PHANTOMS = {
+    "cortical": ("cortical",),
+    "density": ("cortical",),
+    "cancellous": ("plates", "rods", "lattice"),
+    "intervertebral": ("disc",),
+}
+
+
+def grid(size, function, dtype):
+    """Evaluates function(x, y, z) on a size^3 voxel grid, a few slices of the first axis at a time.
+
+    The coordinates are broadcastable float32 arrays of voxel indices, and the result is broadcast to the slices.
+    """
+    out = np.empty((size, size, size), dtype=dtype)
+    y = np.arange(size, dtype=np.float32)[None, :, None]
+    z = np.arange(size, dtype=np.float32)[None, None, :]
+    for start in range(0, size, GRID_CHUNK):
+        x = np.arange(start, min(start + GRID_CHUNK, size), dtype=np.float32)[:, None, None]
+        out[start:start + len(x)] = np.broadcast_to(function(x, y, z), (len(x), size, size))
+    return out
+
+
+def corticalPhantom(size):
+    """A hollow cylinder along the last axis, filled with bone, around an empty medullary cavity.
+
+    Returns the image, the mask of the wall, and the known values of the cortical and density reports.
+    """
+    center = (size - 1) / 2
+    outer = 0.4 * size
+    inner = 0.25 * size
+    mask = grid(size, lambda x, y, z: (np.hypot(x - center, y - center) >= inner) & (np.hypot(x - center, y - center) < outer), bool)
+    img = np.where(mask, BONE, 0).astype(np.int16)
+    density = BONE * SLOPE + INTERCEPT
+    truth = {
+        "cortical": {
+            "Mean Cortical Thickness (mm)": (outer - inner) * VOXEL_SIZE,
+            "Tissue Mineral Density(mgHA/cm^3)": density,
+            "Porosity": 0,
+            "Total Area (mm^2)": np.pi * outer**2 * VOXEL_SIZE**2,
+            "Bone Area (mm^2)": np.pi * (outer**2 - inner**2) * VOXEL_SIZE**2,
+            "Medullary Area (mm^2)": np.pi * inner**2 * VOXEL_SIZE**2,
+            "Polar Moment of Interia(mm^4)": np.pi / 2 * (outer**4 - inner**4) * VOXEL_SIZE**4,
+        },
+        "density": {
+            "Mean Area": np.pi * (outer**2 - inner**2) * VOXEL_SIZE**2,
+            "Mean Density": density,
+            "Standard Deviation of Density": 0,
+        },
+    }
+    return img, mask, truth
+
+
+def cancellousPhantom(size, kind):
+    """Plates, rods along the last axis, or a cubic lattice of square rods, with a known thickness.
+
+    The structure repeats every 3 thicknesses and fills the volume, like trabeculae continuing past a segment. The mask
+    is a box of a whole number of periods in the middle of the volume. Voxels are partly bone by their distance from
+    the surface, so the marching cubes surface at the lower threshold lies on the true surface.
+    Returns the image, the mask, the known values of the cancellous report, and the thickness and period in voxels.
+    """
+    thickness = max(2, size // 16)
+    period = 3 * thickness
+    periods = max(1, (size - 2 * thickness) // period)
+    side = periods * period
+    start = (size - side) // 2
+    middle = 1.5 * thickness - 0.5
+
+    # Signed distance from the middle of each period along one axis to the surface of a plate there
+    def offset(c):
+        return thickness / 2 - np.abs((c - start) % period - middle)
+
+    if kind == "plates":
+        distance = lambda x, y, z: offset(z)
+    elif kind == "rods":
+        distance = lambda x, y, z: thickness / 2 - np.hypot((x - start) % period - middle, (y - start) % period - middle)
+    elif kind == "lattice":
+        distance = lambda x, y, z: np.maximum(np.maximum(np.minimum(offset(x), offset(y)), np.minimum(offset(x), offset(z))), np.minimum(offset(y), offset(z)))
+    else:
+        raise ValueError("Unknown phantom " + kind)
+    img = grid(size, lambda x, y, z: BONE * np.clip(0.5 + distance(x, y, z), 0, 1), np.int16)
+    inBox = lambda c: (c >= start) & (c < start + side)
+    mask = grid(size, lambda x, y, z: inBox(x) & inBox(y) & inBox(z), bool)
+
+    totalVolume = side**3
+    truth = {"Total Volume (mm^3)": totalVolume * VOXEL_SIZE**3}
+    if kind != "lattice":
+        # The junctions of the lattice hold larger spheres than its rods
+        truth["Mean Trabecular Thickness (mm)"] = thickness * VOXEL_SIZE
+    if kind == "plates":
+        boneVolume = periods * thickness * side**2
+        # The gaps between the plates continue past the mask, so the spacing is the same everywhere
+        truth["Mean Trabecular Spacing (mm)"] = 2 * thickness * VOXEL_SIZE
+        # The number of plates crossed per mm, which the report approximates from the spacing
+        truth["Trabecular Number"] = 1 / (period * VOXEL_SIZE)
+        # Each plate cut by the box is a box, whose area grows by 2*pi times the sum of its sides as it is offset
+        area = 2 * side**2 + 4 * thickness * side
+        # The analyses move the surface along the marching cubes normals, into the bone, so convex bone has a negative SMI
+        truth["Structure Model Index"] = -6 * thickness * side**2 * 2 * np.pi * (thickness + 2 * side) / area**2
+        # The plates are separate, so only one is kept and it has no connections
+        truth["Connectivity Density"] = 0
+    elif kind == "rods":
+        radius = thickness / 2
+        boneVolume = periods**2 * np.pi * radius**2 * side
+        # A closed cylinder, whose area grows by 2*pi*(height + pi*radius) as it is offset
+        area = 2 * np.pi * radius * side + 2 * np.pi * radius**2
+        truth["Structure Model Index"] = -6 * np.pi * radius**2 * side * 2 * np.pi * (side + np.pi * radius) / area**2
+        truth["Connectivity Density"] = 0
+    else:
+        boneVolume = 7 / 27 * totalVolume
+        # The lattice is a thickened graph, so its Euler characteristic is the junctions minus the rods between them
+        euler = periods**3 - 3 * periods**2 * (periods - 1)
+        truth["Connectivity Density"] = (1 - euler) / (totalVolume * VOXEL_SIZE**3)
+    truth["Bone Volume (mm^3)"] = boneVolume * VOXEL_SIZE**3
+    truth["Bone Volume/Total Volume"] = boneVolume / totalVolume
+    if kind != "rods":
+        # The surfaces lie between voxels, so every bone voxel is whole
+        truth["Tissue Mineral Density(mgHA/cm^3)"] = BONE * SLOPE + INTERCEPT
+    return img, mask, {"cancellous": truth}, thickness, period
+
+
+def discPhantom(size):
+    """A disc and its nucleus pulposus, as nested ellipsoids flattened along the last axis.
+
+    Returns the image, the masks of the disc and the nucleus, and the known values of the intervertebral report.
+    """
+    center = (size - 1) / 2
+    disc = np.array([0.4, 0.3, 0.15]) * size
+    nucleus = np.array([0.2, 0.15, 0.08]) * size
+    ellipsoid = lambda axes: lambda x, y, z: ((x - center) / axes[0])**2 + ((y - center) / axes[1])**2 + ((z - center) / axes[2])**2 < 1
+    discMask = grid(size, ellipsoid(disc), bool)
+    nucleusMask = grid(size, ellipsoid(nucleus), bool)
+    img = np.where(discMask, BONE, 0).astype(np.int16)
+    volume = 4 / 3 * np.pi * np.prod(disc)
+    npVolume = 4 / 3 * np.pi * np.prod(nucleus)
+    truth = {
+        "Disc Volume (mm^3)": volume * VOXEL_SIZE**3,
+        "Nucleus Pulposus Volume (mm^3)": npVolume * VOXEL_SIZE**3,
+        "Volume Ratio": npVolume / volume,
+        "Annulus Fibrosus Width (mm)": 2 * disc[0] * VOXEL_SIZE,
+        "Nucleus Pulposus Width (mm)": 2 * nucleus[0] * VOXEL_SIZE,
+        "Disc Height (mm)": 2 * disc[2] * VOXEL_SIZE,
+        "Disc Height Ratio": disc[2] / disc[0],
+    }
+    return img, discMask, nucleusMask, {"intervertebral": truth}
+
+
+def writeVolume(path, data):
+    """Writes a volume to an uncompressed NRRD file with identity directions, so the analyses read it unchanged."""
+    import nrrd
+
+    nrrd.write(path, data, {"space": "left-posterior-superior", "space directions": np.eye(3) * VOXEL_SIZE, "encoding": "raw"})
+
+
+def makePhantom(kind, size, directory):
+    """Creates a phantom and writes it to files for the CLI modules.
+
+    Returns a dict with the image, mask and bone cropped to the mask, as the analyses see them, the file names, and
+    the known values of each report.
+    """
+    from MusculoskeletalAnalysisCLITools import crop
+
+    phantom = {"kind": kind, "size": size, "directory": directory}
+    if kind == "cortical":
+        (img, mask, phantom["truth"]) = corticalPhantom(size)
+    elif kind == "disc":
+        (img, mask, mask2, phantom["truth"]) = discPhantom(size)
+        writeVolume(os.path.join(directory, "mask2.nrrd"), mask2.astype(np.uint8))
+        phantom["mask2File"] = os.path.join(directory, "mask2.nrrd")
+        phantom["mask2"] = mask2
+    else:
+        (img, mask, phantom["truth"], phantom["thickness"], phantom["period"]) = cancellousPhantom(size, kind)
+    writeVolume(os.path.join(directory, "img.nrrd"), img)
+    writeVolume(os.path.join(directory, "mask.nrrd"), mask.astype(np.uint8))
+    phantom["imgFile"] = os.path.join(directory, "img.nrrd")
+    phantom["maskFile"] = os.path.join(directory, "mask.nrrd")
+    phantom["fullImg"] = img
+    phantom["fullMask"] = mask
+    (phantom["mask"], phantom["img"]) = crop(mask, img)
+    phantom["bone"] = (phantom["img"] > LOWER) & (phantom["img"] <= UPPER) & phantom["mask"]
+    return phantom
+
+
+def residentMemory():
+    """Gets the current resident memory of this process in bytes, or None where /proc is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def measure(function, *args):
+    """Runs a function once. Returns its result, the seconds it took, and the increase of the peak resident memory in bytes, or None if it can not be measured."""
+    from MusculoskeletalAnalysisCLITools.profiling import StageTimer
+
+    before = residentMemory()
+    timer = StageTimer(function.__name__, {})
+    # The progress the tools report to Slicer is not shown
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    record = timer.stop()
+    peak = record["peakMemory"] - before if before is not None and record["peakMemory"] is not None else None
+    return result, record["wall"], peak
+
+
+def primedCache(phantom):
+    """Stores the largest component of the bone in a cache, and returns the call that loads it again."""
+    from MusculoskeletalAnalysisCLITools import ResultCache, cacheKey, cached, largestCC
+
+    cache = ResultCache(os.path.join(phantom["directory"], "cache"))
+    key = cacheKey("largestCC", phantom["kind"])
+    cached(cache, key, largestCC, phantom["bone"])
+    return lambda: cached(cache, key, largestCC, phantom["bone"])
+
+
+def storeResult(phantom):
+    """Returns a call that stores the bone in a new cache directory."""
+    from MusculoskeletalAnalysisCLITools import ResultCache, cacheKey
+
+    directory = tempfile.mkdtemp(dir=phantom["directory"])
+    return lambda: ResultCache(directory).put(cacheKey("bone", phantom["kind"]), (phantom["bone"],))
+
+
+def profileStages(phantom):
+    """Returns a call that records a stage in a StageProfile and writes it to the phantom directory."""
+    from MusculoskeletalAnalysisCLITools import StageProfile, stage
+
+    def run():
+        profile = StageProfile()
+        with stage(profile, "threshold", image=phantom["img"]):
+            bone = phantom["img"] > LOWER
+        profile.write(phantom["directory"], phantom["kind"], "benchmark.txt")
+        return bone
+    return run
+
+
+def writeSlices(phantom, sink):
+    """Returns a call that writes the number of bone voxels of each slice to a report, with writeReport or a ReportSink."""
+    from MusculoskeletalAnalysisCLITools import ReportSink, writeReport
+
+    path = os.path.join(phantom["directory"], "benchmark.txt")
+    counts = np.count_nonzero(phantom["bone"], axis=(0, 1))
+    if sink:
+        def run():
+            with ReportSink(path, ["Slice", "Bone Voxels"]) as report:
+                for i in range(10):
+                    report.add([np.arange(len(counts)), counts])
+        return run
+    return lambda: writeReport(path, ["Slice", "Bone Voxels"], [np.arange(len(counts)), counts])
+
+
+def toolBenchmarks(workers):
+    """Lists the benchmark of each exported tool as (name, phantom, setup).
+
+    setup takes the phantom and returns the function to time, its arguments, and None or a function that takes the
+    result and phantom and returns a list of (measure, value, known value).
+    """
+    import MusculoskeletalAnalysisCLITools as tools
+    from MusculoskeletalAnalysisCLITools.shape import marchingCubes
+
+    canc = lambda p, field: p["truth"]["cancellous"][field]
+    cort = lambda p, field: p["truth"]["cortical"][field]
+    disc = lambda p, field: p["truth"]["intervertebral"][field]
+    volume = lambda p: np.count_nonzero(p["mask"]) * VOXEL_SIZE**3
+    return [
+        ("cacheKey", "plates", lambda p: (tools.cacheKey, (p["img"],), None)),
+        ("fileKey", "plates", lambda p: (tools.fileKey, (p["imgFile"], p["maskFile"]), None)),
+        ("ResultCache", "plates", lambda p: (storeResult(p), (), None)),
+        ("cached", "plates", lambda p: (primedCache(p), (), None)),
+        ("connectivityDensity", "lattice", lambda p: (tools.connectivityDensity, (p["bone"], volume(p)),
+            lambda r, p: [("Connectivity Density", r, canc(p, "Connectivity Density"))])),
+        ("connectivityMap", "lattice", lambda p: (tools.connectivityMap, (p["bone"], p["mask"], VOXEL_SIZE, p["period"]),
+            lambda r, p: [("Connections", 1 + np.nansum(r * blockVolumes(p["mask"], p["period"])), canc(p, "Connectivity Density") * volume(p))])),
+        ("crop", "plates", lambda p: (tools.crop, (p["fullMask"], p["fullImg"]),
+            lambda r, p: [("Total Volume (mm^3)", np.count_nonzero(r[0]) * VOXEL_SIZE**3, canc(p, "Total Volume (mm^3)"))])),
+        ("squaredDistance", "plates", lambda p: (tools.squaredDistance, (p["bone"],), None)),
+        ("signedDistance", "plates", lambda p: (tools.signedDistance, (p["bone"], p["mask"] & ~p["bone"]), None)),
+        ("phaseDistance", "plates", lambda p: (tools.phaseDistance, (tools.signedDistance(p["bone"], p["mask"] & ~p["bone"]), 1), None)),
+        ("densityMap", "plates", lambda p: (tools.densityMap, (p["img"], SLOPE, INTERCEPT), None)),
+        ("meanDensity", "plates", lambda p: (tools.meanDensity, (p["img"], p["bone"], SLOPE, INTERCEPT),
+            lambda r, p: [("Tissue Mineral Density(mgHA/cm^3)", r, canc(p, "Tissue Mineral Density(mgHA/cm^3)"))])),
+        ("densityStats", "cortical", lambda p: (tools.densityStats, (p["img"], p["mask"], SLOPE, INTERCEPT),
+            lambda r, p: [("Mean Area", np.mean(r[0]) * VOXEL_SIZE**2, p["truth"]["density"]["Mean Area"])])),
+        ("poolStats", "cortical", lambda p: (tools.poolStats, tools.densityStats(p["img"], p["mask"], SLOPE, INTERCEPT),
+            lambda r, p: [("Mean Density", r[0], p["truth"]["density"]["Mean Density"])])),
+        ("eulerNumber", "lattice", lambda p: (tools.eulerNumber, (p["bone"], 3, workers),
+            lambda r, p: [("Connections", 1 - r, canc(p, "Connectivity Density") * volume(p))])),
+        ("eulerMap", "lattice", lambda p: (tools.eulerMap, (p["bone"], p["period"]),
+            lambda r, p: [("Connections", 1 - np.sum(r), canc(p, "Connectivity Density") * volume(p))])),
+        ("fill", "cortical", lambda p: (tools.fill, (p["mask"][:, :, p["mask"].shape[2] // 2], 5),
+            lambda r, p: [("Total Area (mm^2)", np.count_nonzero(r) * VOXEL_SIZE**2, cort(p, "Total Area (mm^2)"))])),
+        ("fillSlices", "cortical", lambda p: (tools.fillSlices, (p["mask"], 5, workers),
+            lambda r, p: [("Total Area (mm^2)", np.count_nonzero(r) / r.shape[2] * VOXEL_SIZE**2, cort(p, "Total Area (mm^2)"))])),
+        ("largestCC", "lattice", lambda p: (tools.largestCC, (p["bone"],),
+            lambda r, p: [("Bone Volume/Total Volume", np.count_nonzero(r) / np.count_nonzero(p["mask"]), canc(p, "Bone Volume/Total Volume"))])),
+        ("areaMoments", "cortical", lambda p: (tools.areaMoments, (p["mask"],),
+            lambda r, p: [("Polar Moment of Interia(mm^4)", np.mean(r[3] + r[4]) * VOXEL_SIZE**4, cort(p, "Polar Moment of Interia(mm^4)"))])),
+        ("principalMoments", "cortical", lambda p: (tools.principalMoments, tools.areaMoments(p["mask"])[3:],
+            lambda r, p: [("Imax (mm^4)", np.mean(r[0]) * VOXEL_SIZE**4, cort(p, "Polar Moment of Interia(mm^4)") / 2)])),
+        ("sectionModulus", "cortical", lambda p: (tools.sectionModulus, sectionArguments(p["mask"]), None)),
+        ("mapMask", "cortical", lambda p: (tools.mapMask, (p["maskFile"],), None)),
+        ("maskRegion", "cortical", lambda p: (tools.maskRegion, (p["maskFile"],), None)),
+        ("readImg", "cortical", lambda p: (tools.readImg, (p["imgFile"], tools.maskRegion(p["maskFile"])), None)),
+        ("readMask", "cortical", lambda p: (tools.readMask, (p["maskFile"], tools.maskRegion(p["maskFile"])), None)),
+        ("openImg", "cortical", lambda p: (lambda: np.asarray(tools.openImg(p["imgFile"], tools.maskRegion(p["maskFile"]))), (), None)),
+        ("slabs", "cortical", lambda p: (tools.slabs, (p["img"].shape, 64, p["img"].itemsize), None)),
+        ("runStages", "plates", lambda p: (tools.runStages, ([("tmd", tools.meanDensity, ("image", "bone"), (SLOPE, INTERCEPT), ()),
+                                                              ("euler", tools.eulerNumber, ("bone",), (3,), ())], {"image": p["img"], "bone": p["bone"]}, workers),
+            lambda r, p: [("Tissue Mineral Density(mgHA/cm^3)", r["tmd"], canc(p, "Tissue Mineral Density(mgHA/cm^3)"))])),
+        ("bWshape", "plates", lambda p: (tools.bWshape, (p["img"], LOWER), None)),
+        ("updateVertices", "plates", lambda p: (tools.updateVertices, (lambda mesh: (mesh, mesh.vertices))(tools.bWshape(p["img"], LOWER)), None)),
+        ("meshMetrics", "plates", lambda p: (tools.meshMetrics, (p["img"], LOWER, VOXEL_SIZE),
+            lambda r, p: [("Bone Volume (mm^3)", r[0], canc(p, "Bone Volume (mm^3)")), ("Structure Model Index", r[1], canc(p, "Structure Model Index"))])),
+        ("maskedMeshMetrics", "plates", lambda p: (tools.maskedMeshMetrics, (p["img"], p["mask"], LOWER, VOXEL_SIZE, None, None, workers),
+            lambda r, p: [("Bone Volume (mm^3)", r[0], canc(p, "Bone Volume (mm^3)")), ("Structure Model Index", r[1], canc(p, "Structure Model Index"))])),
+        ("surfaceSums", "rods", lambda p: (tools.surfaceSums, (p["img"], LOWER, workers, p["mask"]),
+            lambda r, p: [("Bone Volume (mm^3)", r[0] * VOXEL_SIZE**3, canc(p, "Bone Volume (mm^3)"))])),
+        ("surfaceDerivative", "rods", lambda p: (tools.surfaceDerivative, marchingCubes(p["img"], LOWER), None)),
+        ("voxelSMI", "rods", lambda p: (tools.voxelSMI, (p["bone"], VOXEL_SIZE),
+            lambda r, p: [("Structure Model Index", r, canc(p, "Structure Model Index"))])),
+        ("distanceSpheres", "plates", lambda p: (tools.distanceSpheres, (tools.squaredDistance(p["bone"]), workers), None)),
+        ("findSpheres", "plates", lambda p: (tools.findSpheres, (p["bone"], "ridge", workers),
+            lambda r, p: [("Mean Trabecular Thickness (mm)", 2 * np.mean(r[r > 0]) * VOXEL_SIZE, canc(p, "Mean Trabecular Thickness (mm)"))])),
+        # Each slab holds about a quarter of the volume, at 32 bytes per voxel
+        ("slabSpheres", "plates", lambda p: (tools.slabSpheres, (p["bone"], p["bone"].size * 8 / 2**20),
+            lambda r, p: [("Mean Trabecular Thickness (mm)", 2 * np.mean(r[r > 0]) * VOXEL_SIZE, canc(p, "Mean Trabecular Thickness (mm)"))])),
+        ("thicknessStats", "rods", lambda p: (tools.thicknessStats, (p["bone"], VOXEL_SIZE, workers),
+            lambda r, p: [("Mean Trabecular Thickness (mm)", r[0], canc(p, "Mean Trabecular Thickness (mm)"))])),
+        ("phaseThicknessStats", "plates", lambda p: (tools.phaseThicknessStats, (tools.signedDistance(p["bone"], p["mask"] & ~p["bone"]), -1, VOXEL_SIZE, workers),
+            lambda r, p: [("Mean Trabecular Spacing (mm)", r[0], canc(p, "Mean Trabecular Spacing (mm)"))])),
+        ("sliceWidths", "disc", lambda p: (tools.sliceWidths, (p["mask"], workers),
+            lambda r, p: [("Annulus Fibrosus Width (mm)", r[0][r[1]] * VOXEL_SIZE, disc(p, "Annulus Fibrosus Width (mm)"))])),
+        ("width", "disc", lambda p: (tools.width, (tools.crop(p["mask2"])[0],),
+            lambda r, p: [("Nucleus Pulposus Width (mm)", r * VOXEL_SIZE, disc(p, "Nucleus Pulposus Width (mm)"))])),
+        ("writeReport", "plates", lambda p: (writeSlices(p, False), (), None)),
+        ("ReportSink", "plates", lambda p: (writeSlices(p, True), (), None)),
+        ("startProfile", "plates", lambda p: (tools.startProfile, ("stages",), None)),
+        ("StageProfile", "plates", lambda p: (profileStages(p), (), None)),
+        ("stage", "plates", lambda p: (profileStages(p), (), None)),
+    ]
+
+
+def blockVolumes(mask, blockSize):
+    """Finds the volume of the mask in each block of blockSize voxels along each axis, in mm^3."""
+    for axis in range(mask.ndim):
+        mask = np.add.reduceat(mask, np.arange(0, mask.shape[axis], blockSize), axis=axis, dtype=np.int64)
+    return mask * VOXEL_SIZE**3
+
+
+def sectionArguments(mask):
+    """Finds the arguments of sectionModulus for a mask."""
+    from MusculoskeletalAnalysisCLITools import areaMoments, principalMoments
+
+    (_, xCenter, yCenter, xx, yy, xy) = areaMoments(mask)
+    (iMax, iMin, angle) = principalMoments(xx, yy, xy)
+    return mask, xCenter, yCenter, angle, iMax, iMin
+
+
+def runAnalysis(analysis, phantom, workers):
+    """Runs the main function of a CLI module on the files of a phantom. Returns the values of its report as a dict."""
+    from MusculoskeletalAnalysisCLITools.batch import ANALYSES, importAnalysis
+
+    (moduleName, report) = ANALYSES[analysis]
+    module = importAnalysis(moduleName)
+    output = tempfile.mkdtemp(dir=phantom["directory"])
+    (imgFile, maskFile) = (phantom["imgFile"], phantom["maskFile"])
+    if analysis in ("cortical", "cancellous"):
+        module.main(imgFile, maskFile, LOWER, UPPER, VOXEL_SIZE, SLOPE, INTERCEPT, phantom["kind"], output, workers)
+    elif analysis == "density":
+        module.main(imgFile, maskFile, VOXEL_SIZE, SLOPE, INTERCEPT, phantom["kind"], output)
+    else:
+        module.main(imgFile, maskFile, phantom["mask2File"], VOXEL_SIZE, phantom["kind"], output)
+    # Per slice values continue on the following lines, the first row has every value
+    with open(os.path.join(output, report)) as f:
+        lines = f.read().splitlines()
+    return dict(zip(lines[0].split("\t"), lines[1].split("\t")))
+
+
+def printRow(size, name, kind, seconds, peak, check=("-", None, None)):
+    """Prints one row of results, with the relative error of a value, or its absolute error if the known value is 0."""
+    (measureName, value, truth) = check
+    if truth is None:
+        error = "-"
+    elif truth == 0:
+        error = "{:.3g} abs".format(abs(value - truth))
+    else:
+        error = "{:.2%}".format(abs(value - truth) / abs(truth))
+    print("\t".join([str(size), name, kind, "{:.3f}".format(seconds), "{:.3g}".format(size**3 / seconds) if seconds > 0 else "-",
+                     "{:.1f}".format(peak / 2**20) if peak is not None else "-", measureName,
+                     "{:.6g}".format(value) if value is not None else "-", "{:.6g}".format(truth) if truth is not None else "-", error]))
+    sys.stdout.flush()
+
+
+def main(sizes, only=None, workers=1):
+    import MusculoskeletalAnalysisCLITools as tools
+
+    benchmarks = toolBenchmarks(workers)
+    missing = sorted(set(tools.__all__) - {b[0] for b in benchmarks})
+    if missing:
+        print("Tools without a benchmark: " + ", ".join(missing), file=sys.stderr)
+    selected = lambda name: only is None or name in only
+    kinds = list(dict.fromkeys([b[1] for b in benchmarks] + [k for a in CLI_PHANTOMS.values() for k in a]))
+    print("Size\tBenchmark\tPhantom\tSeconds\tVoxels/s\tPeak (MB)\tMeasure\tValue\tKnown Value\tError")
+    for size in sizes:
+        for kind in kinds:
+            runs = [b for b in benchmarks if b[1] == kind and selected(b[0])]
+            analyses = [a for a, k in CLI_PHANTOMS.items() if kind in k and selected(a)]
+            if not runs and not analyses:
+                continue
+            # Each phantom is only in memory while its benchmarks run
+            with tempfile.TemporaryDirectory() as directory:
+                phantom = makePhantom(kind, size, directory)
+                for (name, _, setup) in runs:
+                    (function, args, checks) = setup(phantom)
+                    (result, seconds, peak) = measure(function, *args)
+                    for check in checks(result, phantom) if checks else [("-", None, None)]:
+                        printRow(size, name, kind, seconds, peak, check)
+                    del result
+                for analysis in analyses:
+                    (report, seconds, peak) = measure(runAnalysis, analysis, phantom, workers)
+                    truth = phantom["truth"][analysis]
+                    for field, known in truth.items():
+                        printRow(size, analysis, kind, seconds, peak, (field, float(report[field]), known))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Times the analysis tools and CLI modules on synthetic phantoms with known measurements.")
+    parser.add_argument("sizes", type=int, nargs="*", default=[64, 128], help="The side lengths of the phantoms, in voxels")
+    parser.add_argument("--only", default=None, help="Comma separated names of the tools and analyses to run")
+    parser.add_argument("--workers", type=int, default=1, help="The number of workers given to the tools and analyses that use them")
+    args = parser.parse_args()
+    # The benchmarks run in a process of their own, so each call can start a new peak memory
+    from MusculoskeletalAnalysisCLITools import profiling
+    profiling.RESET_PEAK = True
+    main(args.sizes, args.only.split(",") if args.only else None, args.workers)
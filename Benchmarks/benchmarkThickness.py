@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# Compares the ridge and brute force thickness engines on synthetic plates and rods, and on the background around them
+# and around a sphere, which is measured as trabecular spacing
+# Usage: python benchmarkThickness.py [size] [thickness]
+
+import sys
+import os
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "CLI"))
+from MusculoskeletalAnalysisCLITools.thickness import findSpheres
+
+
+def plates(size, thickness):
+    """Creates a stack of plates perpendicular to the z axis, with spacing equal to twice their thickness."""
+    z = np.arange(size)
+    return np.broadcast_to((z % (3*thickness)) < thickness, (size, size, size)).copy()
+
+
+def rods(size, thickness):
+    """Creates a lattice of rods along the z axis, with spacing equal to twice their diameter."""
+    x, y = np.mgrid[:size, :size]
+    period = 3*thickness
+    center = (thickness-1)/2
+    section = ((x % period) - center)**2 + ((y % period) - center)**2 <= (thickness/2)**2
+    return np.broadcast_to(section[:, :, None], (size, size, size)).copy()
+
+
+def sphereBackground(size, thickness):
+    """Creates the open background around a sphere with a diameter of half the volume, where most spheres overlap."""
+    center = (size-1)/2
+    x, y, z = np.ogrid[:size, :size, :size]
+    return (x - center)**2 + (y - center)**2 + (z - center)**2 > (size/4)**2
+
+
+PHANTOMS = (
+    ("plates", plates),
+    ("rods", rods),
+    ("plate spacing", lambda size, thickness: ~plates(size, thickness)),
+    ("rod spacing", lambda size, thickness: ~rods(size, thickness)),
+    ("sphere background", sphereBackground),
+)
+
+
+def main(size, thickness):
+    print("Phantom\tMethod\tVoxels\tSeconds\tMean Thickness\tMatches Brute")
+    for name, phantom in PHANTOMS:
+        mask = phantom(size, thickness)
+        results = {}
+        for method in ("brute", "ridge"):
+            start = time.perf_counter()
+            results[method] = findSpheres(mask, method=method)
+            elapsed = time.perf_counter() - start
+            print("{}\t{}\t{}\t{:.3f}\t{:.4f}\t{}".format(name, method, np.count_nonzero(mask), elapsed,
+                  np.mean(results[method])*2, np.array_equal(results[method], results["brute"])))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 48, int(sys.argv[2]) if len(sys.argv) > 2 else 4)
@@ -4,17 +4,17 @@ import sys
 import os
 from datetime import date
 
-import numpy as np
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from MusculoskeletalAnalysisCLITools import (
-  crop,
-  bWshape,
-  densityMap,
-  findSpheres,
+  analyzeCancellous,
+  cacheKey,
+  cached,
+  fileKey,
+  maskRegion,
   readImg,
   readMask,
-  updateVertices,
+  stage,
+  startProfile,
   writeReport,
 )
 
@@ -46,79 +46,36 @@ OUTPUT_FIELDS = [
 # voxSize: The physical side length of the voxels, in mm
 # slope, intercept and scale: parameters for density conversion
 # output: The name of the output directory
-def main(inputImg, inputMask, lower, upper, voxSize, slope, intercept, name, output):
-    from skimage import measure
-
-    imgData = readImg(inputImg)
-    (_, maskData) = readMask(inputMask)
-    
-    (maskData, imgData) = crop(maskData, imgData)
-    if np.count_nonzero(maskData) == 0:
-         raise Exception("Segmentation mask is empty.")
-    trabecular = (imgData > lower) & (imgData <= upper)
-    # Create mesh using marching squares and calculate its volume
-    boneMesh = bWshape(imgData, lower)
-    boneVolume=boneMesh.volume * voxSize**3
-    # Find volume of entire mask by counting voxels
-    totalVolume = np.count_nonzero(maskData) * voxSize**3
-    bvtv = boneVolume/totalVolume
-    print("""<filter-progress>{}</filter-progress>""".format(.20))
-    sys.stdout.flush()
-    background = np.bitwise_and(maskData, np.invert(trabecular))
-    # Get the thickness map and calculate the thickness
-    rads = findSpheres(trabecular)
-    diams = rads * 2 * voxSize
-    thickness = np.mean(diams)
-    thicknessStd = np.std(diams)
-    print("""<filter-progress>{}</filter-progress>""".format(.40))
-    sys.stdout.flush()
-    # Get the thickness map for the background
-    rads = findSpheres(background)
-    diams = rads * 2 * voxSize
-    spacing = np.mean(diams)
-    spacingStd = np.std(diams)
-    trabecularNum = 1/spacing
-    print("""<filter-progress>{}</filter-progress>""".format(.60))
-    sys.stdout.flush()
-    # SMI
-    # Calculated by finding a 3d mesh, expanding the vertices by a small amount, and calculate a value based on the relative difference in surface area
-    # Measures the characteristics of the shape; 0 for plate-like, 3 for rod-like, 4 for sphere-like
-    # Surface area
-    bS = measure.mesh_surface_area(boneMesh.vertices, boneMesh.faces)*(voxSize**2)
-    # Arbitrary small value. Reducing size increases accuracy, but risks being rounded to zero
-    dr = 0.000001
-    # Creates a new mesh by moving each vertex a small distance in the direction of its vertex normal, then find the difference in surface area
-    newVert=np.add(boneMesh.vertices, boneMesh.vertex_normals*dr)
-    boneMesh = updateVertices(boneMesh, newVert)
-    dS = (measure.mesh_surface_area(boneMesh.vertices, boneMesh.faces)*(voxSize**2))-bS
-    # Convert to mm
-    dr = dr*voxSize
-    # Apply the SMI formula
-    SMI=(6*boneVolume*(dS/dr)/(bS**2))
-    print("""<filter-progress>{}</filter-progress>""".format(.80))
-    sys.stdout.flush()
-    # Calculate density
-    density = densityMap(imgData, slope, intercept)
-    tmd = np.mean(density[trabecular])
-
-    # Connnectivity
-    # Remove disconected holes and islands
-    labelmap=measure.label(np.invert(trabecular), connectivity=1)
-    largest=np.argmax(np.bincount(labelmap[np.nonzero(labelmap)]))
-    trabecular=labelmap!=largest
-    # Holes use face connectivity, switch to vertex connectivity for islands
-    labelmap=measure.label(trabecular, connectivity=3)
-    largest=np.argmax(np.bincount(labelmap[np.nonzero(labelmap)]))
-    trabecular=labelmap==largest
-
-    # Find the euler characteristic
-    # roughly equal to 2-2*number of holes
-    phi = measure.euler_number(trabecular, connectivity=3)
-    # connD gives an approximate measure of holes/connections per volume
-    connD = (1-phi)/totalVolume
-
-
-
+# workers: The number of processes used to run the analysis stages
+# columnar: "parquet" or "hdf5" to also write the results to a typed columnar file
+# cache: A ResultCache to reuse the cropped volumes and intermediate results of earlier runs on the same data
+# mapBlock: If above 0, also writes a map of the connectivity density of blocks of this many voxels on each side
+# smi: "mesh" to find the SMI from the marching cubes mesh, or "voxel" to find it from the voxels for comparison
+# maskedMesh: Find bone volume and SMI only from the bone inside the mask, meshing the blocks that contain it in parallel
+# profile: "stages" to write the time and memory of each stage next to the report, or "cprofile" to also write cProfile statistics
+def main(inputImg, inputMask, lower, upper, voxSize, slope, intercept, name, output, workers=1, columnar=None, cache=None, mapBlock=0, smi="mesh", maskedMesh=False, profile=None):
+    profile = startProfile(profile)
+    with stage(profile, "read"):
+        # Only the region around the mask is loaded, or reused if the same files were read before
+        key = fileKey(inputImg, inputMask) if cache is not None else None
+        (imgData, maskData) = cached(cache if key else None, key and cacheKey("region", key), readRegion, inputImg, inputMask)
+    analyze(imgData, maskData, lower, upper, voxSize, slope, intercept, name, output, workers, columnar, cache, mapBlock, smi, maskedMesh, profile)
+
+
+# Reads the region of the image and mask around the mask
+def readRegion(inputImg, inputMask):
+    region = maskRegion(inputMask)
+    imgData = readImg(inputImg, region)
+    (_, maskData) = readMask(inputMask, region)
+    return imgData, maskData
+
+
+# Runs the analysis on arrays that are already loaded, so the Slicer module can call it without writing files
+# imgData: The image array, oriented as returned by readImg
+# maskData: A binary array of the mask, the same shape as imgData
+def analyze(imgData, maskData, lower, upper, voxSize, slope, intercept, name, output, workers=1, columnar=None, cache=None, mapBlock=0, smi="mesh", maskedMesh=False, profile=None):
+    profile = startProfile(profile)
+    results = analyzeCancellous(imgData, maskData, lower, upper, voxSize, slope, intercept, workers, cache, mapBlock, smi, maskedMesh, profile, progress=printProgress)
 
     fPath = os.path.join(output, "cancellous.txt")
 
@@ -127,29 +84,47 @@ def main(inputImg, inputMask, lower, upper, voxSize, slope, intercept, name, out
     data = [
         date.today(),
         name,
-        totalVolume,
-        boneVolume,
-        bvtv,
-        thickness,
-        thicknessStd,
-        spacing,
-        spacingStd,
-        trabecularNum,
-        SMI,
-        connD,
-        tmd,
-        voxSize,
-        lower,
-        upper
+        results.totalVolume,
+        results.boneVolume,
+        results.bvtv,
+        results.thickness,
+        results.thicknessStd,
+        results.spacing,
+        results.spacingStd,
+        results.trabecularNum,
+        results.smi,
+        results.connD,
+        results.tmd,
+        results.voxSize,
+        results.lower,
+        results.upper
     ]
 
-    writeReport(fPath, header, data)
+    with stage(profile, "report"):
+        writeReport(fPath, header, data, columnar)
+
+        if mapBlock > 0:
+            import nrrd
+            # The map has the axes of the analyzed volume, cropped to the mask, with one voxel for each block
+            nrrd.write(os.path.join(output, name + "_connectivity.nrrd"), results.connectivityMap, {"spacings": [voxSize*mapBlock]*3})
+
+    if profile is not None:
+        profile.write(output, name, fPath)
+
+# Prints the fraction of the analysis that is done, in the format Slicer reads from the output of a CLI module
+def printProgress(fraction):
+    print("""<filter-progress>{}</filter-progress>""".format(fraction))
+    sys.stdout.flush()
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 10:
         print(sys.argv)
         print(len(sys.argv))
-        print("Usage: CancellousAnalysis <input> <mask> <lowerThreshold> <upperThreshold> <voxelSize> <slope> <intercept> <name> <output>")
+        print("Usage: CancellousAnalysis <input> <mask> <lowerThreshold> <upperThreshold> <voxelSize> <slope> <intercept> <name> <output> [workers] [mapBlock] [profile] [maskedMesh]")
         sys.exit(1)
 
-    main(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]), float(sys.argv[6]), float(sys.argv[7]), str(sys.argv[8]), str(sys.argv[9]))
+    # This process only runs the analysis, so each stage can start a new peak memory
+    from MusculoskeletalAnalysisCLITools import profiling
+    profiling.RESET_PEAK = True
+    main(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]), float(sys.argv[6]), float(sys.argv[7]), str(sys.argv[8]), str(sys.argv[9]), int(sys.argv[10]) if len(sys.argv) > 10 else 1, mapBlock=int(sys.argv[11]) if len(sys.argv) > 11 else 0, profile=sys.argv[12] if len(sys.argv) > 12 else None, maskedMesh=len(sys.argv) > 13 and sys.argv[13].lower() == "true")
@@ -4,17 +4,18 @@ import sys
 import os
 from datetime import date
 
-import numpy as np
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from MusculoskeletalAnalysisCLITools import (
-    crop,
-    densityMap,
-    findSpheres,
-    fill,
-    largestCC,
+    analyzeCortical,
+    cacheKey,
+    cached,
+    fileKey,
+    maskRegion,
+    openImg,
     readImg,
     readMask,
+    stage,
+    startProfile,
     writeReport,
 )
 
@@ -33,6 +34,18 @@ OUTPUT_FIELDS = [
     ("Voxel Dimension (mm)", "The side length of one voxel, measured in milimeters"),
 ]
 
+SLICE_FIELDS = [
+    ("Date Analysis Performed", "The current date"),
+    ("Input Volume", "Name of the input volume"),
+    ("Bone Area by Slice (mm^2)", "The area of the bone in each slice"),
+    ("Polar Moment of Inertia by Slice (mm^4)", "The moment of inertia around the z-axis of each slice"),
+    ("Imax by Slice (mm^4)", "The largest second moment of area of each slice, around its principal axis"),
+    ("Imin by Slice (mm^4)", "The smallest second moment of area of each slice, around its principal axis"),
+    ("Principal Angle by Slice (degrees)", "The angle from the first image axis to the principal axis of Imin, which runs along the widest direction of the slice"),
+    ("Max Section Modulus by Slice (mm^3)", "Imax divided by the distance from its axis to the furthest edge of the slice"),
+    ("Min Section Modulus by Slice (mm^3)", "Imin divided by the distance from its axis to the furthest edge of the slice"),
+]
+
 
 # Performs analysis on cortical bone
 # image: 3D image black and white of bone
@@ -41,70 +54,58 @@ OUTPUT_FIELDS = [
 # voxSize: The physical side length of the voxels, in mm
 # slope, intercept and scale: parameters for density conversion
 # output: The name of the output directory
-def main(inputImg, inputMask, lower, upper, voxSize, slope, intercept, name, output):
-    imgData = readImg(inputImg)
-    (_, maskData) = readMask(inputMask)
-    (maskData, imgData) = crop(maskData, imgData)
-    if np.count_nonzero(maskData) == 0:
-         raise Exception("Segmentation mask is empty.")
-    depth = np.shape(maskData)[2] * voxSize
-
-    boneVolume = np.count_nonzero(maskData) * voxSize**3
-    # Fill in hole to find medullary cavity
-    filledMask = maskData.copy()
-    print("""<filter-progress>{}</filter-progress>""".format(.20))
-    sys.stdout.flush()
-    for sliceNum in range(filledMask.shape[2]):
-        filledMask[:,:,sliceNum] = fill(filledMask[:,:,sliceNum], 5)
-    # Calculate volumes and average area
-    totalVolume = np.count_nonzero(filledMask) * voxSize**3
-    medullarVolume = totalVolume-boneVolume
-    boneArea = boneVolume/depth
-    totalArea = totalVolume/depth
-    medullarArea = medullarVolume/depth
-    print("""<filter-progress>{}</filter-progress>""".format(.40))
-    sys.stdout.flush()
-    # PMOI
-    # For each slice, calculate the second moment of area around the x-axis and y-axis
-    # I = area*(distance from center)^2
-    # PMOI = average of Ix+Iy
-    ix = np.zeros(maskData.shape[2])
-    iy = np.zeros(maskData.shape[2])
-    # Calculate Ix and Iy for each slice
-    for sliceNum in range(maskData.shape[2]):
-        # Find the x center
-        xDist = np.nonzero(maskData[:,:,sliceNum])[0]
-        xCenter = np.mean(xDist)
-        # Find distance from center squared times area. Convert from voxel units^4 to mm^4
-        ix[sliceNum] = sum((xDist-xCenter)**2)*voxSize**4
-        # Repeat for y
-        yDist = np.nonzero(maskData[:,:,sliceNum])[1]
-        yCenter = np.mean(yDist)
-        iy[sliceNum] = sum((yDist-yCenter)**2)*voxSize**4
-    # Find the average of the sum
-    pMOI = np.mean(ix)+np.mean(iy)
-    # Porosity
-    # Finds the percentage of the mask that is not in the threshold
-    porousBone = (imgData > lower) & (imgData <= upper) & maskData
-    porosity = 1 - (np.count_nonzero(porousBone)/np.count_nonzero(maskData))
-    print("""<filter-progress>{}</filter-progress>""".format(.60))
-    sys.stdout.flush()
-    # Thickness
-    # Remove disconnected areas
-    rads = largestCC(maskData)
-    # Convert to thickness map
-    rads = findSpheres(rads)
-    # Find nonzero values, double to convert to diameters, and find average
-    rads = rads[np.nonzero(rads)]
-    diams = rads * 2 * voxSize
-    thickness = np.mean(diams)
-    thicknessStd = np.std(diams)
-    print("""<filter-progress>{}</filter-progress>""".format(.80))
-    sys.stdout.flush()
-    # Calculate Density
-    # Density calculations are based on DICOM metadata
-    density = densityMap(imgData, slope, intercept)
-    tmd = np.mean(density[maskData])
+# workers: The number of processes used to calculate thickness, and threads used to fill slices
+# memory: The number of megabytes used to analyze each slab of the image. If 0 the whole image is loaded at once
+# columnar: "parquet" or "hdf5" to also write the results to a typed columnar file
+# cache: A ResultCache to reuse the cropped volumes and intermediate results of earlier runs on the same data
+# profile: "stages" to write the time and memory of each stage next to the report, or "cprofile" to also write cProfile statistics
+def main(inputImg, inputMask, lower, upper, voxSize, slope, intercept, name, output, workers=1, memory=0, columnar=None, cache=None, profile=None):
+    profile = startProfile(profile)
+    with stage(profile, "read"):
+        if memory > 0:
+            # Only the region around the mask is loaded
+            region = maskRegion(inputMask)
+            # The image is read from disk one slab at a time as it is analyzed, the mask is still needed whole for thickness
+            imgData = openImg(inputImg, region)
+            (_, maskData) = readMask(inputMask, region)
+        else:
+            # Only the region around the mask is loaded, or reused if the same files were read before
+            key = fileKey(inputImg, inputMask) if cache is not None else None
+            (imgData, maskData) = cached(cache if key else None, key and cacheKey("region", key), readRegion, inputImg, inputMask)
+    analyze(imgData, maskData, lower, upper, voxSize, slope, intercept, name, output, workers, memory, columnar, cache, profile)
+
+
+# Reads the region of the image and mask around the mask
+def readRegion(inputImg, inputMask):
+    region = maskRegion(inputMask)
+    imgData = readImg(inputImg, region)
+    (_, maskData) = readMask(inputMask, region)
+    return imgData, maskData
+
+
+# Runs the analysis on arrays that are already loaded, so the Slicer module can call it without writing files
+# imgData: The image array, oriented as returned by readImg
+# maskData: A binary array of the mask, the same shape as imgData
+def analyze(imgData, maskData, lower, upper, voxSize, slope, intercept, name, output, workers=1, memory=0, columnar=None, cache=None, profile=None):
+    profile = startProfile(profile)
+    results = analyzeCortical(imgData, maskData, lower, upper, voxSize, slope, intercept, workers, memory, cache, profile, progress=printProgress)
+
+    # The slices are written first, since resuming a batch skips the specimens already in cortical.txt
+    slicePath = os.path.join(output, "corticalSlices.txt")
+    header = [field[0] for field in SLICE_FIELDS]
+    data = [
+        date.today(),
+        name,
+        results.sliceArea,
+        results.slicePolar,
+        results.sliceIMax,
+        results.sliceIMin,
+        results.sliceAngle,
+        results.sliceZMax,
+        results.sliceZMin
+    ]
+    with stage(profile, "sliceReport"):
+        writeReport(slicePath, header, data, columnar)
 
     fPath = os.path.join(output, "cortical.txt")
 
@@ -112,25 +113,38 @@ def main(inputImg, inputMask, lower, upper, voxSize, slope, intercept, name, out
     data = [
         date.today(),
         name,
-        thickness,
-        thicknessStd,
-        tmd,
-        porosity,
-        totalArea,
-        boneArea,
-        medullarArea,
-        pMOI,
-        voxSize
+        results.thickness,
+        results.thicknessStd,
+        results.tmd,
+        results.porosity,
+        results.totalArea,
+        results.boneArea,
+        results.medullaryArea,
+        results.pMOI,
+        results.voxSize
     ]
 
-    writeReport(fPath, header, data)
+    with stage(profile, "report"):
+        writeReport(fPath, header, data, columnar)
+
+    if profile is not None:
+        profile.write(output, name, fPath)
+
 
 
+# Prints the fraction of the analysis that is done, in the format Slicer reads from the output of a CLI module
+def printProgress(fraction):
+    print("""<filter-progress>{}</filter-progress>""".format(fraction))
+    sys.stdout.flush()
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 10:
         print(sys.argv)
-        print("Usage: CorticalAnalysis <input> <mask> <lowerThreshold> <upperThreshold> <voxelSize> <slope> <intercept> <name> <output>")
+        print("Usage: CorticalAnalysis <input> <mask> <lowerThreshold> <upperThreshold> <voxelSize> <slope> <intercept> <name> <output> [workers] [memory] [profile]")
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]), float(sys.argv[6]), float(sys.argv[7]), str(sys.argv[8]), str(sys.argv[9]))
+    # This process only runs the analysis, so each stage can start a new peak memory
+    from MusculoskeletalAnalysisCLITools import profiling
+    profiling.RESET_PEAK = True
+    main(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]), float(sys.argv[6]), float(sys.argv[7]), str(sys.argv[8]), str(sys.argv[9]), int(sys.argv[10]) if len(sys.argv) > 10 else 1, int(sys.argv[11]) if len(sys.argv) > 11 else 0, profile=sys.argv[12] if len(sys.argv) > 12 else None)
 
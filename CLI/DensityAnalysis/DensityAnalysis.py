@@ -4,14 +4,16 @@ import sys
 import os
 from datetime import date
 
-import numpy as np
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from MusculoskeletalAnalysisCLITools import (
-  crop,
-  densityMap,
+  analyzeDensity,
+  mapMask,
+  maskRegion,
+  openImg,
   readImg,
   readMask,
+  stage,
+  startProfile,
   writeReport,
 )
 
@@ -41,47 +43,30 @@ OUTPUT_FIELDS = [
 # voxSize: The physical side length of the voxels, in mm
 # slope, intercept and scale: parameters of the equation for converting image values to mgHA/ccm
 # output: The name of the output directory
-def main(inputImg, inputMask, voxSize, slope, intercept, name, output):
-    imgData = readImg(inputImg)
-    (_, maskData) = readMask(inputMask)
-    (maskData, imgData) = crop(maskData, imgData)
-    if np.count_nonzero(maskData) == 0:
-         raise Exception("Segmentation mask is empty.")
-    density = densityMap(imgData, slope, intercept)
-
-    c = density.shape[2]
-    area = np.zeros(c);
-    meanDens = np.zeros(c);
-    stdDens = np.zeros(c);
-    minDens = np.zeros(c);
-    maxDens = np.zeros(c);
-    print("""<filter-progress>{}</filter-progress>""".format(.25))
-    sys.stdout.flush()
-    # Get stats for each slice
-    for sliceNum in range(c):
-        sliceDensity = density[:,:,sliceNum]
-        maskDensity = sliceDensity[maskData[:,:,sliceNum]]
-        area[sliceNum] = len(maskDensity) * voxSize**2
-        if(area[sliceNum] != 0):
-            meanDens[sliceNum] = np.mean(maskDensity)
-            stdDens[sliceNum] = np.std(maskDensity)
-            minDens[sliceNum] = np.min(maskDensity)
-            maxDens[sliceNum] = np.max(maskDensity)
-    print("""<filter-progress>{}</filter-progress>""".format(.50))
-    sys.stdout.flush()
-    # Get average area of all slices
-    meanArea = np.mean(area)
-    stdArea =  np.std(area)
-    minArea = np.min(area)
-    maxArea = np.max(area)
-    print("""<filter-progress>{}</filter-progress>""".format(.75))
-    sys.stdout.flush()
-    # Get average density of entire bone
-    fullDensity = density[maskData]
-    meanDensity = np.mean(fullDensity)
-    stdDensity = np.std(fullDensity)
-    minDensity = np.min(fullDensity)
-    maxDensity = np.max(fullDensity)
+# memory: The number of megabytes used to analyze each slab of the volume. If 0 the whole volume is loaded at once
+# columnar: "parquet" or "hdf5" to also write the results to a typed columnar file
+# profile: "stages" to write the time and memory of each stage next to the report, or "cprofile" to also write cProfile statistics
+def main(inputImg, inputMask, voxSize, slope, intercept, name, output, memory=0, columnar=None, profile=None):
+    profile = startProfile(profile)
+    with stage(profile, "read"):
+        # Only the region around the mask is loaded
+        region = maskRegion(inputMask)
+        if memory > 0:
+            # The volumes are read from disk one slab at a time as they are analyzed
+            imgData = openImg(inputImg, region)
+            maskData = mapMask(inputMask)[region]
+        else:
+            imgData = readImg(inputImg, region)
+            (_, maskData) = readMask(inputMask, region)
+    analyze(imgData, maskData, voxSize, slope, intercept, name, output, memory, columnar, profile)
+
+
+# Runs the analysis on arrays that are already loaded, so the Slicer module can call it without writing files
+# imgData: The image array, oriented as returned by readImg
+# maskData: A binary array of the mask, the same shape as imgData
+def analyze(imgData, maskData, voxSize, slope, intercept, name, output, memory=0, columnar=None, profile=None):
+    profile = startProfile(profile)
+    results = analyzeDensity(imgData, maskData, voxSize, slope, intercept, memory, profile, progress=printProgress)
 
     fPath = os.path.join(output, "density.txt")
 
@@ -90,27 +75,40 @@ def main(inputImg, inputMask, voxSize, slope, intercept, name, output):
     data = [
         date.today(),
         name,
-        area,
-        meanDens,
-        stdDens,
-        minDens,
-        maxDens,
-        meanArea,
-        stdArea,
-        minArea,
-        maxArea,
-        meanDensity,
-        stdDensity,
-        minDensity,
-        maxDensity
+        results.sliceArea,
+        results.sliceMeanDensity,
+        results.sliceStdDensity,
+        results.sliceMinDensity,
+        results.sliceMaxDensity,
+        results.meanArea,
+        results.stdArea,
+        results.minArea,
+        results.maxArea,
+        results.meanDensity,
+        results.stdDensity,
+        results.minDensity,
+        results.maxDensity
     ]
-    writeReport(fPath, header, data)
+    with stage(profile, "report"):
+        writeReport(fPath, header, data, columnar)
+
+    if profile is not None:
+        profile.write(output, name, fPath)
+
 
 
+# Prints the fraction of the analysis that is done, in the format Slicer reads from the output of a CLI module
+def printProgress(fraction):
+    print("""<filter-progress>{}</filter-progress>""".format(fraction))
+    sys.stdout.flush()
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 8:
         print(sys.argv)
-        print("Usage: CancellousAnalysis <input> <mask> <voxelSize> <slope> <intercept> <name> <output>")
+        print("Usage: CancellousAnalysis <input> <mask> <voxelSize> <slope> <intercept> <name> <output> [memory] [profile]")
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]), str(sys.argv[6]), str(sys.argv[7]))
+    # This process only runs the analysis, so each stage can start a new peak memory
+    from MusculoskeletalAnalysisCLITools import profiling
+    profiling.RESET_PEAK = True
+    main(sys.argv[1], sys.argv[2], float(sys.argv[3]), float(sys.argv[4]), float(sys.argv[5]), str(sys.argv[6]), str(sys.argv[7]), int(sys.argv[8]) if len(sys.argv) > 8 else 0, profile=sys.argv[9] if len(sys.argv) > 9 else None)
@@ -4,14 +4,14 @@ import sys
 import os
 from datetime import date
 
-import numpy as np
-
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from MusculoskeletalAnalysisCLITools import (
-   crop,
+   analyzeIntervertebral,
+   maskRegion,
    readImg,
    readMask,
-   width,
+   stage,
+   startProfile,
    writeReport,
 )
 
@@ -30,63 +30,62 @@ OUTPUT_FIELDS = [
 ]
 
 
-def main(inputImg, inputMask1, inputMask2, voxSize, name, output):
-    imgData = readImg(inputImg)
-    (_, maskData1) = readMask(inputMask1)
-    (_, maskData2) = readMask(inputMask2)
-    # Set the np mask to the smaller one
-    if np.count_nonzero(maskData1) > np.count_nonzero(maskData2):
-        (maskData, npData, imgData) = crop(maskData1, maskData2, imgData)
-    else:
-        (maskData, npData, imgData) = crop(maskData2, maskData1, imgData)
-    (maskData, npData, imgData) = crop(maskData, npData, imgData)
-    if np.count_nonzero(maskData) == 0 or np.count_nonzero(npData) == 0:
-         raise Exception("Segmentation mask is empty.")
-
-    volume = np.count_nonzero(maskData) * voxSize**3
-    npVolume = np.count_nonzero(npData) * voxSize**3
-    vr = npVolume/volume
-
-    print("""<filter-progress>{}</filter-progress>""".format(.33))
-    sys.stdout.flush()
-
-    afWidth= width(maskData) * voxSize
-    npWidth = width(npData) * voxSize
+# workers: The number of threads used to measure the width of the slices
+# profile: "stages" to write the time and memory of each stage next to the report, or "cprofile" to also write cProfile statistics
+def main(inputImg, inputMask1, inputMask2, voxSize, name, output, workers=1, columnar=None, profile=None):
+    profile = startProfile(profile)
+    with stage(profile, "read"):
+        # Only the region around both masks is loaded
+        region = maskRegion(inputMask1, inputMask2)
+        imgData = readImg(inputImg, region)
+        (_, maskData1) = readMask(inputMask1, region)
+        (_, maskData2) = readMask(inputMask2, region)
+    analyze(imgData, maskData1, maskData2, voxSize, name, output, workers, columnar, profile)
 
-    # Find the center
-    xcent = int(np.rint(np.mean(np.nonzero(maskData)[0])))
-    ycent = int(np.rint(np.mean(np.nonzero(maskData[1]))))
-    center = np.nonzero(maskData[xcent,ycent,:])
-    height = (np.max(center)-np.min(center)) * voxSize
 
-    hw = height/afWidth
-
-    print("""<filter-progress>{}</filter-progress>""".format(.66))
-    sys.stdout.flush()
+# Runs the analysis on arrays that are already loaded, so the Slicer module can call it without writing files
+# imgData: The image array, oriented as returned by readImg
+# maskData1, maskData2: Binary arrays of the disc and nucleus pulposus masks, the same shape as imgData
+def analyze(imgData, maskData1, maskData2, voxSize, name, output, workers=1, columnar=None, profile=None):
+    profile = startProfile(profile)
+    results = analyzeIntervertebral(imgData, maskData1, maskData2, voxSize, workers, profile, progress=printProgress)
 
     fPath = os.path.join(output, "intervertebral.txt")
     header = [field[0] for field in OUTPUT_FIELDS]
     data = [
         date.today(),
         name,
-        volume,
-        npVolume,
-        vr,
-        afWidth,
-        npWidth,
-        height,
-        hw,
-        voxSize
+        results.volume,
+        results.npVolume,
+        results.vr,
+        results.afWidth,
+        results.npWidth,
+        results.height,
+        results.hw,
+        results.voxSize
     ]
 
-    writeReport(fPath, header, data)
+    with stage(profile, "report"):
+        writeReport(fPath, header, data, columnar)
 
+    if profile is not None:
+        profile.write(output, name, fPath)
+
+
+
+# Prints the fraction of the analysis that is done, in the format Slicer reads from the output of a CLI module
+def printProgress(fraction):
+    print("""<filter-progress>{}</filter-progress>""".format(fraction))
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
     if len(sys.argv) < 7:
         print(sys.argv)
-        print("Usage: Intervertebral Analysis <input> <mask1> <mask2> <voxelSize> <name> <output>")
+        print("Usage: Intervertebral Analysis <input> <mask1> <mask2> <voxelSize> <name> <output> [profile] [workers]")
         sys.exit(1)
-    main(sys.argv[1], sys.argv[2], sys.argv[3], float(sys.argv[4]), str(sys.argv[5]), str(sys.argv[6]))
+    # This process only runs the analysis, so each stage can start a new peak memory
+    from MusculoskeletalAnalysisCLITools import profiling
+    profiling.RESET_PEAK = True
+    main(sys.argv[1], sys.argv[2], sys.argv[3], float(sys.argv[4]), str(sys.argv[5]), str(sys.argv[6]), int(sys.argv[8]) if len(sys.argv) > 8 else 1, profile=sys.argv[7] if len(sys.argv) > 7 else None)
 
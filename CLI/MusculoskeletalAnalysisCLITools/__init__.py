@@ -1,25 +1,115 @@
+from .analysis import CancellousResults
+from .analysis import CorticalResults
+from .analysis import DensityResults
+from .analysis import IntervertebralResults
+from .analysis import analyzeCancellous
+from .analysis import analyzeCortical
+from .analysis import analyzeDensity
+from .analysis import analyzeIntervertebral
+from .cache import ResultCache
+from .cache import cacheKey
+from .cache import cached
+from .cache import fileKey
+from .connectivity import connectivityDensity
+from .connectivity import connectivityMap
 from .crop import crop
+from .distance import phaseDistance
+from .distance import signedDistance
+from .distance import squaredDistance
 from .density import densityMap
+from .density import densityStats
+from .density import meanDensity
+from .density import poolStats
+from .euler import eulerMap
+from .euler import eulerNumber
 from .fill import fill
+from .fill import fillSlices
 from .largestCC import largestCC
+from .moments import areaMoments
+from .moments import principalMoments
+from .moments import sectionModulus
+from .profiling import StageProfile
+from .profiling import stage
+from .profiling import startProfile
+from .reader import mapMask
+from .reader import maskRegion
 from .reader import readImg
 from .reader import readMask
+from .scheduler import runStages
 from .shape import bWshape
+from .shape import maskedMeshMetrics
+from .shape import meshMetrics
+from .shape import surfaceDerivative
+from .shape import surfaceSums
 from .shape import updateVertices
+from .shape import voxelSMI
+from .stream import openImg
+from .stream import slabs
+from .thickness import distanceSpheres
 from .thickness import findSpheres
+from .thickness import phaseThicknessStats
+from .thickness import slabSpheres
+from .thickness import thicknessStats
+from .width import sliceWidths
 from .width import width
+from .writeReport import ReportSink
 from .writeReport import writeReport
 
 __all__ = [
+    "CancellousResults",
+    "CorticalResults",
+    "DensityResults",
+    "IntervertebralResults",
+    "analyzeCancellous",
+    "analyzeCortical",
+    "analyzeDensity",
+    "analyzeIntervertebral",
+    "ResultCache",
+    "cacheKey",
+    "cached",
+    "fileKey",
+    "connectivityDensity",
+    "connectivityMap",
     "crop",
+    "phaseDistance",
+    "signedDistance",
+    "squaredDistance",
     "densityMap",
+    "densityStats",
+    "meanDensity",
+    "poolStats",
+    "eulerMap",
+    "eulerNumber",
     "fill",
+    "fillSlices",
     "largestCC",
+    "areaMoments",
+    "principalMoments",
+    "sectionModulus",
+    "StageProfile",
+    "stage",
+    "startProfile",
+    "mapMask",
+    "maskRegion",
     "readImg",
     "readMask",
+    "runStages",
     "bWshape",
+    "maskedMeshMetrics",
+    "meshMetrics",
+    "surfaceDerivative",
+    "surfaceSums",
     "updateVertices",
+    "voxelSMI",
+    "openImg",
+    "slabs",
+    "distanceSpheres",
     "findSpheres",
+    "phaseThicknessStats",
+    "slabSpheres",
+    "thicknessStats",
+    "sliceWidths",
     "width",
+    "ReportSink",
     "writeReport",
 ]
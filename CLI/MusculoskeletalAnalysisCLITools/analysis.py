@@ -0,0 +1,473 @@
+"""Runs each analysis on arrays in memory and returns its results, without reading or writing files.
+
+These functions do not need Slicer, so they can be used from any Python program. The CLI modules read the volumes,
+call them, and write their results to the report.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+
+@dataclass
+class CorticalResults:
+    """The results of analyzing cortical bone. Lengths are in mm, and areas are averaged over the slices.
+
+    The slice arrays have one value for each slice along the last axis of the cropped volume.
+    """
+
+    thickness: float
+    thicknessStd: float
+    tmd: float
+    porosity: float
+    totalArea: float
+    boneArea: float
+    medullaryArea: float
+    pMOI: float
+    voxSize: float
+    sliceArea: Any = field(repr=False)
+    slicePolar: Any = field(repr=False)
+    sliceIMax: Any = field(repr=False)
+    sliceIMin: Any = field(repr=False)
+    sliceAngle: Any = field(repr=False)
+    sliceZMax: Any = field(repr=False)
+    sliceZMin: Any = field(repr=False)
+
+
+@dataclass
+class CancellousResults:
+    """The results of analyzing cancellous bone. Lengths are in mm.
+
+    connectivityMap: The connectivity density of each block of the cropped volume, if a map was made.
+    """
+
+    totalVolume: float
+    boneVolume: float
+    bvtv: float
+    thickness: float
+    thicknessStd: float
+    spacing: float
+    spacingStd: float
+    trabecularNum: float
+    smi: float
+    connD: float
+    tmd: float
+    voxSize: float
+    lower: float
+    upper: float
+    connectivityMap: Optional[Any] = field(default=None, repr=False)
+
+
+@dataclass
+class DensityResults:
+    """The results of analyzing density. Areas are in mm^2 and densities in mgHA/cm^3.
+
+    The slice arrays have one value for each slice along the last axis of the cropped volume.
+    """
+
+    meanArea: float
+    stdArea: float
+    minArea: float
+    maxArea: float
+    meanDensity: float
+    stdDensity: float
+    minDensity: float
+    maxDensity: float
+    sliceArea: Any = field(repr=False)
+    sliceMeanDensity: Any = field(repr=False)
+    sliceStdDensity: Any = field(repr=False)
+    sliceMinDensity: Any = field(repr=False)
+    sliceMaxDensity: Any = field(repr=False)
+
+
+@dataclass
+class IntervertebralResults:
+    """The results of analyzing an intervertebral disc. Lengths are in mm.
+
+    The slice arrays have one value for each slice along the last axis of the cropped volume, and the widest slices
+    are indices into them.
+    """
+
+    volume: float
+    npVolume: float
+    vr: float
+    afWidth: float
+    npWidth: float
+    height: float
+    hw: float
+    voxSize: float
+    afWidestSlice: int
+    npWidestSlice: int
+    sliceAFWidth: Any = field(repr=False)
+    sliceNPWidth: Any = field(repr=False)
+
+
+def analyzeCortical(imgData, maskData, lower, upper, voxSize, slope, intercept, workers=1, memory=0, cache=None, profile=None, progress=None):
+    """Analyzes cortical bone.
+
+    imgData: The image array, oriented as returned by readImg. It may be mapped from disk if memory is above 0.
+    maskData: A binary array of the bone, including its pores, the same shape as imgData
+    lower, upper: The thresholds for bone in the image
+    voxSize: The side length of the voxels, in mm
+    slope, intercept: The equation for converting image values to mgHA/cm^3
+    workers: The number of processes used to calculate thickness, and threads used to fill slices
+    memory: The number of megabytes used to analyze each slab of the image. If 0 the whole image is analyzed at once.
+        The binary mask of the largest component is still loaded whole, but its distance and thickness maps are measured
+        one slab at a time, in this process.
+    cache: A ResultCache to reuse the intermediate results of earlier runs on the same data
+    profile: A StageProfile to record each stage in, or None
+    progress: A function called with the fraction of the analysis that is done as it runs, or None
+    Returns a CorticalResults.
+    """
+    import numpy as np
+
+    from .cache import cacheKey, cached
+    from .crop import crop
+    from .density import densityMap
+    from .fill import fillSlices
+    from .largestCC import largestCC
+    from .moments import areaMoments, principalMoments, sectionModulus
+    from .profiling import stage
+    from .stream import slabs
+    from .thickness import findSpheres
+    from .thickness import slabSpheres
+
+    with stage(profile, "crop", image=imgData, mask=maskData):
+        (maskData, imgData) = crop(maskData, imgData)
+    if np.count_nonzero(maskData) == 0:
+        raise Exception("Segmentation mask is empty.")
+    depth = np.shape(maskData)[2] * voxSize
+
+    boneVolume = np.count_nonzero(maskData) * voxSize**3
+    # Fill in hole to find medullary cavity
+    if progress is not None:
+        progress(.20)
+    # Only the filled area is needed, so each slab of filled slices is counted without keeping it
+    filledVoxels = 0
+    with stage(profile, "fill", mask=maskData):
+        for s in slabs(maskData.shape, memory, 1):
+            filledVoxels += np.count_nonzero(fillSlices(maskData[:,:,s], 5, workers))
+    # Calculate volumes and average area
+    totalVolume = filledVoxels * voxSize**3
+    medullarVolume = totalVolume-boneVolume
+    boneArea = boneVolume/depth
+    totalArea = totalVolume/depth
+    medullarArea = medullarVolume/depth
+    if progress is not None:
+        progress(.40)
+    # PMOI
+    # For each slice, calculate the second moment of area around the x-axis and y-axis
+    # I = area*(distance from center)^2
+    # PMOI = average of Ix+Iy
+    # The moments of every slice are found at once, in voxel units
+    with stage(profile, "moments", mask=maskData):
+        (area, xCenter, yCenter, xx, yy, xy) = areaMoments(maskData)
+        # Convert from voxel units^4 to mm^4 and find the average of the sum
+        polar = (xx + yy)*voxSize**4
+        pMOI = np.mean(polar)
+        # Find the principal moments and section modulus of each slice
+        (iMax, iMin, angle) = principalMoments(xx, yy, xy)
+        (zMax, zMin) = sectionModulus(maskData, xCenter, yCenter, angle, iMax, iMin)
+    # Porosity and density only need one slab of the image at a time
+    porousVoxels = 0
+    densitySum = 0
+    with stage(profile, "density", image=imgData, mask=maskData):
+        for s in slabs(imgData.shape, memory, imgData.itemsize):
+            imgSlab = np.asarray(imgData[:,:,s])
+            maskSlab = maskData[:,:,s]
+            # Count the part of the mask that is in the threshold
+            porousVoxels += np.count_nonzero((imgSlab > lower) & (imgSlab <= upper) & maskSlab)
+            # Density calculations are based on DICOM metadata
+            densitySum += np.sum(densityMap(imgSlab[maskSlab], slope, intercept), dtype=np.float64)
+    # Porosity
+    # Finds the percentage of the mask that is not in the threshold
+    porosity = 1 - (porousVoxels/np.count_nonzero(maskData))
+    if progress is not None:
+        progress(.60)
+    # Thickness
+    # Cached results are found by the contents of the mask, the largest component is not needed if the thickness map is cached
+    componentKey = cacheKey("largestCC", cacheKey(maskData)) if cache is not None else None
+    # Remove disconnected areas and convert to thickness map
+    with stage(profile, "thickness", mask=maskData):
+        # Under a memory limit the thickness is measured in slabs, which gives the same values as the whole mask
+        def measure():
+            component = cached(cache, componentKey, largestCC, maskData)
+            return slabSpheres(component, memory) if memory > 0 else findSpheres(component, workers=workers)
+        rads = cached(cache, cache and cacheKey("thickness", componentKey), measure)
+    # Find nonzero values, double to convert to diameters, and find average
+    rads = rads[np.nonzero(rads)]
+    diams = rads * 2 * voxSize
+    thickness = np.mean(diams)
+    thicknessStd = np.std(diams)
+    if progress is not None:
+        progress(.80)
+    # Calculate Density
+    tmd = densitySum/np.count_nonzero(maskData)
+
+    return CorticalResults(
+        thickness=thickness,
+        thicknessStd=thicknessStd,
+        tmd=tmd,
+        porosity=porosity,
+        totalArea=totalArea,
+        boneArea=boneArea,
+        medullaryArea=medullarArea,
+        pMOI=pMOI,
+        voxSize=voxSize,
+        sliceArea=area*voxSize**2,
+        slicePolar=polar,
+        sliceIMax=iMax*voxSize**4,
+        sliceIMin=iMin*voxSize**4,
+        sliceAngle=np.degrees(angle),
+        sliceZMax=zMax*voxSize**3,
+        sliceZMin=zMin*voxSize**3,
+    )
+
+
+def analyzeCancellous(imgData, maskData, lower, upper, voxSize, slope, intercept, workers=1, cache=None, mapBlock=0, smi="mesh", maskedMesh=False, profile=None, progress=None):
+    """Analyzes cancellous bone.
+
+    imgData: The image array, oriented as returned by readImg
+    maskData: A binary array of the region of cancellous bone, the same shape as imgData
+    lower, upper: The thresholds for bone in the image
+    voxSize: The side length of the voxels, in mm
+    slope, intercept: The equation for converting image values to mgHA/cm^3
+    workers: The number of processes used to run the analysis stages
+    cache: A ResultCache to reuse the intermediate results of earlier runs on the same data
+    mapBlock: If above 0, also finds the connectivity density of blocks of this many voxels on each side
+    smi: "mesh" to find the SMI from the marching cubes mesh, or "voxel" to find it from the voxels
+    maskedMesh: Find bone volume and SMI only from the bone inside the mask
+    profile: A StageProfile to record each stage in, or None
+    progress: A function called with the fraction of the analysis that is done as it runs, or None
+    Returns a CancellousResults.
+    """
+    import numpy as np
+
+    from .cache import cacheKey, cachedValue
+    from .connectivity import connectivityDensity, connectivityMap
+    from .crop import crop
+    from .density import meanDensity
+    from .distance import signedDistance
+    from .dtypes import distanceDtype
+    from .profiling import stage
+    from .scheduler import runStages
+    from .shape import maskedMeshMetrics, meshMetrics, voxelSMI
+    from .shared import releaseShared, sharedArray
+    from .thickness import phaseThicknessStats, sphereStats
+
+    with stage(profile, "crop", image=imgData, mask=maskData):
+        (maskData, imgData) = crop(maskData, imgData)
+    if np.count_nonzero(maskData) == 0:
+        raise Exception("Segmentation mask is empty.")
+    # With several workers the arrays made here are made in shared memory, so the stages read them without a copy
+    blocks = []
+    def newArray(shape, dtype):
+        if workers == 1:
+            return np.empty(shape, dtype=dtype)
+        (shm, array) = sharedArray(shape, dtype)
+        blocks.append(shm)
+        return array
+    try:
+        with stage(profile, "threshold", image=imgData, mask=maskData):
+            trabecular = newArray(imgData.shape, bool)
+            np.greater(imgData, lower, out=trabecular)
+            trabecular &= imgData <= upper
+            background = np.bitwise_and(maskData, np.invert(trabecular))
+        # Find volume of entire mask by counting voxels
+        totalVolume = np.count_nonzero(maskData) * voxSize**3
+        # Cached intermediate results are found by the contents of the array they are computed from
+        (imgKey, trabecularKey, backgroundKey) = (cacheKey(imgData), cacheKey(trabecular), cacheKey(background)) if cache is not None else (None, None, None)
+        # Cached thickness maps are read before any stage runs, so the entries the stages store can not evict them
+        cachedRads = {"thickness": cachedValue(cache, cache and cacheKey("thickness", trabecularKey)),
+                      "spacing": cachedValue(cache, cache and cacheKey("thickness", backgroundKey))}
+        # The metrics are independent of each other, so they can run in separate processes
+        # Thickness, spacing and the masked mesh start their own processes, so they share the workers the other stages
+        # do not use, and the analysis uses no more than workers processes at once
+        missing = [name for name, rads in cachedRads.items() if rads is None]
+        nested = len(missing) + maskedMesh
+        plain = (not maskedMesh) + 2 + (mapBlock > 0) + (smi == "voxel")
+        share = max(1, (workers - plain) // nested) if nested else 1
+        stages = [
+            ("mesh", meshMetrics, ("image",), (lower, voxSize, cache, imgKey), ()),
+            ("thickness", phaseThicknessStats, ("distance",), (1, voxSize, share, cache, trabecularKey), ()),
+            ("spacing", phaseThicknessStats, ("distance",), (-1, voxSize, share, cache, backgroundKey), ()),
+            ("connectivity", connectivityDensity, ("trabecular",), (totalVolume, cache, trabecularKey), ()),
+            ("tmd", meanDensity, ("image", "trabecular"), (slope, intercept), ()),
+        ]
+        stages = [s for s in stages if s[0] not in cachedRads or s[0] in missing]
+        arrays = {"image": imgData, "trabecular": trabecular}
+        if missing:
+            # Thickness and spacing share one field of the squared distances of both phases
+            # A phase whose thickness map is cached does not need its distance transform
+            with stage(profile, "distance", trabecular=trabecular, background=background):
+                arrays["distance"] = signedDistance(trabecular if "thickness" in missing else None, background if "spacing" in missing else None,
+                                                    newArray((2,) + trabecular.shape, distanceDtype(trabecular.shape)))
+        del background
+        if maskedMesh:
+            meshKey = cacheKey(imgKey, cacheKey(maskData)) if cache is not None else None
+            stages[0] = ("mesh", maskedMeshMetrics, ("image", "mask"), (lower, voxSize, cache, meshKey, share), ())
+            arrays["mask"] = maskData
+        if mapBlock > 0:
+            stages.append(("connectivityMap", connectivityMap, ("trabecular", "mask"), (voxSize, mapBlock, cache, trabecularKey), ()))
+            arrays["mask"] = maskData
+        if smi == "voxel":
+            stages.append(("voxelSMI", voxelSMI, ("trabecular",), (voxSize,), ()))
+        # The stages are the first 80% of the analysis
+        results = runStages(stages, arrays, workers, (lambda done: progress(.8*done)) if progress is not None else None, profile)
+    finally:
+        # The shared arrays must not be used after they are released
+        trabecular = arrays = None
+        releaseShared(*blocks)
+    for (name, rads) in cachedRads.items():
+        if rads is not None:
+            results[name] = sphereStats(rads, voxSize)
+    # Bone volume and SMI come from the marching cubes mesh
+    (boneVolume, SMI) = results["mesh"]
+    if smi == "voxel":
+        SMI = results["voxelSMI"]
+    # Thickness of the bone and of the background
+    (thickness, thicknessStd) = results["thickness"]
+    (spacing, spacingStd) = results["spacing"]
+
+    return CancellousResults(
+        totalVolume=totalVolume,
+        boneVolume=boneVolume,
+        bvtv=boneVolume/totalVolume,
+        thickness=thickness,
+        thicknessStd=thicknessStd,
+        spacing=spacing,
+        spacingStd=spacingStd,
+        trabecularNum=1/spacing,
+        smi=SMI,
+        connD=results["connectivity"],
+        tmd=results["tmd"],
+        voxSize=voxSize,
+        lower=lower,
+        upper=upper,
+        connectivityMap=results.get("connectivityMap"),
+    )
+
+
+def analyzeDensity(imgData, maskData, voxSize, slope, intercept, memory=0, profile=None, progress=None):
+    """Finds the area and density of a segment in each slice, and of the whole segment.
+
+    imgData: The image array, oriented as returned by readImg. It may be mapped from disk if memory is above 0.
+    maskData: A binary array of the segment, the same shape as imgData
+    voxSize: The side length of the voxels, in mm
+    slope, intercept: The equation for converting image values to mgHA/cm^3
+    memory: The number of megabytes used to analyze each slab of the volume. If 0 the whole volume is analyzed at once
+    profile: A StageProfile to record each stage in, or None
+    progress: A function called with the fraction of the analysis that is done as it runs, or None
+    Returns a DensityResults.
+    """
+    import numpy as np
+
+    from .crop import crop
+    from .density import densityStats, poolStats
+    from .profiling import stage
+    from .stream import slabs
+
+    with stage(profile, "crop", image=imgData, mask=maskData):
+        (maskData, imgData) = crop(maskData, imgData)
+    if np.count_nonzero(maskData) == 0:
+        raise Exception("Segmentation mask is empty.")
+    if progress is not None:
+        progress(.25)
+    # Get stats for each slice in one pass over the masked voxels of each slab
+    with stage(profile, "density", image=imgData, mask=maskData):
+        stats = [densityStats(np.asarray(imgData[:,:,s]), np.asarray(maskData[:,:,s]) != 0, slope, intercept) for s in slabs(imgData.shape, memory, imgData.itemsize)]
+    (counts, meanDens, stdDens, minDens, maxDens) = [np.concatenate(a) for a in zip(*stats)]
+    area = counts * voxSize**2
+    if progress is not None:
+        progress(.50)
+    # Get average area of all slices
+    meanArea = np.mean(area)
+    stdArea =  np.std(area)
+    minArea = np.min(area)
+    maxArea = np.max(area)
+    if progress is not None:
+        progress(.75)
+    # Get average density of entire bone from the slices
+    (meanDensity, stdDensity, minDensity, maxDensity) = poolStats(counts, meanDens, stdDens, minDens, maxDens)
+
+    return DensityResults(
+        meanArea=meanArea,
+        stdArea=stdArea,
+        minArea=minArea,
+        maxArea=maxArea,
+        meanDensity=meanDensity,
+        stdDensity=stdDensity,
+        minDensity=minDensity,
+        maxDensity=maxDensity,
+        sliceArea=area,
+        sliceMeanDensity=meanDens,
+        sliceStdDensity=stdDens,
+        sliceMinDensity=minDens,
+        sliceMaxDensity=maxDens,
+    )
+
+
+def analyzeIntervertebral(imgData, maskData1, maskData2, voxSize, workers=1, profile=None, progress=None):
+    """Analyzes an intervertebral disc.
+
+    imgData: The image array, oriented as returned by readImg
+    maskData1, maskData2: Binary arrays of the disc and nucleus pulposus, in either order, the same shape as imgData
+    voxSize: The side length of the voxels, in mm
+    workers: The number of threads used to measure the width of the slices
+    profile: A StageProfile to record each stage in, or None
+    progress: A function called with the fraction of the analysis that is done as it runs, or None
+    Returns an IntervertebralResults.
+    """
+    import numpy as np
+
+    from .crop import crop
+    from .profiling import stage
+    from .width import sliceWidths
+
+    with stage(profile, "crop", image=imgData, mask1=maskData1, mask2=maskData2):
+        # Set the np mask to the smaller one
+        if np.count_nonzero(maskData1) > np.count_nonzero(maskData2):
+            (maskData, npData, imgData) = crop(maskData1, maskData2, imgData)
+        else:
+            (maskData, npData, imgData) = crop(maskData2, maskData1, imgData)
+        (maskData, npData, imgData) = crop(maskData, npData, imgData)
+    if np.count_nonzero(maskData) == 0 or np.count_nonzero(npData) == 0:
+        raise Exception("Segmentation mask is empty.")
+
+    volume = np.count_nonzero(maskData) * voxSize**3
+    npVolume = np.count_nonzero(npData) * voxSize**3
+
+    if progress is not None:
+        progress(.33)
+
+    # The width is the largest width of any slice
+    with stage(profile, "width", mask=maskData, nucleus=npData):
+        (afWidths, afWidest) = sliceWidths(maskData, workers)
+        (npWidths, npWidest) = sliceWidths(npData, workers)
+    afWidth = afWidths[afWidest] * voxSize
+    npWidth = npWidths[npWidest] * voxSize
+
+    # Find the center
+    with stage(profile, "height", mask=maskData):
+        xcent = int(np.rint(np.mean(np.nonzero(maskData)[0])))
+        ycent = int(np.rint(np.mean(np.nonzero(maskData[1]))))
+        center = np.nonzero(maskData[xcent,ycent,:])
+        height = (np.max(center)-np.min(center)) * voxSize
+
+    if progress is not None:
+        progress(.66)
+
+    return IntervertebralResults(
+        volume=volume,
+        npVolume=npVolume,
+        vr=npVolume/volume,
+        afWidth=afWidth,
+        npWidth=npWidth,
+        height=height,
+        hw=height/afWidth,
+        voxSize=voxSize,
+        afWidestSlice=afWidest,
+        npWidestSlice=npWidest,
+        sliceAFWidth=afWidths*voxSize,
+        sliceNPWidth=npWidths*voxSize,
+    )
@@ -0,0 +1,292 @@
+"""Runs analyses on a whole cohort of volumes without Slicer.
+
+Usage: python -m MusculoskeletalAnalysisCLITools.batch <manifest> <output> [--jobs N] [--memory-limit MB] [--workers N] [--columnar parquet|hdf5]
+    [--cache DIR] [--cache-size MB]
+
+The manifest is a CSV file with a header row, or a JSON list of objects, with one specimen per row:
+    analysis: cortical, cancellous, density or intervertebral, or the names used by the Slicer module
+    image: The image file
+    mask: A labelmap file of the segment, with the same geometry as the image
+    mask2: The labelmap of the nucleus pulposus, for intervertebral analysis
+    segment, segment2: Optional. The segment name to use from a .seg.nrrd mask, or the label value to use from a
+        labelmap with several labels
+    lower, upper: The bone thresholds, for cortical and cancellous analysis
+    voxelSize: The side length of a voxel in mm
+    slope, intercept: The density calibration, for every analysis except intervertebral
+    name: Optional. The name written to the report, defaults to the image file name. It must be unique for each analysis
+Relative paths are relative to the manifest. Specimens whose name is already in the output report are skipped, so an
+interrupted batch can be resumed by running it again.
+"""
+import os
+import sys
+
+# The CLI module and output report of each analysis
+ANALYSES = {
+    "cortical": ("CorticalAnalysis", "cortical.txt"),
+    "cancellous": ("CancellousAnalysis", "cancellous.txt"),
+    "density": ("DensityAnalysis", "density.txt"),
+    "intervertebral": ("IntervertebralAnalysis", "intervertebral.txt"),
+}
+# The names of the analyses in the Slicer module
+ALIASES = {
+    "cortical bone": "cortical",
+    "cancellous bone": "cancellous",
+    "bone density": "density",
+    "intervertebral disc": "intervertebral",
+}
+# Approximate bytes used for each voxel of the image by each analysis, in addition to the image itself
+VOXEL_BYTES = {
+    "cortical": 48,
+    "cancellous": 64,
+    "density": 16,
+    "intervertebral": 24,
+}
+
+
+def runBatch(manifest, output, jobs=1, memoryLimit=None, workers=1, columnar=None, cache=None):
+    """Runs every specimen of a manifest that is not already in the output reports.
+
+    jobs: The number of specimens analyzed at once, each in its own process.
+    memoryLimit: The number of megabytes the running specimens may use together. Specimens wait to start until their
+    estimated memory fits, but one specimen is always allowed to run. Defaults to the available memory.
+    workers: The number of processes each cortical or cancellous analysis uses, and threads each intervertebral analysis uses.
+    columnar: "parquet" or "hdf5" to also write each report as a typed columnar file.
+    cache: A ResultCache that cortical and cancellous analyses use to reuse intermediate results of earlier runs.
+
+    Returns a list of (specimen, error) for the specimens that failed.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from .writeReport import checkColumnar
+
+    # Every specimen would fail after its analysis if the columnar format can not be written
+    checkColumnar(columnar)
+    os.makedirs(output, exist_ok=True)
+    specimens = readManifest(manifest)
+    done = {}
+    pending = []
+    for specimen in specimens:
+        report = ANALYSES[specimen["analysis"]][1]
+        if report not in done:
+            done[report] = reportNames(os.path.join(output, report))
+        if specimen["name"] in done[report]:
+            print("Skipping " + specimen["analysis"] + " " + specimen["name"] + ", already in " + report)
+        else:
+            pending.append(specimen)
+    if memoryLimit is None:
+        memoryLimit = availableMemory()
+    failures = []
+    running = {}
+    with ProcessPoolExecutor(max_workers=max(1, jobs)) as pool:
+        while pending or running:
+            used = sum(running.values())
+            # Start specimens in manifest order while they fit in memory
+            while pending and len(running) < jobs:
+                estimate = estimateMemory(pending[0])
+                if running and memoryLimit and used + estimate > memoryLimit:
+                    break
+                specimen = pending.pop(0)
+                running[pool.submit(runSpecimen, specimen, output, workers, columnar, cache)] = estimate
+                used += estimate
+                print("Started " + specimen["analysis"] + " " + specimen["name"])
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for job in finished:
+                del running[job]
+                name, error = job.result()
+                if error is None:
+                    print("Finished " + name)
+                else:
+                    print("Failed " + name + ": " + error)
+                    failures.append((name, error))
+            sys.stdout.flush()
+    return failures
+
+
+def readManifest(manifest):
+    """Reads the specimens of a CSV or JSON manifest, with paths made absolute and the analysis names normalized.
+
+    Raises ValueError if two specimens of the same analysis have the same name, since only the name is in the report.
+    """
+    import csv
+    import json
+
+    with open(manifest, newline="") as f:
+        if manifest.lower().endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    directory = os.path.dirname(os.path.abspath(manifest))
+    specimens = []
+    # The row of each name in each analysis
+    names = {}
+    for number, row in enumerate(rows, 1):
+        specimen = {k.strip(): v.strip() if isinstance(v, str) else v for k, v in row.items() if k and v not in (None, "")}
+        analysis = str(specimen.get("analysis", "")).lower()
+        analysis = ALIASES.get(analysis, analysis)
+        if analysis not in ANALYSES:
+            raise ValueError("Row " + str(number) + " of the manifest has unknown analysis " + str(specimen.get("analysis")))
+        specimen["analysis"] = analysis
+        for key in ("image", "mask", "mask2"):
+            if key in specimen:
+                specimen[key] = os.path.join(directory, specimen[key])
+        if "name" not in specimen:
+            specimen["name"] = os.path.basename(specimen["image"]).split(".")[0]
+        # Resuming skips specimens by the name in the report, so a second specimen with the same name would never run
+        if (analysis, specimen["name"]) in names:
+            raise ValueError("Rows " + str(names[(analysis, specimen["name"])]) + " and " + str(number) + " of the manifest are both "
+                             + analysis + " analyses named " + str(specimen["name"]) + ", set a different name for each")
+        names[(analysis, specimen["name"])] = number
+        specimens.append(specimen)
+    return specimens
+
+
+def reportNames(report):
+    """Gets the names of the input volumes already written to a report."""
+    names = set()
+    if os.path.exists(report):
+        with open(report) as f:
+            next(f, None)
+            for line in f:
+                columns = line.rstrip("\n").split("\t")
+                # Rows continuing the per slice arrays of a specimen have no name
+                if len(columns) > 1 and columns[1]:
+                    names.add(columns[1])
+    return names
+
+
+def availableMemory():
+    """Finds the number of megabytes of available memory, or 0 if it is unknown."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES") // 2**20
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def estimateMemory(specimen):
+    """Estimates the number of megabytes an analysis uses from the size of its image."""
+    import numpy as np
+    import SimpleITK as sitk
+
+    imgReader = sitk.ImageFileReader()
+    imgReader.SetFileName(specimen["image"])
+    try:
+        imgReader.ReadImageInformation()
+    except RuntimeError:
+        return 0
+    # A one voxel image gives the size of the pixel type
+    itemsize = sitk.GetArrayViewFromImage(sitk.Image([1]*imgReader.GetDimension(), imgReader.GetPixelID())).itemsize
+    voxels = int(np.prod(imgReader.GetSize()))
+    return voxels * (itemsize + VOXEL_BYTES[specimen["analysis"]]) // 2**20
+
+
+def runSpecimen(specimen, output, workers, columnar=None, cache=None):
+    """Runs the analysis of one specimen in a worker process. Returns its description and the error message, or None."""
+    import contextlib
+    import io
+    import tempfile
+
+    try:
+        with tempfile.TemporaryDirectory() as temp:
+            masks = [segmentMask(specimen[key], specimen.get(segment), temp)
+                     for key, segment in (("mask", "segment"), ("mask2", "segment2")) if key in specimen]
+            module = importAnalysis(ANALYSES[specimen["analysis"]][0])
+            arguments = analysisArguments(specimen, masks, output, workers)
+            # The progress the CLI prints for Slicer is not needed
+            with contextlib.redirect_stdout(io.StringIO()):
+                if specimen["analysis"] in ("cortical", "cancellous"):
+                    module.main(*arguments, columnar=columnar, cache=cache)
+                else:
+                    module.main(*arguments, columnar=columnar)
+        return specimen["analysis"] + " " + specimen["name"], None
+    except Exception as e:
+        return specimen["analysis"] + " " + specimen["name"], "{}: {}".format(type(e).__name__, e)
+
+
+def analysisArguments(specimen, masks, output, workers):
+    """Gets the arguments of the main function of the specimen's CLI module."""
+    analysis = specimen["analysis"]
+    if analysis in ("cortical", "cancellous"):
+        return (specimen["image"], masks[0], float(specimen["lower"]), float(specimen["upper"]), float(specimen["voxelSize"]),
+                float(specimen["slope"]), float(specimen["intercept"]), specimen["name"], output, workers)
+    elif analysis == "density":
+        return (specimen["image"], masks[0], float(specimen["voxelSize"]), float(specimen["slope"]), float(specimen["intercept"]),
+                specimen["name"], output)
+    else:
+        return (specimen["image"], masks[0], masks[1], float(specimen["voxelSize"]), specimen["name"], output, workers)
+
+
+def segmentMask(mask, segment, temp):
+    """Gets a labelmap file of a single segment.
+
+    segment: A segment name in a .seg.nrrd file, or a label value in a labelmap. If None the mask is used as it is.
+    Selected segments are written to a new labelmap in the temp directory.
+    """
+    import numpy as np
+    import nrrd
+
+    if segment is None:
+        return mask
+    header = nrrd.read_header(mask)
+    layer = 0
+    label = None
+    index = 0
+    while "Segment{}_ID".format(index) in header:
+        if segment in (header.get("Segment{}_Name".format(index)), header["Segment{}_ID".format(index)]):
+            label = int(header["Segment{}_LabelValue".format(index)])
+            layer = int(header.get("Segment{}_Layer".format(index), 0))
+            break
+        index += 1
+    if label is None:
+        try:
+            label = int(segment)
+        except ValueError:
+            raise ValueError("Segment " + segment + " is not in " + mask)
+    data, header = nrrd.read(mask)
+    if data.ndim == 4:
+        # Segmentations with overlapping segments store each layer along the first axis
+        data = data[layer]
+    labelmap = {key: header[key] for key in ("space", "space origin") if key in header}
+    if "space directions" in header:
+        labelmap["space directions"] = header["space directions"][-3:]
+    path = os.path.join(temp, "{}_{}.nrrd".format(os.path.basename(mask).split(".")[0], label))
+    nrrd.write(path, (data == label).astype(np.uint8), labelmap)
+    return path
+
+
+def importAnalysis(moduleName):
+    """Imports the python script of a CLI module, which is next to the tools when installed or in its own directory in the source tree."""
+    import importlib
+
+    parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for directory in (parent, os.path.join(parent, moduleName)):
+        if os.path.exists(os.path.join(directory, moduleName + ".py")):
+            if directory not in sys.path:
+                sys.path.append(directory)
+            return importlib.import_module(moduleName)
+    raise ImportError("Could not find the CLI module " + moduleName)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Runs musculoskeletal analyses on every specimen of a manifest.")
+    parser.add_argument("manifest", help="CSV or JSON file listing the specimens")
+    parser.add_argument("output", help="The directory to write the reports to")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="The number of specimens analyzed at once")
+    parser.add_argument("--memory-limit", type=int, default=None, help="The megabytes the running specimens may use together")
+    parser.add_argument("--workers", type=int, default=1, help="The number of processes each specimen uses for thickness, or threads for intervertebral widths")
+    parser.add_argument("--columnar", choices=["parquet", "hdf5"], default=None, help="Also write each report as a typed columnar file")
+    parser.add_argument("--cache", default=None, help="A directory to keep intermediate results in for later runs")
+    parser.add_argument("--cache-size", type=int, default=None, help="The megabytes the cache directory may use")
+    args = parser.parse_args()
+    from .writeReport import checkColumnar
+    try:
+        checkColumnar(args.columnar)
+    except ImportError as e:
+        parser.error(str(e))
+    cache = None
+    if args.cache is not None:
+        from .cache import DEFAULT_CACHE_BYTES, ResultCache
+        cache = ResultCache(args.cache, DEFAULT_CACHE_BYTES if args.cache_size is None else args.cache_size * 2**20)
+    failures = runBatch(args.manifest, args.output, args.jobs, args.memory_limit, args.workers, args.columnar, cache)
+    if failures:
+        sys.exit(1)
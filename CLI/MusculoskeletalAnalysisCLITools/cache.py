@@ -0,0 +1,179 @@
+"""Stores intermediate results on disk so repeated analyses of the same data can skip recomputing them."""
+
+# Changing this invalidates every entry, for when the way an intermediate result is computed changes
+CACHE_VERSION = 1
+# Default size limit of a cache directory, in bytes
+DEFAULT_CACHE_BYTES = 2**32
+# Number of bytes of a file hashed at once
+HASH_BLOCK = 2**20
+
+
+class ResultCache:
+    """A directory of cached results, limited in size by deleting the least recently used entries.
+
+    Each entry is an uncompressed .npz file named by its key, holding a tuple of arrays. Binary arrays are stored as
+    packed bits unless the dtype policy turns this off. The object only holds the directory and size limit, so it can
+    be passed to worker processes.
+    """
+
+    def __init__(self, directory, maxBytes=DEFAULT_CACHE_BYTES):
+        import os
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    def path(self, key):
+        import os
+
+        return os.path.join(self.directory, key + ".npz")
+
+    def has(self, key):
+        """Checks if a key has an entry, without marking it as used."""
+        import os
+
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        """Gets the arrays stored for a key, or None if there are none."""
+        import os
+        import numpy as np
+
+        path = self.path(key)
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                values = tuple(unpackValue(entry, i) for i in range(len([f for f in entry.files if not f.startswith("shape_")])))
+            # The modification time records when an entry was last used
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # Entries can be evicted by another process while being read
+            return None
+        return values
+
+    def put(self, key, values):
+        """Stores a tuple of arrays for a key, then evicts old entries if the cache is too large."""
+        import os
+        import tempfile
+        import numpy as np
+        from . import dtypes
+
+        arrays = {}
+        for i, value in enumerate(values):
+            value = np.asarray(value)
+            if dtypes.PACK_MASKS and value.dtype == bool:
+                arrays["bits_{}".format(i)] = np.packbits(value, axis=None)
+                arrays["shape_{}".format(i)] = np.array(value.shape, dtype=np.int64)
+            else:
+                arrays["arr_{}".format(i)] = value
+        (handle, temp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as f:
+                np.savez(f, **arrays)
+            # Renaming makes the entry appear complete to other processes
+            os.replace(temp, self.path(key))
+        except BaseException:
+            os.remove(temp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Deletes the least recently used entries until the cache fits in its size limit."""
+        import os
+
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def unpackValue(entry, i):
+    """Reads the value at index i of a cache entry, unpacking binary arrays stored as bits."""
+    import numpy as np
+
+    if "bits_{}".format(i) in entry.files:
+        shape = tuple(entry["shape_{}".format(i)])
+        return np.unpackbits(entry["bits_{}".format(i)], count=int(np.prod(shape))).view(bool).reshape(shape)
+    return entry["arr_{}".format(i)]
+
+
+def cached(cache, key, compute, *args, **kwargs):
+    """Gets the result of compute(*args, **kwargs) from the cache, or computes and stores it.
+
+    The result must be an array or a tuple of arrays. If cache is None the result is always computed.
+    """
+    if cache is None:
+        return compute(*args, **kwargs)
+    values = cachedValue(cache, key)
+    if values is not None:
+        return values
+    result = compute(*args, **kwargs)
+    if isinstance(result, tuple):
+        cache.put(key, result)
+    else:
+        cache.put(key, (result, "single"))
+    return result
+
+
+def cachedValue(cache, key):
+    """Gets a result stored by cached, marking it as used, or None if it is not in the cache.
+
+    A result that is read before the stages that need it run can not be evicted by the entries they store.
+    """
+    if cache is None:
+        return None
+    values = cache.get(key)
+    if values is None:
+        return None
+    # Single arrays are stored with a marker so they are returned the same way they were computed
+    return values[0] if len(values) == 2 and values[1].dtype.kind == "U" and values[1] == "single" else values
+
+
+def cacheKey(*parts):
+    """Hashes arrays, numbers and strings into a key.
+
+    Arrays are hashed by their type, shape and contents, so equal data gives the same key however it was loaded.
+    """
+    import hashlib
+    import numpy as np
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr(CACHE_VERSION).encode())
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update("{}{}".format(part.dtype.str, part.shape).encode())
+            # Rows are hashed one at a time so cropped views are not copied whole
+            for row in part if part.ndim > 1 else (part,):
+                digest.update(np.ascontiguousarray(row).data)
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"|")
+    return digest.hexdigest()
+
+
+def fileKey(*paths):
+    """Hashes the contents of files into a key. Returns None if a file is a header whose data is in a separate file."""
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr(CACHE_VERSION).encode())
+    for path in paths:
+        if path.lower().endswith((".nhdr", ".mhd")):
+            return None
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK), b""):
+                digest.update(block)
+        digest.update(b"|")
+    return digest.hexdigest()
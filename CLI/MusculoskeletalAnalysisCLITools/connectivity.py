@@ -0,0 +1,50 @@
+def connectivityDensity(trabecular, totalVolume, cache=None, key=None):
+    """Calculates the number of connections per volume of a bone mask.
+
+    Isolated holes and islands are removed before finding the Euler characteristic.
+    cache and key: A ResultCache and the key of the mask, used to reuse the cleaned mask of an earlier run.
+    """
+    from .cache import cacheKey, cached
+    from .euler import eulerNumber
+
+    trabecular = cached(cache, cache and cacheKey("connected", key), connectedBone, trabecular)
+
+    # Find the euler characteristic
+    # roughly equal to 2-2*number of holes
+    phi = eulerNumber(trabecular, 3)
+    # connD gives an approximate measure of holes/connections per volume
+    return (1-phi)/totalVolume
+
+
+def connectivityMap(trabecular, maskData, voxSize, blockSize, cache=None, key=None):
+    """Maps the connectivity density of a bone mask over blocks of blockSize voxels along each axis.
+
+    The bone is cleaned the same way as for connectivityDensity. Each block has the number of connections it
+    contributes, the negative of its Euler characteristic, per volume of the segmentation in the block, so adding one
+    to the sum of the connections of the blocks gives the connections of the whole volume. Blocks outside the
+    segmentation are NaN.
+    """
+    import numpy as np
+    from .cache import cacheKey, cached
+    from .euler import eulerMap
+
+    trabecular = cached(cache, cache and cacheKey("connected", key), connectedBone, trabecular)
+    euler = eulerMap(trabecular, blockSize, 3)
+    # Volume of the segmentation in each block
+    volume = maskData
+    for axis in range(maskData.ndim):
+        volume = np.add.reduceat(volume, np.arange(0, maskData.shape[axis], blockSize), axis=axis, dtype=np.int64)
+    volume = volume * voxSize**3
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(volume > 0, -euler / volume, np.nan)
+
+
+def connectedBone(trabecular):
+    """Removes the holes that are not connected to the largest background region, and the islands not connected to the largest bone region."""
+    import numpy as np
+    from .largestCC import largestComponent
+
+    # Remove disconected holes and islands
+    trabecular = np.invert(largestComponent(np.invert(trabecular), 1))
+    # Holes use face connectivity, switch to vertex connectivity for islands
+    return largestComponent(trabecular, 3)
@@ -1,23 +1,55 @@
 import numpy as np
 
+# Approximate number of bytes of the template examined at once when finding its bounding box
+SLAB_BYTES = 2**26
+
+
 def crop(*args):
     """Crops a series of ndarrays to the range of nonzero values in the first array for each dimension."""
     template = args[0]
-    # Get the coodinates of all nonzero points in the first input as a tuple of arrays
-    coords = np.nonzero(template)
-    sliceC = ()
-    # For each dimension, get a slice from the smallest to largest values
-    for i, c in enumerate(coords):
-        low = min(c)
-        high = max(c)+1
-        # Leave 1 space between shape and new edge unless the shape was already on the edge
-        if low > 0:
-            low==low-1
-        if high < np.shape(template)[i]:
-            high = high+1
-        sliceC += slice(low , high),
+    bounds = boundingBox(template)
+    if bounds is None:
+        # An empty template has no range to crop to
+        return args
+    sliceC = cropSlices(bounds, np.shape(template))
     croppedArgs = ()
     # For each input, apply the slice and return the results
     for a in args:
         croppedArgs += a[sliceC],
-    return croppedArgs
\ No newline at end of file
+    return croppedArgs
+
+
+def boundingBox(template):
+    """Finds the range of nonzero values in each dimension of a 3D array.
+
+    The array is read in slabs along the last axis, so memory mapped arrays are streamed from disk and no coordinate
+    arrays are created. Returns a list of (low, high) pairs with exclusive high values, or None if every value is zero.
+    """
+    shape = np.shape(template)
+    found = [np.zeros(s, dtype=bool) for s in shape]
+    step = max(1, SLAB_BYTES // max(1, shape[0]*shape[1]*template.dtype.itemsize))
+    for start in range(0, shape[2], step):
+        slab = np.asarray(template[:, :, start:start+step]) != 0
+        found[0] |= np.any(slab, axis=(1, 2))
+        found[1] |= np.any(slab, axis=(0, 2))
+        found[2][start:start+step] = np.any(slab, axis=(0, 1))
+    if not found[2].any():
+        return None
+    bounds = []
+    for f in found:
+        nonzero = np.flatnonzero(f)
+        bounds.append((nonzero[0], nonzero[-1]+1))
+    return bounds
+
+
+def cropSlices(bounds, shape):
+    """Gets the slices used by crop for the bounding box of a template with the given shape."""
+    sliceC = ()
+    # For each dimension, get a slice from the smallest to largest values
+    for (low, high), size in zip(bounds, shape):
+        # Leave 1 space after the shape unless it was already on the edge
+        # The space before the shape is not added, which keeps results consistent with earlier versions
+        if high < size:
+            high = high+1
+        sliceC += slice(int(low), int(high)),
+    return sliceC
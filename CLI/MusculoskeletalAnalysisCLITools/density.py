@@ -4,5 +4,57 @@ def densityMap(img, slope, intercept):
     """Converts an image to a density map the same shape and size.
 
     Uses parameters from DICOM metadata to find linear relationship between pixel value and physical density.
+    The map has the type set by the dtype policy, and is converted in place so no other full size array is made.
     """
-    return img * slope + intercept
+    from .dtypes import densityDtype
+
+    dtype = densityDtype()
+    density = img.astype(dtype)
+    density *= dtype.type(slope)
+    density += dtype.type(intercept)
+    return density
+
+
+def meanDensity(img, mask, slope, intercept):
+    """Finds the mean physical density of the masked area of an image."""
+    import numpy as np
+
+    # Only the masked values are converted
+    return np.mean(densityMap(img[mask], slope, intercept), dtype=np.float64)
+
+
+def densityStats(img, mask, slope, intercept):
+    """Finds the density statistics of the masked area of each slice along the last axis.
+
+    Only the masked values are converted to density, gathered slice by slice so each slice can be reduced at once.
+    Returns the number of masked voxels, mean, standard deviation, min and max density of each slice. Slices without
+    masked voxels have zero for each. The statistics of the volume can be found with poolStats.
+    """
+    import numpy as np
+
+    counts = np.count_nonzero(mask, axis=(0, 1))
+    # Moving the slice axis first puts the values of each slice next to each other
+    density = densityMap(np.moveaxis(img, 2, 0)[np.moveaxis(mask, 2, 0)], slope, intercept)
+    filled = counts > 0
+    n = counts[filled]
+    starts = np.cumsum(n) - n
+    (mean, std, minDens, maxDens) = [np.zeros(len(counts)) for _ in range(4)]
+    if len(n) > 0:
+        mean[filled] = np.add.reduceat(density, starts, dtype=np.float64) / n
+        # The deviations are taken from each slice's mean to keep the precision of the standard deviation
+        std[filled] = np.sqrt(np.add.reduceat((density - np.repeat(mean[filled], n))**2, starts, dtype=np.float64) / n)
+        minDens[filled] = np.minimum.reduceat(density, starts)
+        maxDens[filled] = np.maximum.reduceat(density, starts)
+    return counts, mean, std, minDens, maxDens
+
+
+def poolStats(counts, mean, std, minDens, maxDens):
+    """Combines the statistics of slices from densityStats into the mean, standard deviation, min and max density of the volume."""
+    import numpy as np
+
+    filled = counts > 0
+    n = counts[filled]
+    total = np.sum(n)
+    volumeMean = np.sum(n * mean[filled]) / total
+    volumeStd = np.sqrt(np.sum(n * (std[filled]**2 + (mean[filled] - volumeMean)**2)) / total)
+    return volumeMean, volumeStd, np.min(minDens[filled]), np.max(maxDens[filled])
@@ -0,0 +1,68 @@
+"""Computes the distance maps used by the thickness and spacing measurements."""
+
+
+def squaredDistance(mask, out=None):
+    """Finds the squared Euclidean distance from each point of a mask to the nearest point outside it.
+
+    The distances are exact integers, built from the feature transform of scipy's distance_transform_edt. This skips
+    the float64 copies scipy makes to find distances, and the square root of each value equals scipy's distance.
+    out: An array the shape of the mask to write the distances to, instead of a new array.
+    Returns an array of the type set by the dtype policy, the smallest integer type that holds every distance by default.
+    """
+    import numpy as np
+    from scipy.ndimage import distance_transform_edt
+    from .dtypes import distanceDtype
+
+    mask = np.asarray(mask)
+    if out is None:
+        sq = np.zeros(mask.shape, dtype=distanceDtype(mask.shape))
+    else:
+        sq = out
+        sq[...] = 0
+    dtype = sq.dtype
+    if mask.size == 0:
+        return sq
+    # The feature transform holds the coordinates of the nearest point outside the mask
+    ft = distance_transform_edt(mask, return_distances=False, return_indices=True)
+    for axis in range(mask.ndim):
+        coords = np.arange(mask.shape[axis], dtype=ft.dtype).reshape([-1 if a == axis else 1 for a in range(mask.ndim)])
+        offset = ft[axis].astype(dtype, copy=False)
+        # The offsets along each axis are squared in place, so only the feature transform and result are kept
+        np.subtract(offset, coords, out=offset)
+        np.multiply(offset, offset, out=offset)
+        sq += offset
+    return sq
+
+
+def signedDistance(inside, outside, out=None):
+    """Stores the squared distance maps of two separate phases in one array.
+
+    The first item along the new first axis has the squared distance of each point of inside to the nearest point
+    outside inside, and the second has the same for outside. Both phases can then be shared with workers as a single
+    array, and phaseDistance gets the map of either phase without copying it.
+    Each phase still takes its own distance transform, since the nearest point outside a phase is found from a
+    different set of points for each phase, so the field saves memory and copies but not distance transform time.
+    inside, outside: The mask of a phase, or None to skip its distance transform, such as when its thickness is cached.
+    The map of a skipped phase is left unset.
+    out: An array of shape (2,) + the shape of the masks to write the maps to, instead of a new array.
+    """
+    import numpy as np
+
+    from .dtypes import distanceDtype
+
+    shape = np.shape(inside if inside is not None else outside)
+    if out is None:
+        out = np.empty((2,) + shape, dtype=distanceDtype(shape))
+    if inside is not None:
+        squaredDistance(inside, out[0])
+    if outside is not None:
+        squaredDistance(outside, out[1])
+    return out
+
+
+def phaseDistance(field, sign):
+    """Gets the squared distance map of the inside (sign 1) or outside (sign -1) phase of a field from signedDistance.
+
+    The map is a view of the field, so measuring the thickness of a phase overwrites it.
+    """
+    return field[0] if sign > 0 else field[1]
@@ -0,0 +1,44 @@
+"""Sets the data types of the large intermediate arrays made by the tools.
+
+The values can be changed before running an analysis, for example setting DENSITY_DTYPE to "float32" halves the memory
+of density maps, at the cost of the precision of the density values.
+"""
+import numpy as np
+
+# Type of density maps. Sums of densities are always taken in float64
+DENSITY_DTYPE = "float64"
+# Type of label maps. None uses the smallest type that can hold a label for every possible component
+LABEL_DTYPE = None
+# Type of squared distance and thickness maps. None uses the smallest type that can hold the largest squared distance
+DISTANCE_DTYPE = None
+# Store binary masks in the result cache as packed bits
+PACK_MASKS = True
+
+
+def densityDtype():
+    """Gets the type of density maps."""
+    return np.dtype(DENSITY_DTYPE)
+
+
+def labelDtype(size):
+    """Gets the type of a label map of an array with size elements."""
+    if LABEL_DTYPE is not None:
+        return np.dtype(LABEL_DTYPE)
+    # Separate components need a gap between them, so there are at most half as many as there are elements
+    return smallestInt(size//2 + 1)
+
+
+def distanceDtype(shape):
+    """Gets the type of a squared distance map of an array with the given shape."""
+    if DISTANCE_DTYPE is not None:
+        return np.dtype(DISTANCE_DTYPE)
+    # No squared distance is longer than the diagonal
+    return smallestInt(sum(int(s)**2 for s in shape))
+
+
+def smallestInt(value):
+    """Gets the smallest signed integer type that can hold value."""
+    for dtype in (np.int16, np.int32, np.int64):
+        if value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError("No integer type can hold " + str(value))
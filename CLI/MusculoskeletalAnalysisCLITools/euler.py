@@ -0,0 +1,134 @@
+"""Computes the Euler characteristic of binary volumes from the configurations of their 2x2x2 neighborhoods."""
+
+# Number of neighborhoods along the first axis counted at once, which bounds the temporary memory of each slab
+EULER_SLAB = 32
+
+
+def eulerTable(connectivity=3):
+    """Builds the contribution to the Euler characteristic of each configuration of a 2x2x2 neighborhood, times 8.
+
+    Bit 4*z + 2*y + x of a configuration is set if the voxel at (z, y, x) of the neighborhood is in the mask.
+    The neighborhoods are centered on the corners of the voxel grid. With connectivity 3 the mask is the union of its
+    closed voxel cubes, and each neighborhood counts the cells of the grid around its corner that touch the mask. With
+    connectivity 1 voxels are points joined by the edges, faces and cubes between neighbors that are all in the mask.
+    Each cell is shared by 8 neighborhoods for each corner it does not have, so weighting them by their share and
+    multiplying by 8 gives integers. The sum over every neighborhood of a zero padded volume is 8 times its Euler
+    characteristic, the same value skimage.measure.euler_number finds.
+    """
+    import numpy as np
+    from itertools import product
+
+    voxels = list(product((0, 1), repeat=3))
+    table = np.zeros(256, dtype=np.int64)
+    for config in range(256):
+        inMask = {v: bool(config >> (4*v[0] + 2*v[1] + v[2]) & 1) for v in voxels}
+        # The squares of 4 voxels around the edges of the grid that meet at the corner, and the pairs around its faces
+        squares = [[v for v in voxels if v[axis] == side] for axis in range(3) for side in (0, 1)]
+        pairs = [[v for v in voxels if v[a] == sa and v[b] == sb] for a, b in ((0, 1), (0, 2), (1, 2)) for sa in (0, 1) for sb in (0, 1)]
+        if connectivity == 3:
+            touches = lambda group: any(inMask[v] for v in group)
+            table[config] = (8*touches(voxels) - 4*sum(touches(s) for s in squares)
+                             + 2*sum(touches(p) for p in pairs) - sum(inMask.values()))
+        elif connectivity == 1:
+            # The pairs, squares and cube are shared by 4, 2 and 1 neighborhoods
+            filled = lambda group: all(inMask[v] for v in group)
+            table[config] = (sum(inMask.values()) - 2*sum(filled(p) for p in pairs)
+                             + 4*sum(filled(s) for s in squares) - 8*filled(voxels))
+        else:
+            raise ValueError("The Euler characteristic is defined for connectivity 1 and 3")
+    return table
+
+
+def neighborhoods(mask, start, end):
+    """Gets the configuration of each neighborhood centered on the corners start:end along the first axis of a zero padded mask.
+
+    Corner i is between voxels i-1 and i of each axis, so there are one more corners than voxels along each axis.
+    """
+    import numpy as np
+
+    shape = mask.shape
+    # The voxels around the corners, with the padding written in
+    padded = np.zeros((end - start + 1, shape[1] + 2, shape[2] + 2), dtype=np.uint8)
+    low = max(start - 1, 0)
+    high = min(end, shape[0])
+    padded[low - start + 1:high - start + 1, 1:-1, 1:-1] = mask[low:high]
+    config = np.zeros((end - start, shape[1] + 1, shape[2] + 1), dtype=np.uint8)
+    for z in (0, 1):
+        for y in (0, 1):
+            for x in (0, 1):
+                voxel = padded[z:z + end - start, y:y + shape[1] + 1, x:x + shape[2] + 1]
+                config |= voxel << np.uint8(4*z + 2*y + x)
+    return config
+
+
+def eulerNumber(mask, connectivity=3, workers=1):
+    """Finds the Euler characteristic of a binary volume, the number of objects and cavities minus the number of tunnels.
+
+    The neighborhoods are counted in slabs, so only one slab of configurations is in memory at a time.
+    workers: The number of processes the slabs are split between.
+    Returns the same value as skimage.measure.euler_number.
+    """
+    import numpy as np
+
+    table = eulerTable(connectivity)
+    corners = mask.shape[0] + 1
+    bounds = list(range(0, corners, EULER_SLAB)) + [corners]
+    if workers > 1 and len(bounds) > 2:
+        from concurrent.futures import ProcessPoolExecutor
+        from .shared import releaseShared, shareArray
+
+        shm, spec = shareArray(np.asarray(mask, dtype=bool))
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                counts = sum(pool.map(sharedCounts, [spec]*(len(bounds)-1), bounds[:-1], bounds[1:]))
+        finally:
+            releaseShared(shm)
+    else:
+        counts = sum(configCounts(mask, start, end) for start, end in zip(bounds[:-1], bounds[1:]))
+    return int(np.dot(counts, table)) // 8
+
+
+def configCounts(mask, start, end):
+    """Counts the neighborhoods of each configuration centered on the corners start:end along the first axis."""
+    import numpy as np
+
+    return np.bincount(neighborhoods(mask, start, end).ravel(), minlength=256)
+
+
+def sharedCounts(spec, start, end):
+    """Counts the configurations of a slab of a mask in shared memory."""
+    from .shared import attachArray
+
+    shm, mask = attachArray(spec)
+    try:
+        return configCounts(mask, start, end)
+    finally:
+        del mask
+        shm.close()
+
+
+def eulerMap(mask, blockSize, connectivity=3):
+    """Sums the Euler characteristic of a binary volume over blocks of blockSize voxels along each axis.
+
+    Each neighborhood is counted in the block of the voxel before its corner, and the first corner of each axis in the
+    first block, so the blocks add up to the Euler characteristic of the whole volume. The neighborhoods after the last
+    voxel of a mask are in a block that has the mask, even when crop leaves the space after it in a block of its own.
+    Returns an array with one value for each block, which is a multiple of 1/8 when a block cuts through the mask.
+    """
+    import numpy as np
+
+    # The contributions are small, so a slab of them fits in one byte each
+    table = eulerTable(connectivity).astype(np.int8)
+    blocks = tuple(-(-s // blockSize) for s in mask.shape)
+    result = np.zeros(blocks, dtype=np.int64)
+    # First corner of each block along the axes of a slab, one after the first voxel of the block
+    edges = [np.concatenate(([0], np.arange(blockSize + 1, s + 1, blockSize))) for s in mask.shape[1:]]
+    # Neighborhood c holds voxels c-1 and c, so it is counted with voxel c-1. Counting it with voxel c put the last
+    # corner of a mask that ends one voxel before a block boundary in a block with no mask, which then became NaN
+    for block in range(blocks[0]):
+        start = block*blockSize + 1 if block > 0 else 0
+        end = min((block + 1)*blockSize, mask.shape[0]) + 1
+        contributions = table[neighborhoods(mask, start, end)]
+        result[block] = np.add.reduceat(np.add.reduceat(contributions.sum(axis=0, dtype=np.int64), edges[0], axis=0), edges[1], axis=1)
+    return result / 8
+
@@ -26,3 +26,38 @@ def fill(mask, radius):
     # seed's zero areas are expanded to match mask's zeros
     mask = skimage.morphology.reconstruction(seed, mask, method='erosion')
     return mask
+
+
+def fillSlices(mask, radius, threads=1):
+    """Performs fill on every slice along the last axis of a 3D binary numpy array at once.
+
+    The disk is applied as a 3D footprint one slice deep, so slices do not affect each other.
+    threads: The number of threads that fill separate groups of slices.
+
+    Returns the filled binary array.
+    """
+    import numpy as np
+
+    if threads > 1 and mask.shape[2] > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        bounds = np.linspace(0, mask.shape[2], min(threads, mask.shape[2])+1).astype(int)
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            chunks = pool.map(lambda b: fillChunk(mask[:,:,b[0]:b[1]], radius), zip(bounds[:-1], bounds[1:]))
+            return np.concatenate(list(chunks), axis=2)
+    return fillChunk(mask, radius)
+
+
+def fillChunk(mask, radius):
+    """Fills one group of slices for fillSlices."""
+    import numpy as np
+    import skimage.morphology
+    from scipy.ndimage import binary_fill_holes
+    # Performs morphological close on each slice, filling small gaps
+    strel = skimage.morphology.disk(radius, dtype='bool')[:,:,None]
+    # Pad image to remove edge related problems
+    mask = np.pad(mask, ((radius, radius), (radius, radius), (0, 0)), mode='constant', constant_values=0)
+    mask = skimage.morphology.binary_closing(mask, footprint=strel)
+    mask = mask[radius:-radius, radius:-radius]
+    # Fills in all holes not connected to the edges of their slice, holes touching diagonally are connected like in fill
+    return binary_fill_holes(mask, structure=np.ones((3,3,1), dtype='bool'))
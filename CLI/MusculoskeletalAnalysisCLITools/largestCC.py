@@ -5,14 +5,142 @@ def largestCC(mask):
 
     Returns the mask with only the largest component
     """
-    import numpy as np
-    from skimage.measure import label
-
-    # Creates a labelmap of the mask, where connected components have the same label
-    labels = label(mask)
-    # labels[np.nonzero(labels)] is a list of all nonzero values in the labelmap. np.argmax(np.bincount()) returns the most common number in that list. largest is set to a mask showing where the labelmap is equal to that value.
-    largest = labels == np.argmax(np.bincount(labels[np.nonzero(labels)]))
-    if np.count_nonzero(largest) == 0:
+    largest = largestComponent(mask, mask.ndim)
+    if not largest.any():
         # Throw an exception if the output mask is empty. This could happen if the input mask is also empty
         raise Exception("Largest connected component not found")
     return largest
+
+
+def largestComponent(mask, connectivity):
+    """Finds the largest connected component of a binary array.
+
+    connectivity: The number of steps between neighbors, 1 connects faces and mask.ndim connects every touching voxel.
+    The array is read one slice at a time along the first axis. The components of each slice are joined to the
+    components of the previous slice with a union-find over component ids, which keeps the size of each component.
+    A second pass over the slices keeps the points of the largest component, so no label map of the volume is made.
+    Equal sized components are chosen the same way as the first largest label of skimage.measure.label.
+    Returns a binary array of the component, which is empty if the mask is.
+    """
+    import numpy as np
+    from scipy import ndimage
+    from .dtypes import labelDtype
+
+    if mask.ndim < 2:
+        raise ValueError("Components can only be found slice by slice in arrays with at least 2 dimensions")
+    structure = ndimage.generate_binary_structure(mask.ndim, connectivity)
+    # Neighbors in the same slice, and the offsets of neighbors in the previous slice
+    sliceStructure = structure[1]
+    offsets = np.argwhere(structure[0]) - 1
+    dtype = labelDtype(int(np.prod(mask.shape[1:])))
+    forest = ComponentForest()
+    starts = np.zeros(len(mask), dtype=np.int64)
+    previous = None
+    for i in range(len(mask)):
+        (labels, count) = ndimage.label(np.asarray(mask[i]), structure=sliceStructure, output=dtype)
+        starts[i] = forest.add(np.bincount(labels.ravel(), minlength=count+1)[1:])
+        # Component ids of every point of the slice, with 0 for the background
+        ids = np.where(labels > 0, labels + (starts[i] - 1), -1)
+        if previous is not None and count > 0:
+            pairs = []
+            for offset in offsets:
+                # Views of each point and its neighbor in the previous slice
+                here = tuple(slice(max(-d, 0), s - max(d, 0)) for d, s in zip(offset, ids.shape))
+                there = tuple(slice(max(d, 0), s - max(-d, 0)) for d, s in zip(offset, ids.shape))
+                touching = (ids[here] >= 0) & (previous[there] >= 0)
+                # Each pair is stored as one number, which is much faster to deduplicate than rows
+                pairs.append(previous[there][touching] * count + (ids[here][touching] - starts[i]))
+            pairs = np.unique(np.concatenate(pairs))
+            forest.union(np.stack((pairs // count, pairs % count + starts[i])))
+        previous = ids
+    largest = forest.largest()
+    result = np.zeros(mask.shape, dtype=bool)
+    if largest is None:
+        return result
+    roots = forest.roots()
+    for i in range(len(mask)):
+        # Labels are found the same way in both passes, so the ids of each slice start at the same place
+        (labels, count) = ndimage.label(np.asarray(mask[i]), structure=sliceStructure, output=dtype)
+        if count > 0:
+            inLargest = np.r_[False, roots[starts[i]:starts[i]+count] == largest]
+            result[i] = inLargest[labels]
+    return result
+
+
+class ComponentForest:
+    """A union-find forest of component ids, which tracks the size of each set.
+
+    The root of each set is its smallest id, so the sets keep the order of their first component.
+    """
+
+    def __init__(self):
+        import numpy as np
+
+        self.parent = np.zeros(0, dtype=np.int64)
+        self.size = np.zeros(0, dtype=np.int64)
+        self.count = 0
+
+    def add(self, sizes):
+        """Adds components with the given sizes as new sets. Returns the id of the first one."""
+        import numpy as np
+
+        start = self.count
+        self.count += len(sizes)
+        if self.count > len(self.parent):
+            # Grow the arrays by doubling, so adding each slice takes constant time on average
+            capacity = max(self.count, 2*len(self.parent))
+            self.parent = np.concatenate((self.parent, np.zeros(capacity - len(self.parent), dtype=np.int64)))
+            self.size = np.concatenate((self.size, np.zeros(capacity - len(self.size), dtype=np.int64)))
+        self.parent[start:self.count] = np.arange(start, self.count)
+        self.size[start:self.count] = sizes
+        return start
+
+    def find(self, ids):
+        """Finds the root of each id, and points the ids directly at their roots."""
+        import numpy as np
+
+        roots = self.parent[ids]
+        while True:
+            parents = self.parent[roots]
+            if np.array_equal(parents, roots):
+                break
+            roots = parents
+        self.parent[ids] = roots
+        return roots
+
+    def union(self, pairs):
+        """Joins the sets of each pair of ids, given as an array with two rows."""
+        import numpy as np
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        if pairs.shape[1] == 0:
+            return
+        # The roots of the pairs are joined as a small graph, then each group of roots points to its smallest
+        (nodes, edges) = np.unique(self.find(pairs.ravel()), return_inverse=True)
+        edges = edges.reshape(2, -1)
+        graph = coo_matrix((np.ones(edges.shape[1], dtype=np.int8), (edges[0], edges[1])), shape=(len(nodes), len(nodes)))
+        (groups, group) = connected_components(graph, directed=False)
+        # Nodes are sorted, so the first node of each group is its smallest
+        smallest = np.full(groups, len(nodes))
+        np.minimum.at(smallest, group, np.arange(len(nodes)))
+        rep = nodes[smallest[group]]
+        merged = rep != nodes
+        np.add.at(self.size, rep[merged], self.size[nodes[merged]])
+        self.parent[nodes] = rep
+
+    def roots(self):
+        """Finds the root of every id."""
+        import numpy as np
+
+        return self.find(np.arange(self.count))
+
+    def largest(self):
+        """Finds the root of the largest set, the one with the smallest root if several are the largest, or None if there are no sets."""
+        import numpy as np
+
+        if self.count == 0:
+            return None
+        isRoot = self.parent[:self.count] == np.arange(self.count)
+        sizes = np.where(isRoot, self.size[:self.count], -1)
+        return int(np.argmax(sizes))
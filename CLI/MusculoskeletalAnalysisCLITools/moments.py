@@ -0,0 +1,66 @@
+def areaMoments(mask):
+    """Finds the area moments of every slice of a 3D binary array along the last axis, in voxel units.
+
+    Coordinate weighted sums of the voxel counts along each axis are used, so no coordinate arrays are created.
+    Returns the area and centroid of each slice, and the central second moments of each slice as the sums of
+    (x-xCenter)^2, (y-yCenter)^2 and (x-xCenter)*(y-yCenter). Empty slices have zero for each.
+    """
+    import numpy as np
+
+    # Coordinates are measured from the middle of the array to keep the sums small
+    x = np.arange(mask.shape[0]) - (mask.shape[0]-1)/2
+    y = np.arange(mask.shape[1]) - (mask.shape[1]-1)/2
+    rows = np.count_nonzero(mask, axis=1)
+    columns = np.count_nonzero(mask, axis=0)
+    area = np.sum(rows, axis=0)
+    filled = area > 0
+    xCenter = np.divide(x @ rows, area, out=np.zeros(len(area)), where=filled)
+    yCenter = np.divide(y @ columns, area, out=np.zeros(len(area)), where=filled)
+    # Second moments about the centroid from the moments about the middle of the array
+    xx = (x**2 @ rows) - area*xCenter**2
+    yy = (y**2 @ columns) - area*yCenter**2
+    xy = x @ np.einsum("ijk,j->ik", mask, y) - area*xCenter*yCenter
+    # Slices with one row or column have no spread
+    return area, xCenter + (mask.shape[0]-1)/2, yCenter + (mask.shape[1]-1)/2, np.maximum(xx, 0), np.maximum(yy, 0), xy
+
+
+def principalMoments(xx, yy, xy):
+    """Finds the largest and smallest second moments of area of slices from their central second moments.
+
+    Returns the largest moment, the smallest moment, and the angle in radians from the first axis to the principal axis
+    of the smallest moment, which runs along the widest direction of the slice.
+    """
+    import numpy as np
+
+    mean = (xx + yy)/2
+    radius = np.sqrt(((xx - yy)/2)**2 + xy**2)
+    angle = np.arctan2(2*xy, xx - yy)/2
+    return mean + radius, mean - radius, angle
+
+
+def sectionModulus(mask, xCenter, yCenter, angle, iMax, iMin):
+    """Finds the section modulus of each slice about its two principal axes, in voxel units.
+
+    The section modulus is the moment of area divided by the distance from the axis to the furthest edge of the slice.
+    Only the first and last point of each row can be the furthest from an axis, so the other points are not used.
+    Returns the section modulus about the axis of the largest moment, then about the axis of the smallest moment.
+    Empty slices have zero for each.
+    """
+    import numpy as np
+
+    found = np.any(mask, axis=1)
+    first = np.argmax(mask, axis=1)
+    last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+    dx = np.arange(mask.shape[0])[:, None] - xCenter
+    moduli = []
+    for (cos, sin), moment in (((np.cos(angle), np.sin(angle)), iMax), ((-np.sin(angle), np.cos(angle)), iMin)):
+        # The distance from an axis is measured along the direction perpendicular to it
+        # The largest moment is about the axis perpendicular to angle, so distances are along angle
+        distance = np.zeros(len(angle))
+        for end in (first, last):
+            along = np.abs(dx*cos + (end - yCenter)*sin)
+            distance = np.maximum(distance, np.max(np.where(found, along, 0), axis=0, initial=0))
+        # The furthest edge of a voxel is half a voxel past its center along each axis
+        distance += (np.abs(cos) + np.abs(sin))/2
+        moduli.append(np.where(np.any(found, axis=0), moment/distance, 0))
+    return moduli[0], moduli[1]
@@ -0,0 +1,163 @@
+"""Records the time, memory and array sizes of each stage of an analysis."""
+from contextlib import contextmanager
+
+# Modes of profiling an analysis
+PROFILE_MODES = ("stages", "cprofile")
+# Start a new peak memory at the start of each stage. This affects the whole process, so it is only turned on by the
+# entry points that run in a process of their own, not when the tools run inside Slicer or a worker
+RESET_PEAK = False
+
+
+class StageProfile:
+    """The measurements of the stages of one analysis run.
+
+    mode: "stages" to measure each stage, or "cprofile" to also record every function call made in this process with
+    cProfile. Stages run in worker processes are measured, but their calls are not in the cProfile statistics.
+    """
+
+    def __init__(self, mode="stages"):
+        import time
+
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode " + str(mode))
+        self.mode = mode
+        self.stages = []
+        self.start = time.perf_counter()
+        self.profiler = None
+        if mode == "cprofile":
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def add(self, record):
+        """Adds the record of a finished stage."""
+        self.stages.append(record)
+
+    def write(self, output, name, report):
+        """Writes the stages to <name>_<report>.profile.json in the output directory, next to the report.
+
+        The cProfile statistics are written to <name>_<report>.prof, which can be read with pstats.
+        Returns the path of the JSON file.
+        """
+        import json
+        import os
+        import time
+
+        base = os.path.join(output, name + "_" + os.path.splitext(os.path.basename(report))[0])
+        data = {"name": name, "report": os.path.basename(report), "wall": time.perf_counter() - self.start, "stages": self.stages}
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(base + ".prof")
+            data["pstats"] = os.path.basename(base + ".prof")
+        with open(base + ".profile.json", "w") as f:
+            json.dump(data, f, indent=2)
+        return base + ".profile.json"
+
+
+class StageTimer:
+    """Measures a stage from when it is created until stop is called.
+
+    arrays: A dict of the arrays the stage works on, by name, whose sizes are recorded.
+    """
+
+    def __init__(self, name, arrays):
+        import time
+
+        self.record = {"name": name, "arrays": arraySizes(arrays)}
+        if RESET_PEAK:
+            resetPeakMemory()
+        self.peak = peakMemory()
+        self.wall = time.perf_counter()
+        self.cpu = cpuTime()
+
+    def stop(self):
+        """Returns the record of the stage, with its wall and CPU time in seconds, and the peak memory of the process and
+        how much the stage raised it in bytes.
+        """
+        import time
+
+        self.record["wall"] = time.perf_counter() - self.wall
+        self.record["cpu"] = cpuTime() - self.cpu
+        peak = peakMemory()
+        self.record["peakMemory"] = peak
+        self.record["peakIncrease"] = peak - self.peak if peak is not None and self.peak is not None else None
+        return self.record
+
+
+def startProfile(profile):
+    """Gets the StageProfile of an analysis from a profile mode, or an existing StageProfile when main passes its profile to analyze.
+
+    Returns None if profile is None or "none", so stages are not measured.
+    """
+    if profile is None or isinstance(profile, StageProfile):
+        return profile
+    if profile == "none":
+        return None
+    return StageProfile(profile)
+
+
+@contextmanager
+def stage(profile, name, **arrays):
+    """Measures the code in a with block as a stage of a StageProfile, along with the sizes of the arrays given by name.
+
+    Does nothing if profile is None.
+    """
+    if profile is None:
+        yield
+        return
+    timer = StageTimer(name, arrays)
+    yield
+    profile.add(timer.stop())
+
+
+def arraySizes(arrays):
+    """Gets the shape, type and number of bytes of each array in a dict, without reading arrays mapped from disk."""
+    import numpy as np
+
+    sizes = {}
+    for name, array in arrays.items():
+        dtype = np.dtype(array.dtype)
+        sizes[name] = {"shape": list(array.shape), "dtype": str(dtype), "bytes": int(np.prod(array.shape, dtype=np.int64)) * dtype.itemsize}
+    return sizes
+
+
+def cpuTime():
+    """Gets the CPU time used by this process and the worker processes it has finished waiting for, in seconds."""
+    import os
+
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def resetPeakMemory():
+    """Starts a new peak resident memory of this process from its current memory.
+
+    This is only possible on Linux, elsewhere the peak is the largest memory since the process started. The peak of the
+    whole process is reset, so this should only be called by a process that runs nothing else.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peakMemory():
+    """Gets the largest resident memory of this process, in bytes, or None where it can not be measured."""
+    import sys
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux reports kilobytes
+    return peak if sys.platform == "darwin" else peak * 1024
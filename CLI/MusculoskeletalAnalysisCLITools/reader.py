@@ -1,8 +1,19 @@
 """Converts slicer image and segmentation volumes into numpy format."""
 
 
-def readImg(inputImg):
-    """Reads an image file as input, returns the image as a numpy array."""
+def readImg(inputImg, region=None, mmap=True):
+    """Reads an image file as input, returns the image as a numpy array.
+
+    The array is oriented so its axes point left, posterior and superior.
+    region: A tuple of slices of the oriented array. Only this region is loaded.
+    mmap: Memory maps uncompressed NRRD, NIfTI and MetaImage files instead of decoding the whole file.
+    """
+    import numpy as np
+
+    if mmap:
+        imgData = mapImg(inputImg)
+        if imgData is not None:
+            return np.array(imgData[region] if region is not None else imgData, order="C")
     import SimpleITK as sitk
 
     imgReader = sitk.ImageFileReader()
@@ -10,14 +21,206 @@ def readImg(inputImg):
     image = imgReader.Execute()
     image = sitk.DICOMOrient(image, 'SPL')
     imgData = sitk.GetArrayFromImage(image)
+    if region is not None:
+        imgData = imgData[region].copy()
     return imgData
 
 
-def readMask(inputMask):
-    """Reads an nrrd file as input, returns the image as a binary numpy array."""
-    from nrrd import read
+def readMask(inputMask, region=None, mmap=True):
+    """Reads an nrrd file as input, returns the image as a binary numpy array.
+
+    region: A tuple of slices of the array. Only this region is loaded.
+    mmap: Memory maps uncompressed files instead of decoding the whole file.
+    """
+    import numpy as np
+    import nrrd
 
-    maskReader = read(inputMask)
+    if mmap:
+        header = nrrd.read_header(inputMask)
+        maskData = mapNrrd(inputMask, header)
+        if maskData is not None:
+            if region is not None:
+                maskData = maskData[region]
+            return (header,), np.asarray(maskData) != 0
+    maskReader = nrrd.read(inputMask)
     maskHeader = maskReader[1:]
-    maskData = maskReader[0].astype('bool')
+    maskData = maskReader[0]
+    if region is not None:
+        maskData = maskData[region]
+    maskData = maskData.astype('bool')
     return maskHeader, maskData
+
+
+def maskRegion(*inputMasks):
+    """Finds the region that crop would keep for the union of one or more nrrd masks, without loading them whole.
+
+    Returns a tuple of slices that can be passed to readImg and readMask. If every mask is empty the region is empty.
+    """
+    from .crop import boundingBox, cropSlices
+
+    bounds = None
+    for inputMask in inputMasks:
+        maskData = mapMask(inputMask)
+        shape = maskData.shape
+        maskBounds = boundingBox(maskData)
+        if maskBounds is None:
+            continue
+        if bounds is None:
+            bounds = maskBounds
+        else:
+            bounds = [(min(a[0], b[0]), max(a[1], b[1])) for a, b in zip(bounds, maskBounds)]
+    if bounds is None:
+        return (slice(0, 0),) * 3
+    return cropSlices(bounds, shape)
+
+
+def mapMask(inputMask):
+    """Memory maps an nrrd mask file, indexed by voxel (i, j, k) like readMask.
+
+    Returns the stored values rather than a binary array. Files that can not be mapped are loaded whole.
+    """
+    import nrrd
+
+    maskData = mapNrrd(inputMask, nrrd.read_header(inputMask))
+    if maskData is None:
+        maskData = nrrd.read(inputMask)[0]
+    return maskData
+
+
+def mapImg(inputImg):
+    """Memory maps an image file, oriented the same way as readImg.
+
+    Returns a read only view, or None if the file can not be mapped. Nothing is read until the view is used.
+    """
+    import numpy as np
+    import SimpleITK as sitk
+
+    imgReader = sitk.ImageFileReader()
+    imgReader.SetFileName(inputImg)
+    try:
+        imgReader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    if imgReader.GetDimension() != 3 or imgReader.GetNumberOfComponents() != 1:
+        return None
+    name = inputImg.lower()
+    if name.endswith((".nrrd", ".nhdr")):
+        import nrrd
+        imgData = mapNrrd(inputImg, nrrd.read_header(inputImg))
+    elif name.endswith(".nii"):
+        imgData = mapNifti(inputImg, imgReader)
+    elif name.endswith((".mha", ".mhd")):
+        imgData = mapMeta(inputImg)
+    else:
+        imgData = None
+    if imgData is None or imgData.shape != imgReader.GetSize():
+        return None
+    direction = np.reshape(imgReader.GetDirection(), (3, 3))
+    return orient(imgData, direction)
+
+
+def orient(data, direction):
+    """Reorders and flips the axes of an array indexed by voxel (i, j, k) so they point left, posterior and superior.
+
+    direction: The LPS direction cosines, with one column per voxel axis.
+    Matches the axis choice of SimpleITK DICOMOrient, without copying the data.
+    """
+    import numpy as np
+
+    order = [None, None, None]
+    used = set()
+    for axis in range(3):
+        # Each voxel axis is matched to the closest physical axis that has not already been taken
+        column = np.abs(direction[:, axis])
+        physical = max((p for p in range(3) if p not in used), key=lambda p: column[p])
+        used.add(physical)
+        order[physical] = axis
+    data = np.transpose(data, order)
+    for physical, axis in enumerate(order):
+        if direction[physical, axis] < 0:
+            data = np.flip(data, physical)
+    return data
+
+
+def mapNrrd(path, header):
+    """Memory maps the data of a raw NRRD file, indexed by voxel (i, j, k). Returns None if the data is encoded."""
+    import os
+    import numpy as np
+    from nrrd.reader import _determine_datatype
+
+    if header.get("encoding") != "raw" or header.get("line skip", 0) != 0 or header.get("byte skip", 0) < 0:
+        return None
+    dtype = _determine_datatype(header)
+    dataFile = header.get("data file", header.get("datafile"))
+    if dataFile is None:
+        offset = headerLength(path)
+        if offset is None:
+            return None
+    elif isinstance(dataFile, str) and "%" not in dataFile and not dataFile.startswith("LIST"):
+        path = os.path.join(os.path.dirname(path), dataFile)
+        offset = 0
+    else:
+        return None
+    offset += header.get("byte skip", 0)
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=tuple(header["sizes"]), order="F")
+
+
+def mapNifti(path, imgReader):
+    """Memory maps the data of an uncompressed NIfTI file, indexed by voxel (i, j, k). Returns None if it is scaled."""
+    import numpy as np
+
+    slope = float(imgReader.GetMetaData("scl_slope")) if imgReader.HasMetaDataKey("scl_slope") else 0
+    inter = float(imgReader.GetMetaData("scl_inter")) if imgReader.HasMetaDataKey("scl_inter") else 0
+    if slope not in (0, 1) or inter != 0:
+        return None
+    with open(path, "rb") as f:
+        start = f.read(348)
+    # The header size field is 348 in the file's byte order
+    endian = "<" if int.from_bytes(start[:4], "little") == 348 else ">"
+    offset = int(np.frombuffer(start[108:112], dtype=endian+"f4")[0])
+    datatype = int(np.frombuffer(start[70:72], dtype=endian+"i2")[0])
+    types = {2: "u1", 4: "i2", 8: "i4", 16: "f4", 64: "f8", 256: "i1", 512: "u2", 768: "u4", 1024: "i8", 1280: "u8"}
+    if datatype not in types:
+        return None
+    return np.memmap(path, dtype=endian+types[datatype], mode="r", offset=offset, shape=imgReader.GetSize(), order="F")
+
+
+def mapMeta(path):
+    """Memory maps the data of an uncompressed MetaImage file, indexed by voxel (i, j, k)."""
+    import os
+    import numpy as np
+
+    fields = {}
+    offset = 0
+    with open(path, "rb") as f:
+        for line in f:
+            offset += len(line)
+            key, _, value = line.decode("latin-1").partition("=")
+            fields[key.strip()] = value.strip()
+            if key.strip() == "ElementDataFile":
+                break
+    types = {"MET_UCHAR": "u1", "MET_CHAR": "i1", "MET_USHORT": "u2", "MET_SHORT": "i2", "MET_UINT": "u4", "MET_INT": "i4",
+             "MET_ULONG_LONG": "u8", "MET_LONG_LONG": "i8", "MET_FLOAT": "f4", "MET_DOUBLE": "f8"}
+    if fields.get("CompressedData", "False") != "False" or fields.get("ElementType") not in types:
+        return None
+    msb = fields.get("BinaryDataByteOrderMSB", fields.get("ElementByteOrderMSB", "False")) == "True"
+    dtype = (">" if msb else "<") + types[fields["ElementType"]]
+    dataFile = fields.get("ElementDataFile")
+    if dataFile != "LOCAL":
+        if dataFile is None or " " in dataFile or "%" in dataFile or int(fields.get("HeaderSize", 0)) != 0:
+            return None
+        path = os.path.join(os.path.dirname(path), dataFile)
+        offset = 0
+    shape = tuple(int(s) for s in fields["DimSize"].split())
+    return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F")
+
+
+def headerLength(path):
+    """Finds the number of bytes before the data of a NRRD file with attached data, which starts after a blank line."""
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            offset += len(line)
+            if line in (b"\n", b"\r\n"):
+                return offset
+    return None
@@ -0,0 +1,104 @@
+"""Runs independent analysis stages concurrently in worker processes."""
+
+
+def runStages(stages, arrays, workers=1, progress=None, profile=None):
+    """Runs a dependency graph of analysis stages.
+
+    stages: A list of tuples (name, function, arrayNames, args, dependencies). Each function is called with the named
+    arrays, then args, then the results of its dependencies. Functions must be importable so workers can unpickle them.
+    arrays: A dict of read only input arrays. When running in workers they are shared through shared memory, and arrays
+    made by sharedArray are shared without copying them.
+    workers: The number of stages to run at once. With 1 worker stages run in order in this process.
+    progress: A function called with the fraction of the stages that are done as each one finishes, or None.
+    profile: A StageProfile that each stage is recorded in, measured in the process that runs it.
+
+    Returns a dict of the results of each stage.
+    """
+    from .profiling import stage
+
+    names = [s[0] for s in stages]
+    for name, _, _, _, dependencies in stages:
+        for d in dependencies:
+            if d not in names:
+                raise ValueError("Stage " + name + " depends on unknown stage " + d)
+    if workers > 1 and len(stages) > 1:
+        return runParallel(stages, arrays, workers, progress, profile)
+    results = {}
+    remaining = list(stages)
+    while remaining:
+        ready = [s for s in remaining if all(d in results for d in s[4])]
+        if not ready:
+            raise ValueError("Stage dependencies contain a cycle")
+        name, function, arrayNames, args, dependencies = ready[0]
+        with stage(profile, name, **{a: arrays[a] for a in arrayNames}):
+            results[name] = function(*[arrays[a] for a in arrayNames], *args, *[results[d] for d in dependencies])
+        remaining.remove(ready[0])
+        if progress is not None:
+            progress(len(results)/len(stages))
+    return results
+
+
+def runParallel(stages, arrays, workers, progress, profile=None):
+    """Runs stages in a process pool as soon as their dependencies finish."""
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    from .shared import releaseShared, shareArray, sharedSpec
+
+    blocks = []
+    specs = {}
+    try:
+        # Only the arrays used by some stage are copied to shared memory, unless they are already in it
+        for name in {a for s in stages for a in s[2]}:
+            specs[name] = sharedSpec(arrays[name])
+            if specs[name] is None:
+                shm, specs[name] = shareArray(arrays[name])
+                blocks.append(shm)
+        results = {}
+        remaining = list(stages)
+        running = {}
+        with ProcessPoolExecutor(max_workers=min(workers, len(stages))) as pool:
+            while remaining or running:
+                for stage in [s for s in remaining if all(d in results for d in s[4])]:
+                    name, function, arrayNames, args, dependencies = stage
+                    timer = (name, arrayNames) if profile is not None else None
+                    job = pool.submit(runStage, function, [specs[a] for a in arrayNames], args, [results[d] for d in dependencies], timer)
+                    running[job] = name
+                    remaining.remove(stage)
+                if not running:
+                    raise ValueError("Stage dependencies contain a cycle")
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for job in done:
+                    if profile is None:
+                        results[running.pop(job)] = job.result()
+                    else:
+                        (results[running.pop(job)], record) = job.result()
+                        profile.add(record)
+                    if progress is not None:
+                        progress(len(results)/len(stages))
+        return results
+    finally:
+        releaseShared(*blocks)
+
+
+def runStage(function, specs, args, dependencies, timer=None):
+    """Attaches to the shared input arrays and runs one stage in a worker process.
+
+    timer: The name of the stage and of its arrays, to also return the record of the stage for a StageProfile.
+    """
+    from .profiling import StageTimer
+    from .shared import attachArray
+
+    attached = [attachArray(spec) for spec in specs]
+    blocks = [a[0] for a in attached]
+    views = [a[1] for a in attached]
+    del attached
+    try:
+        if timer is None:
+            return function(*views, *args, *dependencies)
+        measure = StageTimer(timer[0], dict(zip(timer[1], views)))
+        result = function(*views, *args, *dependencies)
+        return result, measure.stop()
+    finally:
+        # The views must be released before the shared memory can be closed
+        del views
+        for shm in blocks:
+            shm.close()
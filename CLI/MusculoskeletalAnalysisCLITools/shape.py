@@ -1,16 +1,226 @@
-def bWshape(shape, threshold):
-    """Creates a triangular mesh shape using marching cubes algorithm."""
-    from skimage import measure
+# Number of faces measured at once, which bounds the temporary memory of the surface measurements
+FACE_CHUNK = 2**20
+# Number of cells along each axis of the blocks the marching cubes surface is found in
+MESH_BLOCK = 64
+# Distances from the surface, in voxels, at which the volume is sampled for the voxel based SMI
+VOXEL_SMI_OFFSETS = tuple(step/4 for step in range(-8, 9))
+
+
+def bWshape(shape, threshold, cache=None, key=None):
+    """Creates a triangular mesh shape using marching cubes algorithm.
+
+    cache and key: A ResultCache and the key of the image, used to reuse the marching cubes surface of an earlier run.
+    """
     from trimesh import base
+    from .cache import cacheKey, cached
 
-    verts, face, normals, _ = measure.marching_cubes(shape, level=threshold, allow_degenerate=False)
+    verts, face, normals = cached(cache, cache and cacheKey("mesh", key, threshold), marchingCubes, shape, threshold)
     mesh=base.Trimesh(vertices=verts, faces=face, vertex_normals=normals, validate=True)
     return mesh
 
 
+def marchingCubes(shape, threshold):
+    """Finds the vertices, faces and vertex normals of the surface of an image at a threshold."""
+    from skimage import measure
+
+    verts, face, normals, _ = measure.marching_cubes(shape, level=threshold, allow_degenerate=False)
+    return verts, face, normals
+
+
 def updateVertices(mesh, newVert):
     """Creates a mesh using a previous mesh's faces with new vertices locations."""
     from trimesh import base
 
     mesh = base.Trimesh(vertices=newVert, faces=mesh.faces, vertex_normals=mesh.vertex_normals, validate=True)
     return mesh
+
+
+def meshMetrics(img, threshold, voxSize, cache=None, key=None, workers=1, mask=None):
+    """Measures bone volume and structure model index using a marching cubes mesh of the image.
+
+    mask: If given, only the bone inside the mask is measured, from a closed surface found in blocks by surfaceSums
+    with workers processes. Otherwise the whole image is meshed at once and measured after trimesh validates it.
+    cache and key: A ResultCache and the key of the image, and of the mask if there is one, used to reuse the mesh or
+    measurements of an earlier run.
+    Returns the volume in physical units and the SMI.
+    """
+    from .cache import cacheKey, cached
+
+    if mask is not None:
+        (volume, bS, dS) = cached(cache, cache and cacheKey("surface", key, threshold), surfaceSums, img, threshold, workers, mask)
+    else:
+        # Create mesh using marching squares and calculate its volume
+        boneMesh = bWshape(img, threshold, cache, key)
+        volume = boneMesh.volume
+        # The surface area, and the derivative of the area as each vertex moves along its normal
+        (bS, dS) = surfaceDerivative(boneMesh.vertices, boneMesh.faces, boneMesh.vertex_normals)
+    boneVolume = volume * voxSize**3
+    # SMI
+    # Calculated from how fast the surface area of the mesh grows as its vertices move outward, relative to its volume and area
+    # Measures the characteristics of the shape; 0 for plate-like, 3 for rod-like, 4 for sphere-like
+    # Every way of measuring it moves the surface along the marching cubes normals, toward higher values, so all of them give the same sign
+    # Convert to mm
+    bS = bS*(voxSize**2)
+    dSdr = dS*voxSize
+    # Apply the SMI formula
+    SMI=(6*boneVolume*dSdr/(bS**2))
+    return boneVolume, SMI
+
+
+def maskedMeshMetrics(img, mask, threshold, voxSize, cache=None, key=None, workers=1):
+    """Measures bone volume and structure model index of the bone inside a mask, taking the arrays first for runStages."""
+    return meshMetrics(img, threshold, voxSize, cache, key, workers, mask)
+
+
+def surfaceSums(img, threshold, workers=1, mask=None):
+    """Finds the volume, surface area and derivative of the area of the closed marching cubes surface of an image.
+
+    Voxels around the image, and outside the mask if there is one, are treated as background so the surface closes
+    around the bone. The cells of the padded image are split into blocks of MESH_BLOCK cells along each axis, and each
+    block is meshed separately, with workers processes. Blocks that the surface does not cross are skipped. Each block
+    reads one more layer of voxels on each side, so the vertices it shares with its neighbors get the same normals from
+    the gradient of the image. The measurements are sums over the faces, so the blocks are added without joining
+    their meshes.
+    Returns an array of the volume, area and derivative, in voxel units.
+    """
+    import numpy as np
+
+    # Value of the background. Values far below the threshold would pull the surface onto the bone
+    low = min(float(np.min(img)), threshold - 1)
+    cells = [s + 1 for s in img.shape]
+    blocks = [(a, b, c) for a in range(0, cells[0], MESH_BLOCK) for b in range(0, cells[1], MESH_BLOCK) for c in range(0, cells[2], MESH_BLOCK)]
+    if workers > 1 and len(blocks) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        from .shared import releaseShared, shareArray
+
+        shared = [shareArray(img)] + ([shareArray(mask)] if mask is not None else [])
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                jobs = [pool.submit(sharedBlock, [spec for _, spec in shared], threshold, low, start) for start in blocks]
+                return sum(job.result() for job in jobs)
+        finally:
+            releaseShared(*[shm for shm, _ in shared])
+    return sum(meshBlock(img, mask, threshold, low, start) for start in blocks)
+
+
+def meshBlock(img, mask, threshold, low, start):
+    """Measures the part of the closed marching cubes surface in the block of cells starting at start.
+
+    Cells are numbered by their first voxel, in the image padded by one voxel of background on each side.
+    Returns an array of the volume, area and derivative of the area of the block's faces.
+    """
+    import numpy as np
+    from scipy import ndimage
+    from skimage import measure
+
+    shape = [s + 2 for s in img.shape]
+    end = [min(s + MESH_BLOCK, n - 1) for s, n in zip(start, shape)]
+    # The voxels of the cells, and one more layer for the gradients of the normals
+    first = [max(s - 1, 0) for s in start]
+    last = [min(e + 2, n) for e, n in zip(end, shape)]
+    # The same region of the image, without the padding
+    inner = tuple(slice(max(f - 1, 0), min(l - 1, n)) for f, l, n in zip(first, last, img.shape))
+    if mask is not None and not np.any(mask[inner]):
+        return np.zeros(3)
+    region = np.full([l - f for f, l in zip(first, last)], low, dtype=np.float32)
+    place = tuple(slice(i.start + 1 - f, i.stop + 1 - f) for i, f in zip(inner, first))
+    region[place] = img[inner] if mask is None else np.where(mask[inner], img[inner], low)
+    if not np.min(region) < threshold < np.max(region):
+        return np.zeros(3)
+    # Only the block's own cells make faces, so each face is found by one block. marching_cubes marks cells by their last voxel
+    cellMask = np.zeros(region.shape, dtype=bool)
+    cellMask[tuple(slice(s - f + 1, e - f + 1) for s, e, f in zip(start, end, first))] = True
+    try:
+        verts, faces, _, _ = measure.marching_cubes(region, level=threshold, allow_degenerate=False, mask=cellMask)
+    except RuntimeError:
+        # No surface in the block's cells
+        return np.zeros(3)
+    # marching_cubes finds the normal of a vertex in the first cell that reaches it, which can be in another block.
+    # Normals interpolated from the gradient of the image are the same in every block that shares the vertex, and
+    # point toward higher values like the normals of marching_cubes
+    gradient = np.stack([ndimage.map_coordinates(g, verts.T, order=1) for g in np.gradient(region)], axis=1)
+    normals = gradient / np.maximum(np.linalg.norm(gradient, axis=1), np.finfo(np.float32).tiny)[:, None]
+    verts = verts + np.array(first, dtype=np.float64) - 1
+    (area, dArea) = surfaceDerivative(verts, faces, normals)
+    # marching_cubes winds the faces clockwise seen from outside, against its normals
+    return np.array([-fluxVolume(verts, faces), area, dArea])
+
+
+def sharedBlock(specs, threshold, low, start):
+    """Measures a block of the surface of an image, and mask if there is one, in shared memory."""
+    from .shared import attachArray
+
+    (shms, arrays) = zip(*[attachArray(spec) for spec in specs])
+    try:
+        return meshBlock(arrays[0], arrays[1] if len(arrays) > 1 else None, threshold, low, start)
+    finally:
+        del arrays
+        for shm in shms:
+            shm.close()
+
+
+def fluxVolume(verts, faces):
+    """Finds the volume of a mesh from the flux of the first coordinate through its faces, the same way as trimesh.
+
+    For closed meshes this is the enclosed volume, positive if the faces wind counterclockwise seen from outside.
+    """
+    import numpy as np
+
+    volume = 0.0
+    for start in range(0, len(faces), FACE_CHUNK):
+        tri = verts[faces[start:start + FACE_CHUNK]]
+        # First component of the cross product of the edges, times the sum of the first coordinates of the corners
+        crossX = (tri[:, 1, 1] - tri[:, 0, 1])*(tri[:, 2, 2] - tri[:, 0, 2]) - (tri[:, 1, 2] - tri[:, 0, 2])*(tri[:, 2, 1] - tri[:, 0, 1])
+        volume += np.sum(crossX*tri[:, :, 0].sum(axis=1))/6
+    return volume
+
+
+def surfaceDerivative(verts, faces, normals):
+    """Finds the surface area of a mesh, and its derivative as every vertex moves along its normal.
+
+    The derivative of each triangle's area comes from the derivative of the cross product of its edges, so no moved
+    copy of the mesh is made. Degenerate triangles have no derivative and are skipped. Faces are measured in chunks of
+    FACE_CHUNK.
+    Returns the area and its derivative, in the units of the vertices.
+    """
+    import numpy as np
+
+    area = 0.0
+    dArea = 0.0
+    for start in range(0, len(faces), FACE_CHUNK):
+        chunk = faces[start:start + FACE_CHUNK]
+        a = verts[chunk[:, 0]] - verts[chunk[:, 1]]
+        b = verts[chunk[:, 0]] - verts[chunk[:, 2]]
+        cross = np.cross(a, b)
+        length = np.sqrt(np.einsum("ij,ij->i", cross, cross))
+        area += np.sum(length)/2
+        dCross = np.cross(normals[chunk[:, 0]] - normals[chunk[:, 1]], b) + np.cross(a, normals[chunk[:, 0]] - normals[chunk[:, 2]])
+        valid = length > 0
+        dArea += np.sum(np.einsum("ij,ij->i", cross[valid], dCross[valid])/length[valid])/2
+    return area, dArea
+
+
+def voxelSMI(bone, voxSize):
+    """Measures the structure model index of a binary mask from its voxels, for comparison with the mesh SMI.
+
+    Each voxel is placed at the signed distance of its center from the surface, which lies halfway between bone and
+    background voxels, and fills the volume within half a voxel of that distance. The volume of the mask dilated or
+    eroded by r is then the volume of the voxels below r, and a quadratic fit of it over VOXEL_SMI_OFFSETS gives the
+    volume, surface area and derivative of the area. The edges of the array are treated as background. Positive offsets
+    dilate the mask, while meshMetrics moves the surface along the marching cubes normals into the bone, so the sign is
+    reversed to match it.
+    """
+    import numpy as np
+    from .distance import squaredDistance
+
+    padded = np.pad(bone, 1)
+    # Number of bone voxels at each squared distance to the background, and background voxels at each squared distance to the bone
+    inside = np.bincount(squaredDistance(padded)[padded])
+    outside = np.bincount(squaredDistance(~padded)[~padded])
+    places = np.concatenate((0.5 - np.sqrt(np.arange(len(inside))), np.sqrt(np.arange(len(outside))) - 0.5))
+    counts = np.concatenate((inside, outside))
+    offsets = np.array(VOXEL_SMI_OFFSETS)
+    volumes = np.clip(offsets[:, None] - places[None, :] + 0.5, 0, 1) @ counts
+    (curve, slope, volume) = np.polyfit(offsets*voxSize, volumes*voxSize**3, 2)
+    # The area is the derivative of the volume, and its derivative is the second derivative of the volume
+    return -6*volume*(2*curve)/slope**2
@@ -0,0 +1,77 @@
+"""Shares numpy arrays between worker processes without copying them through pickles."""
+
+# The spec of each array made by sharedArray in this process, by the address of its data
+SHARED = {}
+
+
+def shareArray(array):
+    """Copies an array into a new shared memory block.
+
+    Returns the shared memory block, which the caller must close and unlink, and a spec that workers can attach to.
+    """
+    shm, spec = emptyShared(array.shape, array.dtype)
+    _, shared = attachArray(spec, shm)
+    shared[...] = array
+    return shm, spec
+
+
+def sharedArray(shape, dtype):
+    """Creates an uninitialized array in shared memory, which runStages passes to workers without copying it.
+
+    Returns the shared memory block, which the caller must release with releaseShared, and the array.
+    """
+    shm, spec = emptyShared(shape, dtype)
+    _, array = attachArray(spec, shm)
+    SHARED[array.__array_interface__["data"][0]] = spec
+    return shm, array
+
+
+def sharedSpec(array):
+    """Gets the spec of an array made by sharedArray, or None if it is any other array."""
+    spec = SHARED.get(array.__array_interface__["data"][0])
+    if spec is None or array.shape != spec[1] or array.dtype.str != spec[2] or not array.flags.c_contiguous:
+        return None
+    return spec
+
+
+def emptyShared(shape, dtype):
+    """Creates an uninitialized shared array.
+
+    Returns the shared memory block and a spec in the format (name, shape, dtype).
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    dtype = np.dtype(dtype)
+    size = max(1, int(np.prod(shape)) * dtype.itemsize)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    return shm, (shm.name, tuple(shape), dtype.str)
+
+
+def attachArray(spec, shm=None):
+    """Gets a numpy view of a shared array from its spec.
+
+    Returns the shared memory block, which must be kept open while the view is in use, and the view.
+    """
+    import numpy as np
+    from multiprocessing import shared_memory
+
+    name, shape, dtype = spec
+    if shm is None:
+        shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def releaseShared(*blocks):
+    """Closes and unlinks shared memory blocks created by this process.
+
+    A block that still has views, such as those in the traceback of an exception, is closed when they are collected.
+    """
+    for shm in blocks:
+        for address in [a for a, spec in SHARED.items() if spec[0] == shm.name]:
+            del SHARED[address]
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            pass
@@ -0,0 +1,31 @@
+"""Splits volumes into slabs along the slice axis so analyses can run with bounded memory."""
+
+# Bytes of temporary arrays made for each voxel of a slab while it is analyzed, such as masks and float64 densities
+WORKING_BYTES = 32
+
+
+def openImg(inputImg, region):
+    """Gets a view of the region of an image, oriented like readImg, that is only read from disk as it is used.
+
+    Images that can not be memory mapped are loaded whole.
+    """
+    from .reader import mapImg, readImg
+
+    imgData = mapImg(inputImg)
+    if imgData is None:
+        imgData = readImg(inputImg, mmap=False)
+    return imgData[region]
+
+
+def slabs(shape, memory, itemsize):
+    """Gets slices of the last axis that split a volume into slabs.
+
+    memory: The number of megabytes a slab may use while it is analyzed. If 0 the volume is one slab.
+    itemsize: The number of bytes of each image voxel.
+    """
+    depth = shape[2]
+    if memory > 0:
+        step = max(1, int(memory * 2**20 // (shape[0] * shape[1] * (itemsize + WORKING_BYTES))))
+    else:
+        step = max(1, depth)
+    return [slice(start, min(start + step, depth)) for start in range(0, depth, step)]
@@ -1,5 +1,136 @@
-def findSpheres(mask):
-    """Calculates thickness by finding the largest sphere containing each point."""
+from functools import lru_cache
+
+from .distance import squaredDistance
+
+# Squared radius below which the ridge test is exact. approxLTE also accepts points that are isclose to r^2, which
+# only lets in an extra integer shell once the relative tolerance (1e-5) of r^2 reaches 1
+EXACT_RIDGE_LIMIT = 99000
+# Maximum number of candidate points painted at once when dilating spheres
+BATCH_POINTS = 2**20
+# Spheres of one radius whose points outnumber the voxels of their bounding box this many times are painted with a
+# distance transform of their centers instead of point by point
+DILATE_RATIO = 4
+# Bytes used for each voxel of a slab by slabSpheres: the feature transform, the squared distance map, the thickness
+# map and the masks of the ridge and of the points no sphere has reached
+SLAB_BYTES = 32
+# The halo slabSpheres starts with on each side of a slab, in voxels. It is doubled until it holds every sphere
+SLAB_HALO = 8
+# The spheres painted between each search for the points no sphere has reached, as a multiple of the size of the map
+GAP_RATIO = 2
+
+
+def findSpheres(mask, method="ridge", workers=1):
+    """Calculates thickness by finding the largest sphere containing each point.
+
+    method selects the engine: "ridge" (default) only grows spheres from the distance ridge and paints them in
+    radius batches, "brute" grows a sphere from every point. Both return identical values.
+    workers is the number of processes the ridge engine splits the volume between.
+    """
+    if method == "ridge":
+        return distanceSpheres(squaredDistance(mask), workers)
+    elif method == "brute":
+        return bruteSpheres(mask)
+    else:
+        raise ValueError("Unknown thickness method: " + str(method))
+
+
+def distanceSpheres(sq, workers=1):
+    """Calculates thickness with the ridge engine from the squared distance map of a mask, from squaredDistance.
+
+    sq is overwritten with the squared thickness map. Returns the thickness radius of each point of the mask.
+    """
+    import numpy as np
+
+    if workers > 1:
+        sqRads = tiledSpheres(sq, workers)
+    else:
+        ridgeSpheres(sq)
+        sqRads = sq[np.nonzero(sq)]
+    return np.sqrt(sqRads, dtype=np.float64)
+
+
+def slabSpheres(mask, memory):
+    """Calculates the same thickness as findSpheres one slab of the first axis at a time, so the distance and thickness
+    maps of only one slab are in memory.
+
+    memory: The number of megabytes each slab may use, including its halo.
+    Each slab is measured with a halo on both sides. The distances within the halo of the slab are exact when none of
+    them is longer than the halo, and then no sphere from outside the halo can reach the slab. If a distance is too
+    long the halo is doubled and the slab is measured again. Slabs are at least as thick as their halos, so thick
+    structures, or a memory too small for the halo, make slabs use more memory.
+    Returns the thickness radius of each point of the mask, in the same order as findSpheres.
+    """
+    import numpy as np
+
+    plane = int(np.prod(mask.shape[1:]))
+    rows = max(1, int(memory * 2**20 // (max(plane, 1) * SLAB_BYTES)))
+    depth = mask.shape[0]
+    halo = SLAB_HALO
+    rads = []
+    start = 0
+    while start < depth:
+        while True:
+            # Slabs are kept at least as thick as their halos, so each voxel is not measured more than a few times
+            end = min(start + max(rows - 4*(halo + 1), 2*(halo + 1)), depth)
+            # The exact zone holds every sphere that can reach the slab, with one more layer for the ridge test
+            exactLow = max(start - halo - 1, 0)
+            exactHigh = min(end + halo + 1, depth)
+            low = max(exactLow - halo - 1, 0)
+            high = min(exactHigh + halo + 1, depth)
+            if low == 0 and high == depth:
+                # The region is the whole volume, so every distance is exact and the rest is measured at once
+                (end, exactLow, exactHigh) = (depth, 0, depth)
+            sq = squaredDistance(mask[low:high])
+            exact = sq[exactLow-low:exactHigh-low]
+            # A distance is exact if the nearest point outside the mask is within the region, which holds for distances up
+            # to the halo. A sphere from outside the zone reaching the slab would make a distance in the zone near the halo
+            if high - low == depth or int(exact.max(initial=0)) <= (halo - 2)**2:
+                break
+            halo *= 2
+        local = np.ascontiguousarray(exact)
+        paintSpheres(local, exact, distanceRidge(exact))
+        slab = local[start-exactLow:end-exactLow]
+        rads.append(np.sqrt(slab[np.nonzero(slab)], dtype=np.float64))
+        del sq, exact, local, slab
+        start = end
+    return np.concatenate(rads) if rads else np.zeros(0)
+
+
+def thicknessStats(mask, voxSize, workers=1, cache=None, key=None):
+    """Calculates the mean and standard deviation of the largest sphere diameter of each point, in physical units.
+
+    cache and key: A ResultCache and the key of the mask, used to reuse the thickness map of an earlier run.
+    """
+    from .cache import cacheKey, cached
+
+    rads = cached(cache, cache and cacheKey("thickness", key), findSpheres, mask, workers=workers)
+    return sphereStats(rads, voxSize)
+
+
+def phaseThicknessStats(field, sign, voxSize, workers=1, cache=None, key=None):
+    """Calculates the same values as thicknessStats for one phase of a field of two distance maps, from signedDistance.
+
+    sign: 1 for the inside phase, -1 for the outside phase.
+    The map of the phase is overwritten with its thickness map, so each phase can only be measured once, but both
+    phases can be measured at once from one shared field.
+    """
+    from .cache import cacheKey, cached
+    from .distance import phaseDistance
+
+    rads = cached(cache, cache and cacheKey("thickness", key), lambda: distanceSpheres(phaseDistance(field, sign), workers))
+    return sphereStats(rads, voxSize)
+
+
+def sphereStats(rads, voxSize):
+    """Calculates the mean and standard deviation of the diameters of thickness radii, in physical units."""
+    import numpy as np
+
+    diams = rads * 2 * voxSize
+    return np.mean(diams), np.std(diams)
+
+
+def bruteSpheres(mask):
+    """Calculates thickness by growing a sphere from every point. Kept as a reference for validating ridgeSpheres."""
     import numpy as np
     from math import floor
     from scipy.ndimage import distance_transform_edt
@@ -28,13 +159,287 @@ def findSpheres(mask):
         roi=rads[x-xr0:x+xr1+1, y-yr0:y+yr1+1, z-zr0:z+zr1+1]
         # Creates mask of sphere within radius
         i,j,k=np.mgrid[-xr0:xr1+1,-yr0:yr1+1,-zr0:zr1+1]
-        mask = approxLTE(i**2 + j**2 + k**2, np.full_like(roi, r**2)) 
+        mask = approxLTE(i**2 + j**2 + k**2, np.full_like(roi, r**2))
         mask = np.bitwise_and(mask, roi>0)
         # Sets all values inside region of interest and sphere mask to the radius if it is higher than their current value
         mask = mask * r
         roi[:,:,:] = np.maximum(roi, mask)
     return rads[np.nonzero(rads)]
 
+
+def ridgeSpheres(sq):
+    """Calculates thickness by finding the largest sphere containing each point.
+
+    sq: The squared distance map of the mask, which is overwritten with the squared thickness map.
+    Only points on the distance ridge are used as sphere centers, every other sphere is contained in a neighbor's
+    larger sphere. Spheres are painted in batches of equal radius using cached offset tables.
+    """
+    centers = distanceRidge(sq)
+    # The radius of each center is read before any sphere is painted, so the map can be painted in place
+    paintSpheres(sq, sq, centers)
+
+
+def tiledSpheres(sq, workers):
+    """Calculates the same thickness as ridgeSpheres, splitting the volume into slabs processed by a pool of workers.
+
+    Each slab is read with a halo as wide as the largest radius, so every sphere reaching the slab is painted by its
+    worker. Workers only write their own slab of the shared thickness map.
+    Returns the squared thickness of each point of the mask.
+    """
+    import numpy as np
+    from math import isqrt
+    from concurrent.futures import ProcessPoolExecutor
+    from .shared import attachArray, emptyShared, releaseShared, shareArray
+
+    # The largest radius, rounded up
+    maxSq = int(np.max(sq)) if sq.size > 0 else 0
+    halo = isqrt(maxSq) + (isqrt(maxSq)**2 < maxSq)
+    # Use a few slabs per worker to balance the load, but keep slabs at least as wide as the halo
+    tiles = min(4*workers, sq.shape[0] // max(halo, 1))
+    if tiles < 2:
+        ridgeSpheres(sq)
+        return sq[np.nonzero(sq)]
+    bounds = np.linspace(0, sq.shape[0], tiles+1).astype(int)
+    distShm, distSpec = shareArray(sq)
+    radsShm, radsSpec = emptyShared(distSpec[1], distSpec[2])
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(thicknessTile, distSpec, radsSpec, start, end, halo) for start, end in zip(bounds[:-1], bounds[1:])]
+            for job in jobs:
+                job.result()
+        _, rads = attachArray(radsSpec, radsShm)
+        return rads[np.nonzero(rads)]
+    finally:
+        releaseShared(distShm, radsShm)
+
+
+def thicknessTile(distSpec, radsSpec, start, end, halo):
+    """Paints the squared thickness map of the slab start:end along the first axis, using spheres from the surrounding halo."""
+    from .shared import attachArray
+
+    distShm, dist = attachArray(distSpec)
+    radsShm, rads = attachArray(radsSpec)
+    try:
+        # One extra layer lets the points at the edge of the halo be compared to their neighbors
+        low = max(start - halo - 1, 0)
+        high = min(end + halo + 1, dist.shape[0])
+        region = dist[low:high]
+        local = region.copy()
+        centers = distanceRidge(region)
+        paintSpheres(local, region, centers)
+        rads[start:end] = local[start-low:end-low]
+    finally:
+        del dist, rads, region
+        distShm.close()
+        radsShm.close()
+
+
+def distanceRidge(sq):
+    """Finds the points of a squared distance map whose sphere is not contained in the sphere of a neighboring point.
+
+    Returns the coordinates of the ridge points as a tuple of arrays.
+    """
+    import numpy as np
+    from math import isqrt
+
+    # Squared distances are integers, so the containment test can be done exactly
+    ridge = sq > 0
+    if not ridge.any():
+        return np.nonzero(ridge)
+    maxSq = int(sq.max())
+    offsets, norms, _ = offsetTable(isqrt(maxSq))
+    shape = sq.shape
+    for step in ((1, 0, 0), (1, 1, 0), (1, 1, 1)):
+        # The smallest squared radius a neighbor at this step needs to contain each sphere
+        # Radii that are never contained fit in the type of the map, so the looked up values take no more memory than it
+        reach = np.minimum(containingRadius(offsets, norms, step, maxSq), np.iinfo(sq.dtype).max).astype(sq.dtype)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for dz in (-1, 0, 1):
+                    if sorted((abs(dx), abs(dy), abs(dz)), reverse=True) != list(step):
+                        continue
+                    # Views of each point p and its neighbor q at offset (dx, dy, dz)
+                    p = tuple(slice(max(-d, 0), s - max(d, 0)) for d, s in zip((dx, dy, dz), shape))
+                    q = tuple(slice(max(d, 0), s - max(-d, 0)) for d, s in zip((dx, dy, dz), shape))
+                    ridge[p] &= sq[q] < reach[sq[p]]
+    return np.nonzero(ridge)
+
+
+def containingRadius(offsets, norms, step, maxSq):
+    """For each squared radius up to maxSq, finds the smallest squared radius of a sphere one step away that contains it.
+
+    Spheres that approxLTE can widen past their exact squared radius are never treated as contained.
+    """
+    import numpy as np
+
+    # The furthest point of each sphere from the neighbor is the running maximum over the sorted offsets
+    furthest = np.maximum.accumulate(norms - 2*(offsets @ np.array(step)) + np.dot(step, step))
+    reach = furthest[np.searchsorted(norms, np.arange(maxSq+1), side="right") - 1]
+    reach[0] = 0
+    reach[EXACT_RIDGE_LIMIT:] = np.iinfo(np.int64).max
+    return reach
+
+
+def paintSpheres(rads, sq, centers):
+    """Sets every foreground point of rads to the largest squared radius of a sphere from centers that contains it.
+
+    rads and sq are squared distance maps, rads may be sq itself.
+    Spheres are painted from the largest radius down, so a point has its final value once any sphere reaches it. Once
+    the spheres painted since the last check cover as many points as the map has, the distance from each point to the
+    nearest point no sphere has reached is found again, and spheres that can not reach such a point are skipped. In
+    open phases, such as the background of spacing, most spheres are inside the union of larger ones.
+    """
+    import numpy as np
+    from math import floor, isqrt
+
+    if not rads.flags.c_contiguous:
+        raise ValueError("Thickness map must be C-contiguous")
+    if len(centers[0]) == 0:
+        return
+    shape = np.array(rads.shape)
+    sqR = sq[centers]
+    order = np.argsort(sqR, kind="stable")[::-1]
+    centers = np.stack(centers, axis=1)[order]
+    sqR = sqR[order]
+    # The same radii as the float distance map, which the sphere tests are based on
+    r = np.sqrt(sqR, dtype=np.float64)
+    # Every sphere is a prefix of the offset table of the largest radius
+    offsets, norms, extent = offsetTable(floor(r[0]))
+    # rads is updated through a flat view, so it must be contiguous
+    flat = rads.reshape(-1)
+    strides = np.array(rads.strides) // rads.itemsize
+    # The foreground points no sphere has reached yet, and the squared distance of each point to the nearest of them
+    # when it was last found. Points are only removed, so the distances can only grow and an old distance is safe
+    unreached = rads > 0
+    unreachedFlat = unreached.reshape(-1)
+    gap = None
+    painted = 0
+    # Group the centers by radius so each group shares one sphere
+    starts = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+    ends = np.r_[starts[1:], len(r)]
+    for start, end in zip(starts, ends):
+        radius = r[start]
+        value = sqR[start]
+        limit = sphereLimit(radius)
+        sphere = offsets[:np.searchsorted(norms, limit, side="right")]
+        group = centers[start:end]
+        if painted >= GAP_RATIO*rads.size:
+            gap = squaredDistance(~unreached)
+            painted = 0
+        if gap is not None:
+            group = group[gap[tuple(group.T)] <= limit]
+            if len(group) == 0:
+                continue
+        if len(sphere) > 0 and sphere[-1] @ sphere[-1] > radius**2:
+            # Above EXACT_RIDGE_LIMIT the tolerance can reach past the cube used by bruteSpheres
+            sphere = sphere[extent[:len(sphere)] <= floor(radius)]
+        elif len(group)*len(sphere) > DILATE_RATIO*boxSize(group, isqrt(limit), shape):
+            # Large spheres that overlap each other are cheaper to paint all at once
+            painted += dilateSpheres(rads, unreached, group, value, limit)
+            continue
+        # Spheres that stay inside the volume can be painted with flat indices, the rest are clipped to the edges
+        inside = np.all((group >= floor(radius)) & (group < shape - floor(radius)), axis=1)
+        flatSphere = sphere @ strides
+        # Limit the batch size so that the candidate points fit in memory
+        step = max(1, BATCH_POINTS // len(sphere))
+        interior = np.ravel_multi_index(tuple(group[inside].T), rads.shape)
+        for s in range(0, len(interior), step):
+            points = (interior[s:s+step, None] + flatSphere[None, :]).ravel()
+            paint(flat, unreachedFlat, points, value)
+            painted += len(points)
+        edge = group[~inside]
+        for s in range(0, len(edge), step):
+            # The coordinates along each axis are checked separately, which is faster than one check of all three
+            coords = [(edge[s:s+step, axis, None] + sphere[None, :, axis]).ravel() for axis in range(3)]
+            valid = np.ones(len(coords[0]), dtype=bool)
+            for c, size in zip(coords, rads.shape):
+                valid &= (c >= 0) & (c < size)
+            points = np.ravel_multi_index(tuple(c[valid] for c in coords), rads.shape)
+            paint(flat, unreachedFlat, points, value)
+            painted += len(points)
+
+
+def boxSize(centers, reach, shape):
+    """Counts the voxels of the box around centers that spheres reaching reach voxels from them can touch."""
+    import numpy as np
+
+    low = np.maximum(centers.min(axis=0) - reach, 0)
+    high = np.minimum(centers.max(axis=0) + reach + 1, shape)
+    return int(np.prod(high - low))
+
+
+def dilateSpheres(rads, unreached, centers, value, limit):
+    """Raises the foreground points within squared distance limit of any of the centers to value, like paintSpheres.
+
+    The squared distance of each point of the box around the spheres to the nearest center is exact, so this paints
+    the same points as painting the sphere of each center. The painted points are removed from unreached.
+    Returns the number of points in the box.
+    """
+    import numpy as np
+    from math import isqrt
+
+    reach = isqrt(limit)
+    low = np.maximum(centers.min(axis=0) - reach, 0)
+    high = np.minimum(centers.max(axis=0) + reach + 1, rads.shape)
+    box = tuple(slice(l, h) for l, h in zip(low, high))
+    # The centers are the points outside the mask, so each point gets its squared distance to the nearest center
+    seeds = np.ones(high - low, dtype=bool)
+    seeds[tuple((centers - low).T)] = False
+    covered = squaredDistance(seeds) <= limit
+    del seeds
+    roi = rads[box]
+    covered &= roi > 0
+    roi[covered] = np.maximum(roi[covered], value)
+    unreached[box] &= ~covered
+    return covered.size
+
+
+def paint(flat, unreachedFlat, points, value):
+    """Raises the foreground points at the flat indices to value, and removes them from the unreached points."""
+    import numpy as np
+
+    roi = flat[points]
+    # Only points inside the shape are updated, all points share the same value so repeated indices are safe
+    flat[points] = np.where(roi > 0, np.maximum(roi, value), roi)
+    unreachedFlat[points] = False
+
+
+def sphereLimit(r):
+    """Finds the largest integer squared length that approxLTE accepts as inside radius r."""
+    from math import floor
+
+    limit = floor(r**2 * 1.00001 + 1e-8)
+    while limit > 0 and not approxLTE(limit, r**2):
+        limit -= 1
+    while approxLTE(limit+1, r**2):
+        limit += 1
+    return limit
+
+
+@lru_cache(maxsize=4)
+def offsetTable(rf):
+    """Gets the offsets of every sphere with integer radius up to rf, sorted by squared length.
+
+    Returns the offsets, their squared lengths and their largest absolute coordinate.
+    """
+    import numpy as np
+
+    # The offsets are made as int32, so no int64 cube is created
+    offsets = np.indices((2*rf+1,)*3, dtype=np.int32).reshape(3, -1).T - rf
+    norms = np.sum(offsets.astype(np.int64)**2, axis=1)
+    # Drop the corners of the cube that no sphere of radius below rf+1 can reach
+    keep = norms <= sphereLimit(rf+1)
+    offsets = offsets[keep]
+    norms = norms[keep]
+    order = np.argsort(norms, kind="stable")
+    offsets = offsets[order]
+    norms = norms[order]
+    extent = np.max(np.abs(offsets), axis=1)
+    for a in (offsets, norms, extent):
+        a.setflags(write=False)
+    return offsets, norms, extent
+
+
 def approxLTE(a, b):
     # Peforms array elementwise less than or equal comparisons with some tolerance for floating point values
     import numpy as np
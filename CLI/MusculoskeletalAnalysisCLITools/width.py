@@ -1,75 +1,69 @@
 """Calculates the width of a 2d shape using rotating calipers method."""
 
 
-def crossProduct(a,b,c):
-    return ((b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0]))
+def edges(mask):
+    """Finds the edge of each slice of a mask along its last axis.
 
+    A point is on the edge if it differs from one of its 4 neighbors in the slice, so the edge has the points of the
+    shape next to the outside and the points outside next to the shape. Points past the sides of the slice are outside.
+    Returns a binary array the same shape as the mask.
+    """
+    import numpy as np
+
+    padded = np.pad(mask, [(1, 1), (1, 1)] + [(0, 0)]*(mask.ndim - 2))
+    center = padded[1:-1, 1:-1]
+    same = (padded[:-2, 1:-1] == center) & (padded[2:, 1:-1] == center) & (padded[1:-1, :-2] == center) & (padded[1:-1, 2:] == center)
+    return np.invert(same)
+
+
+def edge(img):
+    """Finds the coordinates of the points on the edge of a 2d mask."""
+    import numpy as np
 
-def convexHull(pts):
-    """Finds the points on the convex hull.
+    return np.argwhere(edges(img))
 
-    Prereq: The points must be sorted left to right and top to bottom
+
+def hullDiameter(pts):
+    """Finds the largest distance between two points, the width of their convex hull between its farthest calipers.
+
+    Only the vertices of the hull can be farthest apart, so the distances between every pair of them are compared at
+    once. Points that all lie on a line have no hull, and their ends are used instead.
     """
+    import numpy as np
+    from scipy.spatial import ConvexHull, QhullError
 
-    hull = []
-    n = len(pts)
-    # Add points from left to right, remove any that make a clockwise turn
-    for p in pts:
-        while len(hull) >= 2 and crossProduct(hull[-2], hull[-1], p) <= 0:
-            hull.pop()
-        hull.append(p)
-    # Repeat from right to left to fill out the bottom of the hull
-    for p in pts[n-2:-1:-1]:
-        while len(hull) >= 2 and crossProduct(hull[-2], hull[-1], p) <= 0:
-            hull.pop()
-        hull.append(p)
-    # Exclude the last point because it is same as the first
-    return hull[:-1]
-
-
-def rotatingCaliper(pts):
-    import math
-
-    hull = convexHull(pts)
-    n = len(hull)
-
-    if n <= 1:
-        return 0
-    if n == 2:
-        return math.sqrt((hull[0][0]-hull[1][0])**2+(hull[1][0]-hull[1][1])**2)
-    k = 1
-    # Find the furthest point
-    while crossProduct(hull[n - 1], hull[0], hull[(k + 1) % n]) > crossProduct(hull[n - 1], hull[0], hull[k]):
-        k += 1
-
-    res = 0
-
-    # For each point between 0 and k find the opposite point j
-    for i in range(k + 1):
-        j = (i + 1) % n
-        while crossProduct(hull[i], hull[(i + 1) % n], hull[(j + 1) % n]) > crossProduct(hull[i], hull[(i + 1) % n], hull[j]):
-            j = (j + 1) % n
-            res = max(res, math.sqrt((hull[i][0]-hull[j][0])**2+(hull[i][0]-hull[j][1])**2))
-
-    return res
+    if len(pts) < 2:
+        return 0.0
+    try:
+        hull = pts[ConvexHull(pts).vertices]
+    except QhullError:
+        order = np.lexsort(pts.T[::-1])
+        hull = pts[order[[0, -1]]]
+    hull = hull.astype(np.float64)
+    offsets = hull[:, None, :] - hull[None, :, :]
+    return float(np.sqrt(np.max(np.einsum("ijk,ijk->ij", offsets, offsets))))
 
 
-def edge(img):
+def sliceWidths(mask, workers=1):
+    """Calculates the width of the shape in each slice of a mask along its last axis, using rotating calipers method.
+
+    The edges of every slice are found at once, then the slices are measured by a pool of workers threads.
+    Returns an array of the width of each slice, in voxels, and the index of the widest slice.
+    """
     import numpy as np
-    from scipy.ndimage import convolve
+    from concurrent.futures import ThreadPoolExecutor
 
-    filt = [[0,-1,0],
-              [-1,4,-1],
-              [0,-1,0]]
-    return np.argwhere(convolve(img ,filt, mode='constant') >= 1)
+    edge = edges(mask)
+    measure = lambda i: hullDiameter(np.argwhere(edge[:, :, i]))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            widths = np.array(list(pool.map(measure, range(mask.shape[2]))), dtype=np.float64)
+    else:
+        widths = np.array([measure(i) for i in range(mask.shape[2])], dtype=np.float64)
+    return widths, int(np.argmax(widths)) if len(widths) > 0 else 0
 
 
 def width(mask):
     """Calculates the width of a 2d shape using rotating calipers method."""
-    n = mask.shape[2]
-    maxw = 0
-    for i in range(n):
-        pts = edge(mask[:,:,i])
-        w = rotatingCaliper(pts)
-        maxw = max(maxw, w)
-    return maxw
+    (widths, widest) = sliceWidths(mask)
+    return widths[widest] if len(widths) > 0 else 0
@@ -0,0 +1,166 @@
+"""A persistent process that keeps the analysis libraries imported and runs the CLI modules for each job it is sent.
+
+Starting a CLI module imports numpy, SimpleITK, scipy, scikit-image and trimesh again each time, which takes most of
+the time of analyzing a small region. The worker imports them once, then runs the main function of a CLI module for
+each job, so the Slicer module can start an analysis without starting a new process.
+
+Usage: python -m MusculoskeletalAnalysisCLITools.worker <address>
+The authentication key is read from the first line of stdin as hex. The worker stops when it is sent None as a job.
+"""
+import os
+import sys
+
+# The libraries imported before the first job, if they are installed
+PRELOAD = ("numpy", "scipy.ndimage", "scipy.spatial", "skimage.measure", "SimpleITK", "nrrd", "trimesh")
+
+
+def serve(address, authkey, preload=PRELOAD):
+    """Runs the jobs sent to the address one at a time, until a client sends None.
+
+    Each job is a tuple of a CLI module name, such as "CorticalAnalysis", and the arguments and keyword arguments of
+    its main function. The progress the module prints is sent back as ("progress", fraction), and the job ends with
+    ("done", None) or ("error", traceback).
+    """
+    from multiprocessing import AuthenticationError
+    from multiprocessing.connection import Listener
+
+    warm(preload)
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            try:
+                connection = listener.accept()
+            except (AuthenticationError, EOFError):
+                # A client without the key, or one that closed the connection while it was checked, does not stop the worker
+                continue
+            with connection:
+                try:
+                    job = connection.recv()
+                except EOFError:
+                    continue
+                if job is None:
+                    return
+                try:
+                    runJob(connection, *job)
+                except OSError:
+                    # The client closed the connection, which stops its job at the next progress it reports
+                    pass
+
+
+def warm(modules):
+    """Imports the modules that are installed, so jobs do not have to."""
+    import importlib
+
+    for module in modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+
+def runJob(connection, moduleName, args, kwargs):
+    """Runs the main function of a CLI module, sending its progress and result to the client."""
+    import contextlib
+    import traceback
+
+    from .batch import importAnalysis
+
+    try:
+        module = importAnalysis(moduleName)
+        with contextlib.redirect_stdout(ProgressWriter(connection, sys.stdout)):
+            module.main(*args, **kwargs)
+    except Exception:
+        connection.send(("error", traceback.format_exc()))
+    else:
+        connection.send(("done", None))
+
+
+class ProgressWriter:
+    """Sends the <filter-progress> lines printed by a CLI module to the client, and writes other output to stream."""
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+        # print writes the end of the line separately from the progress before it
+        self.afterProgress = False
+
+    def write(self, text):
+        import re
+
+        if self.afterProgress and text.startswith("\n"):
+            text = text[1:]
+        values = re.findall(r"<filter-progress>(.*?)</filter-progress>", text)
+        for value in values:
+            self.connection.send(("progress", float(value)))
+        if values:
+            text = re.sub(r"<filter-progress>.*?</filter-progress>\n?", "", text)
+            self.afterProgress = True
+        elif text:
+            self.afterProgress = False
+        if text:
+            self.stream.write(text)
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def submit(address, authkey, moduleName, args=(), kwargs=None):
+    """Sends a job to the worker listening at the address.
+
+    Returns the connection to pass to wait. Raises OSError if no worker is listening.
+    """
+    from multiprocessing.connection import Client
+
+    try:
+        connection = Client(address, authkey=authkey)
+    except EOFError as e:
+        raise OSError("The worker at " + str(address) + " closed the connection") from e
+    connection.send((moduleName, tuple(args), dict(kwargs or {})))
+    return connection
+
+
+def wait(connection, progress=None):
+    """Waits for a job sent with submit to finish, calling progress with each fraction of it that is done.
+
+    Raises RuntimeError with the traceback of the job if it fails.
+    """
+    with connection:
+        while True:
+            try:
+                (kind, value) = connection.recv()
+            except EOFError:
+                raise RuntimeError("The worker stopped before the job finished")
+            if kind == "progress":
+                if progress is not None:
+                    progress(value)
+            elif kind == "error":
+                raise RuntimeError(value)
+            else:
+                return
+
+
+def stop(address, authkey):
+    """Stops the worker listening at the address, if there is one."""
+    from multiprocessing.connection import Client
+
+    try:
+        with Client(address, authkey=authkey) as connection:
+            connection.send(None)
+    except (OSError, EOFError):
+        pass
+
+
+def workerAddress(name):
+    """Gets an address for a worker that is private to this user, a named pipe on Windows or a Unix socket elsewhere."""
+    import tempfile
+
+    if sys.platform == "win32":
+        return r"\\.\pipe\{}-{}".format(name, os.getpid())
+    return os.path.join(tempfile.mkdtemp(prefix=name + "-"), "worker.sock")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m MusculoskeletalAnalysisCLITools.worker <address>")
+        sys.exit(1)
+    serve(sys.argv[1], bytes.fromhex(sys.stdin.readline().strip()))
@@ -1,38 +1,206 @@
+import contextlib
+import os
 import os.path
 import numpy as np
 
+# Formats that can be written next to the report, and the extension of each
+COLUMNAR_FORMATS = {"parquet": ".parquet", "hdf5": ".h5"}
+# The python module each columnar format is written with
+COLUMNAR_MODULES = {"parquet": "pyarrow.parquet", "hdf5": "h5py"}
+
 # Writes data to a tab seperated format
 # filepath: The filename and path of the file to write to
 # header: A list of collumn names, written as the first line if this is a new file
 # data: A list of data elements, each element can be single or a numpy ndarray
-def writeReport(filepath, header, data):
+# columnar: "parquet" or "hdf5" to also write the data as one row of typed columns to a file next to the report
+def writeReport(filepath, header, data, columnar=None):
+    with ReportSink(filepath, header, columnar) as sink:
+        sink.add(data)
+
+
+# Collects rows of a report and writes them all at once when flushed or when the with block ends
+# Writes are made under a lock, so analyses running at the same time can share an output directory
+class ReportSink:
+    def __init__(self, filepath, header, columnar=None):
+        checkColumnar(columnar)
+        self.filepath = filepath
+        self.header = list(header)
+        self.columnar = columnar
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        # Rows from an analysis that failed are not written
+        if excType is None:
+            self.flush()
+
+    # Adds one row, a list of data elements like writeReport takes
+    def add(self, data):
+        self.rows.append(list(data))
+
+    # Writes the collected rows
+    # The text report is written last, since resuming a batch skips the rows already in it
+    def flush(self):
+        with lockReport(self.filepath):
+            if self.columnar == "parquet" and len(self.rows) > 0:
+                appendParquet(self.filepath, self.header, self.rows)
+            elif self.columnar == "hdf5" and len(self.rows) > 0:
+                appendHdf5(self.filepath, self.header, self.rows)
+            if len(self.rows) > 0 or not os.path.exists(self.filepath):
+                appendText(self.filepath, formatRows(self.header, self.rows, not os.path.exists(self.filepath)))
+        self.rows = []
+
+
+# Checks that a columnar format is known and that the python module it is written with is installed
+# Called before an analysis writes anything, so a missing module does not leave some of its reports written
+def checkColumnar(columnar):
+    import importlib
+
+    if columnar is None:
+        return
+    if columnar not in COLUMNAR_FORMATS:
+        raise ValueError("Unknown columnar format " + str(columnar))
+    try:
+        importlib.import_module(COLUMNAR_MODULES[columnar])
+    except ImportError as e:
+        raise ImportError("Writing " + columnar + " reports requires the " + COLUMNAR_MODULES[columnar].split(".")[0] + " python package") from e
+
+
+# Formats rows as tab seperated text
+# If a row contains ndarray it takes multiple lines, skipping over collumns that are not ndarray
+def formatRows(header, rows, newFile):
+    lines = []
+    if newFile and len(header) > 0:
+        lines.append("\t".join(header))
+    for data in rows:
+        if len(data) > 0:
+            maxLength = max(numEl(d) for d in data)
+            for i in range(maxLength):
+                line = []
+                for d in data:
+                    if numEl(d) > i:
+                        line.append(str(d[i]) if isinstance(d, np.ndarray) else str(d))
+                    else:
+                        line.append("")
+                lines.append("\t".join(line))
+    return "".join(line + "\n" for line in lines)
+
+
+# Adds text to the end of a file in a single write
+# A new file is created with its header in the same write, under the report lock, so other writers never see it without
+# its header. It is created with the permissions of the umask, like other files the analysis writes
+def appendText(filepath, text):
     if os.path.exists(filepath):
-        # If the file exist open and append to it
-        fOut = open(filepath, "a")
+        handle = os.open(filepath, os.O_WRONLY | os.O_APPEND)
     else:
-        # If the file does not exist create it and write header
-        fOut = open(filepath, "w")
-        if len(header) > 0:
-            for h in header[:-1]:
-                fOut.write(h+"\t")
-            fOut.write(header[-1]+"\n")
-    if len(data) > 0:
-        # Write the data
-        # If data contains ndarray write multiple lines, skipping over collumns that are not ndarray
-        maxLength = max(numEl(d) for d in data)
-        for i in range(maxLength):
-            for j in range(len(data)):
-                d = data[j]
-                if numEl(d) > i:
-                    if isinstance(d, np.ndarray):
-                        fOut.write(str(d[i]))
-                    else:
-                        fOut.write(str(d))
-                if j < len(data)-1:
-                    fOut.write("\t")
+        handle = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    with os.fdopen(handle, "w") as fOut:
+        fOut.write(text)
+        fOut.flush()
+        os.fsync(fOut.fileno())
+
+
+# Holds an advisory lock on a report until the with block ends
+# The lock is taken on a hidden file next to the report, which is left in place so every process locks the same file
+@contextlib.contextmanager
+def lockReport(filepath):
+    lockPath = os.path.join(os.path.dirname(os.path.abspath(filepath)), "." + os.path.basename(filepath) + ".lock")
+    with open(lockPath, "a+") as lock:
+        if os.name == "nt":
+            import msvcrt
+            lock.seek(0)
+            while True:
+                # Each attempt waits up to 10 seconds, so keep trying until the other process is done
+                try:
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                lock.seek(0)
+                msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+# Appends rows to a Parquet dataset next to the report, with ndarray elements stored as lists of floats
+# Parquet files can not be added to, so each flush writes its rows to a new part file in a directory with the name of
+# the report, which pyarrow.parquet.read_table reads as one table
+def appendParquet(filepath, header, rows):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = os.path.splitext(filepath)[0] + COLUMNAR_FORMATS["parquet"]
+    columns = {}
+    for j, name in enumerate(header):
+        values = [columnValue(row[j]) for row in rows]
+        if isinstance(values[0], np.ndarray):
+            columns[name] = pa.array([v.tolist() for v in values], type=pa.list_(pa.float64()))
+        elif isinstance(values[0], str):
+            columns[name] = pa.array(values, type=pa.string())
+        else:
+            columns[name] = pa.array(values, type=pa.float64())
+    table = pa.table(columns)
+    if os.path.isfile(path):
+        # A report written as a single file becomes the first part
+        temp = path + ".tmp"
+        os.replace(path, temp)
+        os.makedirs(path)
+        os.replace(temp, os.path.join(path, "part-00000.parquet"))
+    os.makedirs(path, exist_ok=True)
+    parts = sorted(name for name in os.listdir(path) if name.startswith("part-") and name.endswith(".parquet"))
+    if len(parts) > 0:
+        # Every part has the types of the first, so they can be read as one table
+        table = table.cast(pq.read_schema(os.path.join(path, parts[0])))
+    # Files starting with "." are not read as parts, so a part is never read before it is complete
+    temp = os.path.join(path, ".part.tmp")
+    pq.write_table(table, temp)
+    os.replace(temp, os.path.join(path, "part-{:05d}.parquet".format(len(parts))))
+
+
+# Appends rows to an HDF5 file next to the report, with one dataset for each collumn
+# ndarray elements are stored as variable length arrays of floats, "/" in collumn names is replaced with "|"
+def appendHdf5(filepath, header, rows):
+    import h5py
+
+    path = os.path.splitext(filepath)[0] + COLUMNAR_FORMATS["hdf5"]
+    with h5py.File(path, "a") as f:
+        for j, name in enumerate(header):
+            values = [columnValue(row[j]) for row in rows]
+            key = name.replace("/", "|")
+            if key not in f:
+                if isinstance(values[0], np.ndarray):
+                    dtype = h5py.vlen_dtype(np.float64)
+                elif isinstance(values[0], str):
+                    dtype = h5py.string_dtype()
                 else:
-                    fOut.write("\n")
-    fOut.close()
+                    dtype = np.float64
+                f.create_dataset(key, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+            dataset = f[key]
+            start = len(dataset)
+            dataset.resize((start + len(values),))
+            for i, v in enumerate(values):
+                dataset[start + i] = v
+        f.flush()
+
+
+# Converts a data element to a float, a string or a 1D float ndarray
+def columnValue(d):
+    if isinstance(d, np.ndarray):
+        return np.asarray(d, dtype=np.float64).ravel()
+    if isinstance(d, (int, float, np.number)):
+        return float(d)
+    return str(d)
+
 
 # Gets the number of elements in a datapoint,
 # Returns the length of ndarray or 1
@@ -40,4 +208,4 @@ def numEl(d):
     if isinstance(d, np.ndarray):
         return len(d)
     else:
-        return 1
\ No newline at end of file
+        return 1
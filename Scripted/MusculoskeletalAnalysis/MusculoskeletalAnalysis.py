@@ -1,5 +1,6 @@
 import logging
 import os
+import sys
 import time
 import vtk
 import importlib
@@ -285,6 +286,9 @@ class MusculoskeletalAnalysisWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.ui.analysisSelector.connect("currentTextChanged(const QString)", self.updateParameterNodeFromGUI)
         self.ui.DICOMOptions.connect("buttonClicked(QAbstractButton*)", self.updateParameterNodeFromGUI)
         self.ui.DICOMSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.DICOMSeriesChanged)
+        self.ui.InProcessCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.WorkerCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
+        self.ui.WorkerCheckBox.connect("toggled(bool)", self.onWorkerToggled)
         self.ui.voxelSizeLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
         self.ui.scalingLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
         self.ui.densitySlopeLineEdit.connect("editingFinished()", self.updateParameterNodeFromGUI)
@@ -298,17 +302,58 @@ class MusculoskeletalAnalysisWidget(ScriptedLoadableModuleWidget, VTKObservation
 
         # Hidden elements
         self.ui.AnalysisProgress.hide()
+        self.setupQueue()
         # Make sure parameter node is initialized (needed for module reload)
         self.initializeParameterNode()
 
 
 
 
+    def setupQueue(self):
+        """
+        Adds the section that queues analyses to run several of them at a time.
+        """
+        import ctk
+        import qt
+
+        self.queue = MusculoskeletalAnalysisQueue(self.logic, onChange=self.queueUpdate)
+        # Queued jobs wait for analyses started with Apply, and start when they finish
+        self.logic.onAnalysisEnd = self.queue.startJobs
+        queueCollapsibleButton = ctk.ctkCollapsibleButton()
+        queueCollapsibleButton.text = "Queue"
+        self.layout.addWidget(queueCollapsibleButton)
+        queueLayout = qt.QVBoxLayout(queueCollapsibleButton)
+
+        self.queueTable = qt.QTableWidget(0, 3)
+        self.queueTable.setHorizontalHeaderLabels(["Job", "Status", "Progress"])
+        self.queueTable.horizontalHeader().setSectionResizeMode(0, qt.QHeaderView.Stretch)
+        self.queueTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+        self.queueTable.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+        self.queueTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        queueLayout.addWidget(self.queueTable)
+
+        buttonLayout = qt.QHBoxLayout()
+        queueLayout.addLayout(buttonLayout)
+        for (text, toolTip, slot) in (
+            ("Add to Queue", "Queue the selected analysis of the selected segment", self.onAddToQueue),
+            ("Move Up", "Start the selected job earlier", lambda: self.moveSelectedJob(-1)),
+            ("Move Down", "Start the selected job later", lambda: self.moveSelectedJob(1)),
+            ("Cancel", "Remove the selected job from the queue, or stop it if it is running", self.onCancelJob),
+            ("Clear Finished", "Remove the finished jobs from the list", self.queue.removeFinished),
+        ):
+            button = qt.QPushButton(text)
+            button.toolTip = toolTip
+            button.connect('clicked(bool)', lambda checked, slot=slot: slot())
+            buttonLayout.addWidget(button)
+
     def cleanup(self):
         """
         Called when the application closes and the module widget is destroyed.
         """
         self.removeObservers()
+        self.queue.cancelAll()
+        if self.logic:
+            self.logic.stopWorker()
 
     def enter(self):
         """
@@ -421,6 +466,8 @@ class MusculoskeletalAnalysisWidget(ScriptedLoadableModuleWidget, VTKObservation
         self.ui.analysisSelector.setCurrentText(str(self._parameterNode.GetParameter("Analysis")))
         self.ui.AlternateDICOMCheckBox.setChecked(self._parameterNode.GetParameter("UseAlt")=="True")
         self.ui.ManualDICOMCheckBox.setChecked(self._parameterNode.GetParameter("UseMan")=="True")
+        self.ui.InProcessCheckBox.setChecked(self._parameterNode.GetParameter("InProcess")=="True")
+        self.ui.WorkerCheckBox.setChecked(self._parameterNode.GetParameter("UseWorker")=="True")
         self.ui.DICOMSelector.setCurrentNode(self._parameterNode.GetNodeReference("DICOMNode"))
         self.ui.voxelSizeLineEdit.setText(self._parameterNode.GetParameter("0018,0050"))
         self.ui.scalingLineEdit.setText(self._parameterNode.GetParameter("0029,1000"))
@@ -529,6 +576,8 @@ class MusculoskeletalAnalysisWidget(ScriptedLoadableModuleWidget, VTKObservation
         self._parameterNode.SetParameter("Analysis", str(self.ui.analysisSelector.currentText))
         self._parameterNode.SetParameter("UseAlt", str(self.ui.AlternateDICOMCheckBox.checked))
         self._parameterNode.SetParameter("UseMan", str(self.ui.ManualDICOMCheckBox.checked))
+        self._parameterNode.SetParameter("InProcess", str(self.ui.InProcessCheckBox.checked))
+        self._parameterNode.SetParameter("UseWorker", str(self.ui.WorkerCheckBox.checked))
         self.setNumParameter("0018,0050", str(self.ui.voxelSizeLineEdit.text))
         self.setNumParameter("0029,1000", str(self.ui.scalingLineEdit.text))
         self.setNumParameter("0029,1004", str(self.ui.densitySlopeLineEdit.text))
@@ -556,6 +605,13 @@ class MusculoskeletalAnalysisWidget(ScriptedLoadableModuleWidget, VTKObservation
             self._parameterNode.SetParameter(parameter, "")
 
 
+    def onWorkerToggled(self, checked):
+        """
+        Start importing the analysis libraries in the worker process as soon as it is selected.
+        """
+        if checked:
+            self.logic.startWorker()
+
     def onApplyButton(self):
         """
         Run processing when user clicks "Apply" button.
@@ -565,36 +621,95 @@ class MusculoskeletalAnalysisWidget(ScriptedLoadableModuleWidget, VTKObservation
             self.logic.process(self._parameterNode.GetNodeReference("InputVolume"), self._parameterNode.GetNodeReference("SegmentNode"), self._parameterNode.GetParameter("SegmentID"),
                                self.ui.thresholdSelector.lowerThreshold,  self.ui.thresholdSelector.upperThreshold, self.ui.analysisSelector.currentText, self.ui.outputDirectorySelector.currentPath,
                                self.ui.AlternateDICOMCheckBox.checked, self._parameterNode.GetNodeReference("DICOMNode"), self.ui.ManualDICOMCheckBox.checked,
-                               {'0018,0050':self.ui.voxelSizeLineEdit.text, '0029,1000':self.ui.scalingLineEdit.text, '0029,1004':self.ui.densitySlopeLineEdit.text, '0029,1005':self.ui.densityInterceptLineEdit.text, '0028,1053':self.ui.rescaleSlopeLineEdit.text, '0028,1052':self.ui.rescaleInterceptLineEdit.text}, self)
+                               {'0018,0050':self.ui.voxelSizeLineEdit.text, '0029,1000':self.ui.scalingLineEdit.text, '0029,1004':self.ui.densitySlopeLineEdit.text, '0029,1005':self.ui.densityInterceptLineEdit.text, '0028,1053':self.ui.rescaleSlopeLineEdit.text, '0028,1052':self.ui.rescaleInterceptLineEdit.text}, self,
+                               inProcess=self.ui.InProcessCheckBox.checked, useWorker=self.ui.WorkerCheckBox.checked)
         self.updateGUIFromParameterNode()
 
 
 
 
+    def onAddToQueue(self):
+        """
+        Add the selected analysis to the queue when user clicks "Add to Queue" button.
+        """
+        with slicer.util.tryWithErrorDisplay("Failed to queue analysis.", waitCursor=True):
+            job = self.logic.createJob(self._parameterNode.GetNodeReference("InputVolume"), self._parameterNode.GetNodeReference("SegmentNode"), self._parameterNode.GetParameter("SegmentID"),
+                                       self.ui.thresholdSelector.lowerThreshold,  self.ui.thresholdSelector.upperThreshold, self.ui.analysisSelector.currentText, self.ui.outputDirectorySelector.currentPath,
+                                       self.ui.AlternateDICOMCheckBox.checked, self._parameterNode.GetNodeReference("DICOMNode"), self.ui.ManualDICOMCheckBox.checked,
+                                       {'0018,0050':self.ui.voxelSizeLineEdit.text, '0029,1000':self.ui.scalingLineEdit.text, '0029,1004':self.ui.densitySlopeLineEdit.text, '0029,1005':self.ui.densityInterceptLineEdit.text, '0028,1053':self.ui.rescaleSlopeLineEdit.text, '0028,1052':self.ui.rescaleInterceptLineEdit.text})
+            self.queue.add(job)
+
+    def selectedJob(self):
+        row = self.queueTable.currentRow()
+        if row < 0 or row >= len(self.queue.jobs):
+            return None
+        return self.queue.jobs[row]
+
+    def moveSelectedJob(self, offset):
+        job = self.selectedJob()
+        if job:
+            self.queue.move(job, offset)
+            self.queueTable.selectRow(self.queue.jobs.index(job))
+
+    def onCancelJob(self):
+        job = self.selectedJob()
+        if job:
+            self.queue.cancel(job)
+
+    # Shows the status and progress of the queued jobs
+    # job: The job that changed, or None if finished jobs were removed
+    def queueUpdate(self, job):
+        import qt
+
+        # Every row is updated, since jobs may have been added, removed or moved
+        self.queueTable.setRowCount(len(self.queue.jobs))
+        for (row, job) in enumerate(self.queue.jobs):
+            self.queueTable.setItem(row, 0, qt.QTableWidgetItem(job.name()))
+            status = qt.QTableWidgetItem(job.status)
+            if job.error:
+                status.setToolTip(job.error)
+            self.queueTable.setItem(row, 1, status)
+            progress = self.queueTable.cellWidget(row, 2)
+            if progress is None:
+                progress = qt.QProgressBar()
+                self.queueTable.setCellWidget(row, 2, progress)
+            progress.setValue(job.progress)
+
     # Updates
     def analysisUpdate(self, cliNode, event):
         if cliNode.GetStatus() & cliNode.Completed:
-            self.ui.AnalysisProgress.setValue(100)
-            self.ui.AnalysisProgress.hide()
-            if cliNode.GetStatus() & cliNode.ErrorsMask:
-                # error
-                errorText = cliNode.GetErrorText()
-                print("CLI execution failed: " + errorText)
-            else:
-                # success
-                print("CLI execution succeeded.")
-            startTime=float(self._parameterNode.GetParameter("startTime"))
-            stopTime = time.time()
-            logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
-            # Clean up temp nodes
-            slicer.mrmlScene.RemoveNode(self._parameterNode.GetNodeReference("labelmapNode"))
-            slicer.mrmlScene.RemoveNode(self._parameterNode.GetNodeReference("labelmapNode2"))
+            self.analysisFinished(cliNode.GetErrorText() if cliNode.GetStatus() & cliNode.ErrorsMask else None)
             slicer.mrmlScene.RemoveNode(cliNode)
-            self._parameterNode.SetParameter("Analyzing", "False")
-            self.updateGUIFromParameterNode()
         else:
             self.ui.AnalysisProgress.setValue(cliNode.GetProgress())
 
+    # Updates the progress of an analysis run by the worker process
+    # progress: The percent of the analysis that is done
+    def workerUpdate(self, progress):
+        self.ui.AnalysisProgress.setValue(progress)
+
+    # Cleans up after an analysis run by the CLI module or the worker process
+    # errorText: The error of the analysis, or None if it succeeded
+    def analysisFinished(self, errorText=None):
+        self.ui.AnalysisProgress.setValue(100)
+        self.ui.AnalysisProgress.hide()
+        if errorText is not None:
+            # error
+            print("CLI execution failed: " + errorText)
+        else:
+            # success
+            print("CLI execution succeeded.")
+        startTime=float(self._parameterNode.GetParameter("startTime"))
+        stopTime = time.time()
+        logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
+        if errorText is None:
+            self.logic.logProfile(self._parameterNode.GetParameter("profileFile"))
+        # Clean up temp nodes
+        slicer.mrmlScene.RemoveNode(self._parameterNode.GetNodeReference("labelmapNode"))
+        slicer.mrmlScene.RemoveNode(self._parameterNode.GetNodeReference("labelmapNode2"))
+        self._parameterNode.SetParameter("Analyzing", "False")
+        self.updateGUIFromParameterNode()
+
 
 
 
@@ -613,11 +728,30 @@ class MusculoskeletalAnalysisLogic(ScriptedLoadableModuleLogic):
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
+    # The python modules each analysis requires, as (moduleName, pipName)
+    REQUIREMENTS = {
+        "Cortical Bone": [('scipy', 'scipy'), ('skimage', 'scikit-image'), ('nrrd', 'pynrrd')],
+        "Cancellous Bone": [('scipy', 'scipy'), ('skimage', 'scikit-image'), ('nrrd', 'pynrrd'), ('trimesh', 'trimesh')],
+        "Bone Density": [('nrrd', 'pynrrd')],
+        "Intervertebral Disc": [('scipy', 'scipy'), ('nrrd', 'pynrrd')],
+    }
+
     def __init__(self):
         """
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        # The worker process, its address and its authentication key
+        self.worker = None
+        # The timers showing the progress of the analyses running in the worker
+        self.workerTimers = []
+        # The python modules already found by importRequest
+        self.foundModules = set()
+        # The estimated megabytes of each analysis started by process that is still running, by its ID
+        self.analyses = {}
+        self.lastAnalysisID = 0
+        # Called when an analysis started by process finishes, so queued jobs can start
+        self.onAnalysisEnd = None
 
     def setDefaultParameters(self, parameterNode):
         """
@@ -626,16 +760,135 @@ class MusculoskeletalAnalysisLogic(ScriptedLoadableModuleLogic):
         if not parameterNode.GetParameter("Analysis"):
             parameterNode.SetParameter("Analysis", "Cortical Bone")
 
-    def process(self, inputVolume, mask, maskLabel, lowerThreshold, upperThreshold, analysis, outputDirectory, altDICOM=False, DICOMNode=None, manDICOM=False, DICOMOptions=None, source=None, wait=False):
+    def process(self, inputVolume, mask, maskLabel, lowerThreshold, upperThreshold, analysis, outputDirectory, altDICOM=False, DICOMNode=None, manDICOM=False, DICOMOptions=None, source=None, wait=False, workers=None, inProcess=False, useWorker=False):
         """
         Run the processing algorithm.
         Can be used without GUI widget.
         :param InputVolume: volume to be thresholded
         :param Analysis: analysis function to perform
         :param OutputDirectory: directory to write output files to
+        :param workers: number of processes used to calculate thickness, defaults to the number of cores, or to 1 in the Slicer process so the Slicer application is not forked
+        :param inProcess: run the analysis in the Slicer process on the loaded arrays instead of through the CLI module
+        :param useWorker: run the analysis in the worker process, which has the analysis libraries already imported, instead of starting the CLI module. The CLI module is used if the worker can not be started. Off by default, since the worker is a process that stays running outside of Slicer's CLI framework
         """
 
-        # Check inputs
+        self.checkInputs(inputVolume, mask, maskLabel, outputDirectory, altDICOM, DICOMNode, manDICOM, DICOMOptions)
+
+        if workers is None:
+            workers = 1 if inProcess else os.cpu_count() or 1
+
+        startTime = time.time()
+        logging.info('Processing started')
+
+        # Install required python modules
+        self.importRequest(self.REQUIREMENTS[analysis])
+
+        (voxelSize, slope, intercept) = self.calibration(inputVolume, analysis, altDICOM, DICOMNode, manDICOM, DICOMOptions)
+        labelmaps = self.exportLabelmaps(inputVolume, mask, maskLabel, analysis)
+        labelmap = labelmaps[0]
+        if len(labelmaps) > 1:
+            labelmap2 = labelmaps[1]
+        (module, parameters, report) = self.analysisParameters(inputVolume, labelmaps, lowerThreshold, upperThreshold, analysis, outputDirectory, voxelSize, slope, intercept, workers)
+
+        # The analysis writes the time and memory of each of its stages next to its report
+        profileFile = os.path.join(outputDirectory, inputVolume.GetName() + "_" + report + ".profile.json")
+
+        # Jobs of the queue count the analysis as running until it finishes
+        analysisID = self.beginAnalysis(inputVolume, analysis)
+        # Set when the analysis keeps running after process returns, which ends it when it finishes
+        inBackground = False
+        try:
+            if inProcess:
+                # The analysis runs synchronously on the arrays in the scene, so no files are written or read
+                try:
+                    self.analyzeInProcess(module, parameters, profile="stages")
+                finally:
+                    slicer.mrmlScene.RemoveNode(labelmap)
+                    if 'labelmap2' in locals():
+                        slicer.mrmlScene.RemoveNode(labelmap2)
+                logging.info(f'Processing completed in {time.time()-startTime:.2f} seconds')
+                self.logProfile(profileFile)
+                return
+
+            if useWorker:
+                started = False
+                try:
+                    started = self.analyzeInWorker(module, parameters, source, wait, onFinished=lambda: self.endAnalysis(analysisID), profile="stages")
+                except Exception:
+                    started = True
+                    raise
+                finally:
+                    # The volumes are written to files for the worker, so the labelmaps are not needed while it runs
+                    if started:
+                        slicer.mrmlScene.RemoveNode(labelmap)
+                        if 'labelmap2' in locals():
+                            slicer.mrmlScene.RemoveNode(labelmap2)
+                if started:
+                    inBackground = not wait
+                    if source:
+                        source._parameterNode.SetNodeReferenceID("labelmapNode", None)
+                        source._parameterNode.SetNodeReferenceID("labelmapNode2", None)
+                        source._parameterNode.SetParameter("startTime", str(startTime))
+                        source._parameterNode.SetParameter("profileFile", profileFile)
+                    elif wait:
+                        logging.info(f'Processing completed in {time.time()-startTime:.2f} seconds')
+                        self.logProfile(profileFile)
+                    return
+
+            parameters["profile"] = "stages"
+            node = slicer.cli.createNode(module, parameters=parameters)
+            # Set up source before running to avoid race conditions
+            if source:
+                source.ui.AnalysisProgress.setValue(0)
+                source.ui.AnalysisProgress.show()
+                source._parameterNode.SetParameter("Analyzing", "True")
+                source._parameterNode.SetNodeReferenceID("labelmapNode", labelmap.GetID())
+                if 'labelmap2' in locals():
+                    source._parameterNode.SetNodeReferenceID("labelmapNode2", labelmap2.GetID())
+                source._parameterNode.SetParameter("startTime", str(startTime))
+                source._parameterNode.SetParameter("profileFile", profileFile)
+                node.AddObserver('ModifiedEvent', source.analysisUpdate)
+            if not wait:
+                node.AddObserver('ModifiedEvent', lambda caller, event: self.analysisNodeUpdate(caller, analysisID))
+            slicer.cli.run(module=module, node=node, wait_for_completion=wait)
+            inBackground = not wait
+        finally:
+            if not inBackground:
+                self.endAnalysis(analysisID)
+
+
+    # Counts an analysis started by process as running, with its estimated memory
+    # Returns the ID to pass to endAnalysis when it finishes
+    def beginAnalysis(self, inputVolume, analysis):
+        self.lastAnalysisID += 1
+        self.analyses[self.lastAnalysisID] = self.estimateMemory(inputVolume, analysis)
+        return self.lastAnalysisID
+
+    # Stops counting an analysis as running, and calls onAnalysisEnd
+    # An analysis that already ended is ignored
+    def endAnalysis(self, analysisID):
+        if self.analyses.pop(analysisID, None) is not None and self.onAnalysisEnd:
+            self.onAnalysisEnd()
+
+    # Ends an analysis started by process when its CLI node finishes
+    def analysisNodeUpdate(self, cliNode, analysisID):
+        status = cliNode.GetStatus()
+        if status & cliNode.Completed or status == cliNode.Cancelled:
+            self.endAnalysis(analysisID)
+
+    # Estimates the megabytes an analysis uses from the size of its volume, like the batch analysis does
+    def estimateMemory(self, inputVolume, analysis):
+        self.importCLI(slicer.modules.corticalanalysis)
+        from MusculoskeletalAnalysisCLITools.batch import ALIASES, VOXEL_BYTES
+
+        imageData = inputVolume.GetImageData()
+        if imageData is None:
+            return 0
+        (x, y, z) = imageData.GetDimensions()
+        return x*y*z * (imageData.GetScalarSize() + VOXEL_BYTES[ALIASES[analysis.lower()]]) // 2**20
+
+    # Checks the inputs of an analysis, and creates the output directory if it does not exist
+    def checkInputs(self, inputVolume, mask, maskLabel, outputDirectory, altDICOM=False, DICOMNode=None, manDICOM=False, DICOMOptions=None):
         if not inputVolume:
             raise ValueError("Input volume is invalid")
         if not mask or not maskLabel:
@@ -658,32 +911,9 @@ class MusculoskeletalAnalysisLogic(ScriptedLoadableModuleLogic):
                 # If directory is not writable for other reason
                 raise ValueError("Output Directory is invalid")
 
-        startTime = time.time()
-        logging.info('Processing started')
-
-        # Get mask segments
-        if analysis == 'Intervertebral Disc':
-            maskLabel = maskLabel.strip('()')
-            labels = maskLabel.split(', ')
-            maskID = mask.GetSegmentation().GetSegmentIdBySegmentName(labels[0].strip('\''))
-            maskArray = vtk.vtkStringArray()
-            maskArray.InsertNextValue(maskID)
-            labelmap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-            slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(mask, maskArray, labelmap, inputVolume)
-
-            maskID2 = mask.GetSegmentation().GetSegmentIdBySegmentName(labels[1].strip('\''))
-            maskArray2 = vtk.vtkStringArray()
-            maskArray2.InsertNextValue(maskID2)
-            labelmap2 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-            slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(mask, maskArray2, labelmap2, inputVolume)
-        else:
-            maskID = mask.GetSegmentation().GetSegmentIdBySegmentName(maskLabel)
-            maskArray = vtk.vtkStringArray()
-            maskArray.InsertNextValue(maskID)
-            labelmap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-            slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(mask, maskArray, labelmap, inputVolume)
-
-
+    # Gets the voxel size and the density slope and intercept of an analysis from the DICOM tags
+    # The slope and intercept are None for intervertebral disc analysis, which does not measure density
+    def calibration(self, inputVolume, analysis, altDICOM=False, DICOMNode=None, manDICOM=False, DICOMOptions=None):
         # Get DICOM source
         if altDICOM:
             dSource = DICOMNode
@@ -691,48 +921,260 @@ class MusculoskeletalAnalysisLogic(ScriptedLoadableModuleLogic):
             dSource = DICOMOptions
         else:
             dSource = inputVolume
+        slope = None
+        intercept = None
         if analysis != 'Intervertebral Disc':
             # Get Density info
             slope=float(self.getDICOMTag(dSource, '0029,1004'))/(float(self.getDICOMTag(dSource, '0029,1000'))*float(self.getDICOMTag(dSource, '0028,1053')))
             intercept=float(self.getDICOMTag(dSource, '0029,1005'))-(float(self.getDICOMTag(dSource, '0028,1052'))*slope)
 
-
         voxelSize = self.getDICOMTag(dSource, '0018,0050')
+        return voxelSize, slope, intercept
 
+    # Exports the segments of an analysis to new labelmap nodes, with the geometry of the input volume
+    # maskLabel: The segment name, or for intervertebral disc analysis the names of both segments as "('disc', 'nucleus')"
+    # Returns a list of the labelmap nodes
+    def exportLabelmaps(self, inputVolume, mask, maskLabel, analysis):
+        if analysis == 'Intervertebral Disc':
+            labels = [label.strip('\'') for label in maskLabel.strip('()').split(', ')[:2]]
+        else:
+            labels = [maskLabel]
+        labelmaps = []
+        for label in labels:
+            maskID = mask.GetSegmentation().GetSegmentIdBySegmentName(label)
+            maskArray = vtk.vtkStringArray()
+            maskArray.InsertNextValue(maskID)
+            labelmap = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+            slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(mask, maskArray, labelmap, inputVolume)
+            labelmaps.append(labelmap)
+        return labelmaps
+
+    # Gets the CLI module, the parameters and the report name of an analysis
+    # labelmaps: The labelmap nodes from exportLabelmaps
+    def analysisParameters(self, inputVolume, labelmaps, lowerThreshold, upperThreshold, analysis, outputDirectory, voxelSize, slope, intercept, workers):
         # Prepare parameters for the selected function
         if analysis == "Cortical Bone":
-            parameters = {"image":inputVolume, "mask":labelmap, "lowerThreshold":lowerThreshold, "upperThreshold":upperThreshold, "voxelSize":voxelSize, "slope":slope, "intercept":intercept, "inputName":inputVolume.GetName(), "output":outputDirectory}
+            parameters = {"image":inputVolume, "mask":labelmaps[0], "lowerThreshold":lowerThreshold, "upperThreshold":upperThreshold, "voxelSize":voxelSize, "slope":slope, "intercept":intercept, "inputName":inputVolume.GetName(), "output":outputDirectory, "workers":workers}
             module=slicer.modules.corticalanalysis
-            requirements = [('scipy', 'scipy'), ('skimage', 'scikit-image'), ('nrrd', 'pynrrd')]
+            report = "cortical"
         elif analysis == "Cancellous Bone":
-            parameters = {"image":inputVolume, "mask":labelmap, "lowerThreshold":lowerThreshold, "upperThreshold":upperThreshold, "voxelSize":voxelSize, "slope":slope, "intercept":intercept, "inputName":inputVolume.GetName(), "output":outputDirectory}
+            parameters = {"image":inputVolume, "mask":labelmaps[0], "lowerThreshold":lowerThreshold, "upperThreshold":upperThreshold, "voxelSize":voxelSize, "slope":slope, "intercept":intercept, "inputName":inputVolume.GetName(), "output":outputDirectory, "workers":workers}
             module=slicer.modules.cancellousanalysis
-            requirements = [('scipy', 'scipy'), ('skimage', 'scikit-image'), ('nrrd', 'pynrrd'), ('trimesh', 'trimesh')]
+            report = "cancellous"
         elif analysis == "Bone Density":
-            parameters = {"image":inputVolume, "mask":labelmap, "voxelSize":voxelSize, "slope":slope, "intercept":intercept, "inputName":inputVolume.GetName(), "output":outputDirectory}
+            parameters = {"image":inputVolume, "mask":labelmaps[0], "voxelSize":voxelSize, "slope":slope, "intercept":intercept, "inputName":inputVolume.GetName(), "output":outputDirectory}
             module=slicer.modules.densityanalysis
-            requirements = [('nrrd', 'pynrrd')]
+            report = "density"
         elif analysis == 'Intervertebral Disc':
-            parameters = {"image":inputVolume, "mask1":labelmap, "mask2":labelmap2, "voxelSize":voxelSize, "inputName":inputVolume.GetName(), "output":outputDirectory}
+            parameters = {"image":inputVolume, "mask1":labelmaps[0], "mask2":labelmaps[1], "voxelSize":voxelSize, "inputName":inputVolume.GetName(), "output":outputDirectory, "workers":workers}
             module = slicer.modules.intervertebralanalysis
-            requirements = [('scipy', 'scipy'), ('nrrd', 'pynrrd')]
+            report = "intervertebral"
+        return module, parameters, report
 
+    # Creates a job for a MusculoskeletalAnalysisQueue, checking its inputs and reading its DICOM tags now
+    # The segments are not exported until the job starts
+    def createJob(self, inputVolume, mask, maskLabel, lowerThreshold, upperThreshold, analysis, outputDirectory, altDICOM=False, DICOMNode=None, manDICOM=False, DICOMOptions=None):
+        self.checkInputs(inputVolume, mask, maskLabel, outputDirectory, altDICOM, DICOMNode, manDICOM, DICOMOptions)
         # Install required python modules
-        self.importRequest(requirements)
+        self.importRequest(self.REQUIREMENTS[analysis])
+        (voxelSize, slope, intercept) = self.calibration(inputVolume, analysis, altDICOM, DICOMNode, manDICOM, DICOMOptions)
+        return AnalysisJob(inputVolume, mask, maskLabel, lowerThreshold, upperThreshold, analysis, outputDirectory, voxelSize, slope, intercept)
+
+    # Runs the analysis of a CLI module in the Slicer process
+    # Volume nodes are passed to the module's analyze function as arrays in the same layout the CLI reads from its files
+    # module: The CLI module
+    # parameters: The CLI parameters from analysisParameters
+    # options: Keyword arguments of the analyze function
+    def analyzeInProcess(self, module, parameters, **options):
+        import multiprocessing
+        cliModule = self.importCLI(module)
+        moduleName = os.path.splitext(os.path.basename(module.path))[0]
+
+        # Each analyze function takes different arguments, so they are named for each module
+        arguments = {"imgData":self.volumeArray(parameters["image"]), "voxSize":float(parameters["voxelSize"]), "name":parameters["inputName"], "output":parameters["output"]}
+        if moduleName == "IntervertebralAnalysis":
+            # The slices are measured in threads, so the workers do not start processes
+            arguments.update(maskData1=self.volumeArray(parameters["mask1"]), maskData2=self.volumeArray(parameters["mask2"]), workers=parameters["workers"])
+        else:
+            arguments.update(maskData=self.volumeArray(parameters["mask"]), slope=parameters["slope"], intercept=parameters["intercept"])
+        if moduleName in ("CorticalAnalysis", "CancellousAnalysis"):
+            arguments.update(lower=parameters["lowerThreshold"], upper=parameters["upperThreshold"])
+            # Spawned workers would start new copies of the Slicer application
+            arguments["workers"] = parameters["workers"] if multiprocessing.get_start_method() == "fork" else 1
+        cliModule.analyze(**arguments, **options)
+
+    # Gets the array of a volume node in the layout the CLI reads from its files
+    def volumeArray(self, node):
+        import numpy as np
+        from MusculoskeletalAnalysisCLITools.reader import orient
+
+        if isinstance(node, slicer.vtkMRMLLabelMapVolumeNode):
+            # The CLI reads masks in voxel (i, j, k) order, arrayFromVolume is (k, j, i)
+            return slicer.util.arrayFromVolume(node).T != 0
+        ijkToRAS = vtk.vtkMatrix4x4()
+        node.GetIJKToRASDirectionMatrix(ijkToRAS)
+        # readImg orients the image using its directions in LPS space
+        direction = np.array([[ijkToRAS.GetElement(row, column) for column in range(3)] for row in range(3)])
+        direction[:2] *= -1
+        return orient(slicer.util.arrayFromVolume(node).T, direction)
+
+    # Runs the analysis of a CLI module in the worker process, which keeps the analysis libraries imported between analyses
+    # The volumes are written to files and passed to the module's main function, as they are for the CLI module
+    # Returns False if the worker can not be reached, so the CLI module can be run instead
+    # module: The CLI module
+    # parameters: The CLI parameters, in the order of the main function's arguments
+    # source: The widget to show the progress on, and to call analysisFinished on when the analysis is done
+    # wait: Wait for the analysis to finish before returning, raising an exception if it fails
+    # onFinished: Called when an analysis that is not waited for is done
+    # options: Keyword arguments of the main function
+    def analyzeInWorker(self, module, parameters, source=None, wait=False, onFinished=None, **options):
+        import shutil
+        import tempfile
+        import threading
+        import qt
+
+        if not self.startWorker():
+            return False
+        from MusculoskeletalAnalysisCLITools.worker import submit, wait as waitForJob
+        (process, address, key) = self.worker
+        moduleName = os.path.splitext(os.path.basename(module.path))[0]
+
+        temp = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+        arguments = []
+        for name, value in parameters.items():
+            if isinstance(value, slicer.vtkMRMLVolumeNode):
+                path = os.path.join(temp, name + ".nrrd")
+                # exportNode does not change the file the node is stored in
+                slicer.util.exportNode(value, path)
+                arguments.append(path)
+            elif name == "voxelSize":
+                arguments.append(float(value))
+            else:
+                arguments.append(value)
+        # The worker may still be importing the analysis libraries
+        connection = None
+        deadline = time.time() + 30
+        while connection is None:
+            try:
+                connection = submit(address, key, moduleName, arguments, options)
+            except OSError:
+                if process.poll() is not None or time.time() > deadline:
+                    logging.warning("The analysis worker is not running, starting the CLI module instead")
+                    shutil.rmtree(temp, ignore_errors=True)
+                    return False
+                time.sleep(.1)
+
+        if wait:
+            try:
+                waitForJob(connection)
+            finally:
+                shutil.rmtree(temp, ignore_errors=True)
+            return True
 
-        node = slicer.cli.createNode(module, parameters=parameters)
-        # Set up source before running to avoid race conditions
         if source:
             source.ui.AnalysisProgress.setValue(0)
             source.ui.AnalysisProgress.show()
             source._parameterNode.SetParameter("Analyzing", "True")
-            source._parameterNode.SetNodeReferenceID("labelmapNode", labelmap.GetID())
-            if 'labelmap2' in locals():
-                source._parameterNode.SetNodeReferenceID("labelmapNode2", labelmap2.GetID())
-            source._parameterNode.SetParameter("startTime", str(startTime))
-            node.AddObserver('ModifiedEvent', source.analysisUpdate)
-        slicer.cli.run(module=module, node=node, wait_for_completion=wait)
-
+        # The job is waited for in a thread, and its progress is shown by a timer in the main thread
+        state = {"progress": 0, "error": None, "done": False}
+        def run():
+            try:
+                waitForJob(connection, lambda progress: state.update(progress=progress))
+            except Exception as e:
+                state["error"] = str(e)
+            state["done"] = True
+        def update():
+            if source:
+                source.workerUpdate(int(state["progress"]*100))
+            if state["done"]:
+                timer.stop()
+                self.workerTimers.remove(timer)
+                shutil.rmtree(temp, ignore_errors=True)
+                if onFinished:
+                    onFinished()
+                if source:
+                    source.analysisFinished(state["error"])
+                elif state["error"] is not None:
+                    logging.error("Analysis failed: " + state["error"])
+        timer = qt.QTimer()
+        timer.setInterval(200)
+        timer.connect("timeout()", update)
+        # The timers are kept until their analysis is done
+        self.workerTimers.append(timer)
+        threading.Thread(target=run, daemon=True).start()
+        timer.start()
+        return True
+
+    # Starts the worker process, which imports the analysis libraries once and then runs each analysis sent to it
+    # Returns whether the worker is running
+    def startWorker(self):
+        import atexit
+        import secrets
+        import shutil
+        import subprocess
+
+        if self.worker is not None and self.worker[0].poll() is None:
+            return True
+        python = shutil.which("PythonSlicer")
+        if python is None:
+            return False
+        # The worker is run from the directory of the CLI modules, like the tools they import
+        self.importCLI(slicer.modules.corticalanalysis)
+        from MusculoskeletalAnalysisCLITools.worker import workerAddress
+        cliDirectory = os.path.dirname(slicer.modules.corticalanalysis.path)
+        environment = dict(os.environ)
+        environment["PYTHONPATH"] = os.pathsep.join(p for p in (cliDirectory, os.path.dirname(cliDirectory), environment.get("PYTHONPATH")) if p)
+        address = workerAddress("MusculoskeletalAnalysis")
+        key = secrets.token_bytes(32)
+        try:
+            process = subprocess.Popen([python, "-m", "MusculoskeletalAnalysisCLITools.worker", address], stdin=subprocess.PIPE, cwd=cliDirectory, env=environment, text=True)
+            # The key is not passed as an argument, where other users could see it
+            process.stdin.write(key.hex() + "\n")
+            process.stdin.flush()
+        except OSError as e:
+            logging.warning("Could not start the analysis worker: " + str(e))
+            return False
+        if self.worker is None:
+            atexit.register(self.stopWorker)
+        self.worker = (process, address, key)
+        return True
+
+    # Stops the worker process, along with any analysis it is running
+    def stopWorker(self):
+        import shutil
+
+        if self.worker is None:
+            return
+        (process, address, key) = self.worker
+        self.worker = None
+        process.kill()
+        process.wait()
+        if not sys.platform.startswith("win"):
+            shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+    # Logs the time and memory of each stage of an analysis, from the profile it wrote next to its report
+    # profileFile: The .profile.json file written by the analysis
+    def logProfile(self, profileFile):
+        import json
+        if not os.path.exists(profileFile):
+            return
+        with open(profileFile) as f:
+            profile = json.load(f)
+        lines = [f'{"Stage":<16}{"Wall (s)":>10}{"CPU (s)":>10}{"Peak increase (MB)":>20}{"Arrays (MB)":>13}']
+        for stage in profile["stages"]:
+            # Analyses run in Slicer or the worker do not reset the peak memory, so only its increase is shown
+            peak = f'{stage["peakIncrease"]/2**20:.1f}' if stage.get("peakIncrease") is not None else "-"
+            arrays = sum(a["bytes"] for a in stage["arrays"].values())/2**20
+            lines.append(f'{stage["name"]:<16}{stage["wall"]:>10.2f}{stage["cpu"]:>10.2f}{peak:>20}{arrays:>13.1f}')
+        logging.info(f'Analysis stages of {profile["name"]}, {profile["wall"]:.2f} seconds in total:\n' + "\n".join(lines))
+
+    # Imports the python script of a CLI module, along with the tools it uses
+    # module: The CLI module
+    def importCLI(self, module):
+        cliDirectory = os.path.dirname(module.path)
+        if cliDirectory not in sys.path:
+            sys.path.append(cliDirectory)
+        return importlib.import_module(os.path.splitext(os.path.basename(module.path))[0])
 
     # Used to get dicom metadata from the volume
     # source: the volume node or DICOM dict
@@ -755,7 +1197,11 @@ class MusculoskeletalAnalysisLogic(ScriptedLoadableModuleLogic):
     def importRequest(self, requested):
         missing = []
         for r in requested:
-            if not importlib.util.find_spec(r[0]):
+            if r[0] in self.foundModules:
+                continue
+            if importlib.util.find_spec(r[0]):
+                self.foundModules.add(r[0])
+            else:
                 missing.append(r)
         if len(missing) > 0:
             names, pips = zip(*missing)
@@ -768,6 +1214,200 @@ class MusculoskeletalAnalysisLogic(ScriptedLoadableModuleLogic):
 
 
 
+#
+# MusculoskeletalAnalysisQueue
+#
+
+class AnalysisJob:
+    """
+    An analysis of one segment of a volume, waiting in or run by a MusculoskeletalAnalysisQueue.
+    Create jobs with MusculoskeletalAnalysisLogic.createJob.
+    """
+
+    def __init__(self, inputVolume, mask, maskLabel, lowerThreshold, upperThreshold, analysis, outputDirectory, voxelSize, slope, intercept):
+        self.inputVolume = inputVolume
+        self.mask = mask
+        self.maskLabel = maskLabel
+        self.lowerThreshold = lowerThreshold
+        self.upperThreshold = upperThreshold
+        self.analysis = analysis
+        self.outputDirectory = outputDirectory
+        self.voxelSize = voxelSize
+        self.slope = slope
+        self.intercept = intercept
+        # Queued, Running, Cancelling, Completed, Failed or Cancelled
+        self.status = "Queued"
+        # The percent of the analysis that is done
+        self.progress = 0
+        self.error = None
+        self.cliNode = None
+        self.observer = None
+        self.labelmaps = []
+        self.memory = 0
+        self.startTime = None
+        self.profileFile = None
+
+    def name(self):
+        return self.inputVolume.GetName() + " " + self.maskLabel + " " + self.analysis
+
+    def finished(self):
+        return self.status in ("Completed", "Failed", "Cancelled")
+
+
+class MusculoskeletalAnalysisQueue:
+    """
+    Runs analysis jobs with their CLI modules, several at a time.
+    Jobs start in the order of the queue once there are enough cores and memory for them. The segments of a job are
+    exported to labelmaps only when it starts, and the labelmaps are removed when it finishes.
+    """
+
+    def __init__(self, logic, maxJobs=None, memoryLimit=None, onChange=None):
+        """
+        :param logic: The MusculoskeletalAnalysisLogic used to start the jobs
+        :param maxJobs: The number of jobs run at once, defaults to half the number of cores
+        :param memoryLimit: The megabytes of memory the running jobs may use together, defaults to the memory available each time jobs start. Analyses started with Apply count as running jobs. One job is always allowed to run
+        :param onChange: Called with each job whose status or progress changes
+        """
+        cores = os.cpu_count() or 1
+        self.logic = logic
+        self.maxJobs = maxJobs or max(1, cores//2)
+        # The cores are shared between the jobs that can run at once
+        self.workers = max(1, cores//self.maxJobs)
+        # None reads the available memory each time jobs start, since other programs and analyses change it
+        self.memoryLimit = memoryLimit
+        self.onChange = onChange
+        # Every job that has not been removed, queued jobs start in this order
+        self.jobs = []
+
+    def add(self, job):
+        """Adds a job to the end of the queue, and starts it if there is room."""
+        self.jobs.append(job)
+        self.changed(job)
+        self.startJobs()
+
+    def running(self):
+        return [job for job in self.jobs if job.status in ("Running", "Cancelling")]
+
+    def cancel(self, job):
+        """Removes a queued job from the queue, or stops a running job."""
+        if job.status == "Queued":
+            job.status = "Cancelled"
+            self.changed(job)
+        elif job.status == "Running":
+            job.status = "Cancelling"
+            self.changed(job)
+            job.cliNode.Cancel()
+
+    def cancelAll(self):
+        for job in list(self.jobs):
+            self.cancel(job)
+
+    def move(self, job, offset):
+        """Moves a queued job earlier in the queue for a negative offset, or later for a positive one, past other queued jobs."""
+        queued = [j for j in self.jobs if j.status == "Queued"]
+        if job not in queued:
+            return
+        target = queued[min(max(queued.index(job) + offset, 0), len(queued) - 1)]
+        self.jobs.remove(job)
+        index = self.jobs.index(target)
+        self.jobs.insert(index + 1 if offset > 0 else index, job)
+        self.changed(job)
+
+    def removeFinished(self):
+        """Removes the finished jobs from the list of jobs."""
+        self.jobs = [job for job in self.jobs if not job.finished()]
+        self.changed(None)
+
+    def startJobs(self):
+        """Starts queued jobs in order while there are cores and memory for them.
+
+        Analyses started with Apply are counted with the running jobs.
+        """
+        self.logic.importCLI(slicer.modules.corticalanalysis)
+        from MusculoskeletalAnalysisCLITools.batch import availableMemory
+
+        running = self.running()
+        memoryLimit = availableMemory() if self.memoryLimit is None else self.memoryLimit
+        used = sum(job.memory for job in running) + sum(self.logic.analyses.values())
+        count = len(running) + len(self.logic.analyses)
+        for job in [j for j in self.jobs if j.status == "Queued"]:
+            if count >= self.maxJobs:
+                break
+            job.memory = self.estimateMemory(job)
+            if count and memoryLimit and used + job.memory > memoryLimit:
+                break
+            try:
+                self.startJob(job)
+            except Exception as e:
+                self.cleanup(job)
+                job.status = "Failed"
+                job.error = str(e)
+                logging.error(f'Could not start {job.name()}: {e}')
+                self.changed(job)
+                continue
+            count += 1
+            used += job.memory
+
+    def estimateMemory(self, job):
+        """Estimates the megabytes a job uses from the size of its volume, like the batch analysis does."""
+        return self.logic.estimateMemory(job.inputVolume, job.analysis)
+
+    def startJob(self, job):
+        """Exports the segments of a job and starts its CLI module."""
+        job.labelmaps = self.logic.exportLabelmaps(job.inputVolume, job.mask, job.maskLabel, job.analysis)
+        (module, parameters, report) = self.logic.analysisParameters(job.inputVolume, job.labelmaps, job.lowerThreshold, job.upperThreshold, job.analysis, job.outputDirectory, job.voxelSize, job.slope, job.intercept, self.workers)
+        parameters["profile"] = "stages"
+        job.profileFile = os.path.join(job.outputDirectory, job.inputVolume.GetName() + "_" + report + ".profile.json")
+        job.cliNode = slicer.cli.createNode(module, parameters=parameters)
+        job.observer = job.cliNode.AddObserver('ModifiedEvent', lambda caller, event: self.jobUpdate(job))
+        job.status = "Running"
+        job.progress = 0
+        job.startTime = time.time()
+        logging.info(f'Started {job.name()}')
+        self.changed(job)
+        slicer.cli.run(module=module, node=job.cliNode, wait_for_completion=False)
+
+    def jobUpdate(self, job):
+        """Updates the progress of a running job from its CLI node, and starts the next jobs when it finishes."""
+        cliNode = job.cliNode
+        if cliNode is None:
+            return
+        status = cliNode.GetStatus()
+        if status & cliNode.Completed or status == cliNode.Cancelled:
+            if status == cliNode.Cancelled:
+                job.status = "Cancelled"
+            elif status & cliNode.ErrorsMask:
+                job.status = "Failed"
+                job.error = cliNode.GetErrorText()
+                logging.error(f'{job.name()} failed: {job.error}')
+            else:
+                job.status = "Completed"
+                job.progress = 100
+                logging.info(f'{job.name()} completed in {time.time()-job.startTime:.2f} seconds')
+                self.logic.logProfile(job.profileFile)
+            self.cleanup(job)
+            self.changed(job)
+            self.startJobs()
+        else:
+            job.progress = cliNode.GetProgress()
+            self.changed(job)
+
+    def cleanup(self, job):
+        """Removes the labelmaps and CLI node of a job."""
+        for labelmap in job.labelmaps:
+            slicer.mrmlScene.RemoveNode(labelmap)
+        job.labelmaps = []
+        if job.cliNode is not None:
+            job.cliNode.RemoveObserver(job.observer)
+            slicer.mrmlScene.RemoveNode(job.cliNode)
+            job.cliNode = None
+
+    def changed(self, job):
+        if self.onChange:
+            self.onChange(job)
+
+
+
 #
 # MusculoskeletalAnalysisTest
 #